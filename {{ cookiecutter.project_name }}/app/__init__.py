@@ -14,8 +14,16 @@ from flask_uploads import (
     configure_uploads,
     patch_request_class,
 )
-from .main import main
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
 from .config import config
+from .metrics import Metrics
+from .pagecache import PageCache
+from .passwords import PasswordHasher
+from .permissions import PermissionCache, StampDirectory
+from .queryinspector import QueryInspector
+from .rowcount import RowCountCache
+from .search import SearchIndex
 
 
 db = SQLAlchemy()
@@ -24,11 +32,21 @@ assets = Environment()
 toolbar = DebugToolbarExtension()
 bootstrap = Bootstrap()
 login_manager = LoginManager()
-login_manager.login_view = "admin.login"
+login_manager.login_view = "admin.login_view"
+permission_cache = PermissionCache()
+user_stamps = StampDirectory("USER_SNAPSHOT_STAMP_DIR")
+password_hasher = PasswordHasher()
+page_cache = PageCache()
+row_count_cache = RowCountCache()
+search_index = SearchIndex()
+metrics = Metrics()
+query_inspector = QueryInspector()
 images = UploadSet("images", IMAGES)
 files = UploadSet("files", DEFAULTS)
 
 
+from .database import init_engine  # noqa: E402
+from .main import main  # noqa: E402
 from .admin.modelviews import (
     MyAdminIndexView,
     UserModelView,
@@ -36,31 +54,67 @@ from .admin.modelviews import (
     FileModelView,
     StaticPageModelView,
 )  # noqa: E402
+from .admin.upload import ChunkedUploadView  # noqa: E402
 
 admin = Admin(
     name="{{ cookiecutter.project_name }}", index_view=MyAdminIndexView(), template_mode="bootstrap3"
 )
 
 
-def init_database(app):
-    from .models import User, Role, Permission
+# increase when tables are added, so that workers create them on startup
+SCHEMA_VERSION = 2
+
+# version of the schema the database was created with, stored in the
+# database itself so it can't disagree with it
+schema_info = db.Table("schema_info", db.Column("version", db.Integer, nullable=False))
+
+
+def schema_version(engine):
+    """Return the schema version of the database or None."""
+    try:
+        with engine.connect() as connection:
+            return connection.scalar(select([schema_info.c.version]))
+    except SQLAlchemyError:
+        # a new database without the table
+        return None
+
+
+def init_schema(app):
+    """Create missing tables unless the database has the current schema.
 
+    Workers only read the version row, the tables are untouched if the
+    schema is current.
+
+    """
     with app.app_context():
+        if schema_version(db.engine) == SCHEMA_VERSION:
+            return
+
         db.create_all()
+        with db.engine.begin() as connection:
+            search_index.create(connection)
+            connection.execute(schema_info.delete())
+            connection.execute(schema_info.insert().values(version=SCHEMA_VERSION))
+
 
-        if Role.query.filter_by(name="Superuser").count() == 0:
-            superuser_role = Role(name="Superuser", permissions=Permission.ADMINISTER)
-            db.session.add(superuser_role)
+def init_database():
+    """Create default roles and the admin user if they don't exist."""
+    from .models import User, Role, Permission
+
+    superuser_role = Role.query.filter_by(name="Superuser").first()
+    if superuser_role is None:
+        superuser_role = Role(name="Superuser", permissions=Permission.ADMINISTER)
+        db.session.add(superuser_role)
 
-        if Role.query.filter_by(name="User").count() == 0:
-            user_role = Role(name="User", default=True, permissions=Permission.MODIFY)
-            db.session.add(user_role)
+    if Role.query.filter_by(name="User").count() == 0:
+        user_role = Role(name="User", default=True, permissions=Permission.MODIFY)
+        db.session.add(user_role)
 
-        if User.query.filter_by(username="admin").count() == 0:
-            admin_user = User(username="admin", password="admin", role=superuser_role)
-            db.session.add(admin_user)
+    if User.query.filter_by(username="admin").count() == 0:
+        admin_user = User(username="admin", password="admin", role=superuser_role)
+        db.session.add(admin_user)
 
-        db.session.commit()
+    db.session.commit()
 
 
 def create_app(config_name: str = os.environ.get("FLASK_ENV", "production")):
@@ -70,7 +124,16 @@ def create_app(config_name: str = os.environ.get("FLASK_ENV", "production")):
 
     # init extensions
     db.init_app(app)
-    init_database(app)
+    init_engine(app)
+    password_hasher.init_app(app)
+    search_index.init_app(app)
+    init_schema(app)
+    permission_cache.init_app(app)
+    user_stamps.init_app(app)
+    page_cache.init_app(app)
+    row_count_cache.init_app(app)
+    metrics.init_app(app)
+    query_inspector.init_app(app)
 
     migrate.init_app(app, db)
     admin.init_app(app)
@@ -79,17 +142,34 @@ def create_app(config_name: str = os.environ.get("FLASK_ENV", "production")):
     login_manager.init_app(app)
     configure_uploads(app, (images, files))
 
-    # patch image size to 16MB
-    patch_request_class(app, 16 * 1024 * 1024)
+    # limit request size, larger files use the chunked upload
+    patch_request_class(app, app.config["UPLOAD_REQUEST_MAX_SIZE"])
 
     # webassets
     assets.init_app(app)
-    sass = Bundle("styles.sass", filters="libsass", output="styles.css")
+    sass = Bundle("styles.sass", filters="libsass", output="gen/styles.%(version)s.css")
     assets.register("sass", sass)
 
     # register blueprints
     app.register_blueprint(main)
 
+    # command line commands
+    from .commands import (
+        build_assets_command,
+        clear_page_cache_command,
+        init_db_command,
+        optimize_images_command,
+        rebuild_search_index_command,
+        renumber_order_command,
+    )
+
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(clear_page_cache_command)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(optimize_images_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(renumber_order_command)
+
     # Admin views
     from .models import User, Image, File, StaticPage
 
@@ -97,5 +177,6 @@ def create_app(config_name: str = os.environ.get("FLASK_ENV", "production")):
     admin.add_view(FileModelView(File, db.session, name="Dateien"))
     admin.add_view(UserModelView(User, db.session, name="Benutzer"))
     admin.add_view(StaticPageModelView(StaticPage, db.session, name="Statische Seiten"))
+    admin.add_view(ChunkedUploadView(name="Upload", endpoint="upload"))
 
     return app
@@ -21,13 +21,13 @@ class LoginForm(form.Form):
         'Passwort:', validators=[required(MSG_REQUIRED)])
 
     def validate_login(self, field):
-        user = self.get_user()
-
-        if user is None:
-            raise validators.ValidationError('Ungültiger Benutzername')
-
-        if not user.verify_password(self.password.data):
-            raise validators.ValidationError('Ungültiges Passwort')
+        if self.get_user() is None:
+            raise validators.ValidationError(
+                'Ungültiger Benutzername oder Passwort')
 
     def get_user(self):
-        return User.query.filter_by(username=self.username.data).first()
+        """Return the authenticated user or None, checked only once."""
+        if not hasattr(self, '_user'):
+            self._user = User.authenticate(
+                self.username.data, self.password.data)
+        return self._user
@@ -0,0 +1,154 @@
+"""List views for large tables.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+from urllib.parse import urlencode
+from flask import request
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+from .. import row_count_cache
+
+
+def _parse_cursor(value):
+    try:
+        key, id_ = value.split(":")
+        return int(key), int(id_)
+    except (AttributeError, ValueError):
+        return None
+
+
+class FastListMixin:
+    """Cached row counts and keyset pagination for ModelViews.
+
+    The row count comes from the `RowCountCache` instead of a COUNT(*) on
+    every list page. Sorted by one of `keyset_columns` the next and previous
+    page links carry the key of the last or first row on the page and the
+    query continues from there instead of skipping rows with OFFSET. The
+    pager only links the previous and next page then, as jumps to other
+    pages would need OFFSET. Searches and filters use the default
+    implementation.
+
+    Keyset columns must be integer columns without NULL values.
+
+    """
+
+    keyset_columns = ("id",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        row_count_cache.watch(self.model)
+
+    def _keyset_sort(self, sort_column, sort_desc):
+        """Return the keyset column and direction or None."""
+        if sort_column is None:
+            default = self.column_default_sort or "id"
+            if isinstance(default, tuple):
+                sort_column, sort_desc = default
+            else:
+                sort_column, sort_desc = default, False
+
+        if sort_column not in self.keyset_columns:
+            return None
+        return sort_column, bool(sort_desc)
+
+    def get_count_query(self):
+        count_query = super().get_count_query()
+        return _CachedCount(self.model.__table__.name, count_query)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        keyset = self._keyset_sort(sort_column, sort_desc)
+        if page_size is None:
+            page_size = self.page_size
+
+        if search or filters or not execute or not page_size or keyset is None:
+            return super().get_list(
+                page, sort_column, sort_desc, search, filters, execute, page_size
+            )
+
+        column, desc = keyset
+        key = getattr(self.model, column)
+        pk = self.model.id
+
+        query = self.get_query()
+        for join in self._auto_joins:
+            query = query.options(joinedload(join))
+
+        after = _parse_cursor(request.args.get("after"))
+        before = None if after else _parse_cursor(request.args.get("before"))
+        cursor = after or before
+        if cursor is not None:
+            value, id_ = cursor
+            if (after is not None) != desc:
+                query = query.filter(or_(key > value, and_(key == value, pk > id_)))
+            else:
+                query = query.filter(or_(key < value, and_(key == value, pk < id_)))
+
+        # rows before the cursor are fetched in reverse order
+        if desc != (before is not None):
+            query = query.order_by(key.desc(), pk.desc())
+        else:
+            query = query.order_by(key, pk)
+
+        query = query.limit(page_size)
+        if cursor is None and page:
+            query = query.offset(page * page_size)
+
+        data = query.all()
+        if before is not None:
+            data.reverse()
+
+        if data:
+            self._template_args["keyset_cursors"] = (
+                self._cursor(data[0], column),
+                self._cursor(data[-1], column),
+            )
+
+        return self.get_count_query().scalar(), data
+
+    @staticmethod
+    def _cursor(row, column):
+        return f"{getattr(row, column)}:{row.id}"
+
+    def render(self, template, **kwargs):
+        cursors = self._template_args.pop("keyset_cursors", None)
+        if cursors is not None and "pager_url" in kwargs:
+            kwargs["pager_url"] = self._keyset_pager_url(
+                kwargs["pager_url"], kwargs["page"], cursors
+            )
+            # without the number of pages the template shows the simple pager
+            kwargs["num_pages"] = None
+        return super().render(template, **kwargs)
+
+    @staticmethod
+    def _keyset_pager_url(pager_url, page, cursors):
+        first, last = cursors
+
+        def keyset_pager_url(p):
+            url = pager_url(p)
+            if p == page + 1:
+                args = {"after": last}
+            elif p == page - 1 and p > 0:
+                args = {"before": first}
+            else:
+                return url
+            return url + ("&" if "?" in url else "?") + urlencode(args)
+
+        return keyset_pager_url
+
+
+class _CachedCount:
+    """Count query that is answered from the `RowCountCache`."""
+
+    def __init__(self, table, count_query):
+        self.table = table
+        self.count_query = count_query
+
+    def scalar(self):
+        return row_count_cache.count(self.table, self.count_query)
+
+    def __getattr__(self, name):
+        # filtered counts in the default get_list are not cached
+        return getattr(self.count_query, name)
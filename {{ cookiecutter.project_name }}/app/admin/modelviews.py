@@ -9,7 +9,7 @@
 """
 import os
 import flask_login as login
-from flask import redirect, url_for, request, flash
+from flask import current_app, redirect, url_for, request, flash, session
 from flask_admin import AdminIndexView, expose, helpers, form
 from flask_admin.form import rules
 from flask_admin.contrib.sqla import ModelView
@@ -17,9 +17,12 @@ from jinja2 import Markup
 from wtforms.fields import PasswordField
 from .forms import LoginForm
 from .ckeditor import CKEditorMixin, CKTextAreaField
+from .listing import FastListMixin
+from ..imaging import delete_variants, rename_variants
+from ..models import UserSnapshot
 from ..orderable import OrderableModelViewMixin
 from ..config import IMAGE_DIR, FILE_DIR
-from .. import images, files
+from .. import images, files, search_index
 
 
 def _list_thumbnail(view, context, model, name):
@@ -27,7 +30,9 @@ def _list_thumbnail(view, context, model, name):
         return ""
 
     return Markup(
-        '<img src="{model.url}" style="width: 150px;">'.format(model=model)
+        '<img src="{url}" style="width: 150px;">'.format(
+            url=model.variant_url("thumbnail")
+        )
     )
 
 
@@ -46,7 +51,7 @@ class MyAdminIndexView(AdminIndexView):
         form = LoginForm(request.form)
         if helpers.validate_form_on_submit(form):
             user = form.get_user()
-            if user is not None and user.verify_password(form.password.data):
+            if user is not None:
                 login.login_user(user)
             else:
                 flash("Invalid username or password.")
@@ -59,6 +64,7 @@ class MyAdminIndexView(AdminIndexView):
     @expose("/logout/")
     def logout_view(self):
         login.logout_user()
+        session.pop(UserSnapshot.SESSION_KEY, None)
         return redirect(url_for(".index"))
 
 
@@ -80,12 +86,13 @@ class SuperuserModelView(ModelView):
         )
 
 
-class ImageModelView(SecureModelView):
+class ImageModelView(FastListMixin, SecureModelView):
     """ModelView for images."""
 
     edit_template = "/admin/edit_image.html"
     create_template = "/admin/edit_image.html"
     list_template = "/admin/list_file.html"
+    chunked_upload_set = "images"
 
     column_list = ["image", "filename"]
 
@@ -93,6 +100,8 @@ class ImageModelView(SecureModelView):
 
     column_formatters = {"image": _list_thumbnail}
 
+    form_excluded_columns = ["blob", "width", "height", "size", "variants", "formats"]
+
     form_extra_fields = {
         "image": form.ImageUploadField(
             "Bild", base_path=IMAGE_DIR, url_relative_path="images/"
@@ -104,11 +113,24 @@ class ImageModelView(SecureModelView):
     def on_model_change(self, form, model, is_created):
 
         if form.image.data is None:
-            if request.form["filename"] != request.form["old_filename"]:
+            # blobs in the content addressed store keep their name
+            if (
+                model.blob is None
+                and request.form["filename"] != request.form["old_filename"]
+            ):
                 os.rename(
                     images.path(request.form["old_filename"]),
                     images.path(request.form["filename"])
                 )
+                rename_variants(
+                    images.path(request.form["old_filename"]),
+                    images.path(request.form["filename"]),
+                    model.variant_names,
+                    model.format_names,
+                )
+
+        elif current_app.config["CONTENT_ADDRESSED_STORAGE"]:
+            model.store_content(images.path(form.image.data.filename))
 
         else:
             if form.filename.data != form.image.data.filename:
@@ -117,13 +139,27 @@ class ImageModelView(SecureModelView):
                     images.path(form.filename.data)
                 )
 
+            # variants of a replaced image
+            old_filename = request.form.get("old_filename")
+            if old_filename and old_filename != model.filename:
+                delete_variants(
+                    images.path(old_filename),
+                    model.variant_names,
+                    model.format_names,
+                )
+
+            model.update_variants()
 
-class FileModelView(SecureModelView):
+
+class FileModelView(FastListMixin, SecureModelView):
     """ModelView for files."""
 
     edit_template = "/admin/edit_file.html"
     create_template = "/admin/edit_file.html"
     list_template = "/admin/list_file.html"
+    chunked_upload_set = "files"
+
+    form_excluded_columns = ["blob"]
 
     form_extra_fields = {
         "file": form.FileUploadField(
@@ -134,12 +170,19 @@ class FileModelView(SecureModelView):
     def on_model_change(self, form, model, is_created):
 
         if form.file.data is None:
-            if request.form["filename"] != request.form["old_filename"]:
+            # blobs in the content addressed store keep their name
+            if (
+                model.blob is None
+                and request.form["filename"] != request.form["old_filename"]
+            ):
                 os.rename(
                     files.path(request.form["old_filename"]),
                     files.path(request.form["filename"])
                 )
 
+        elif current_app.config["CONTENT_ADDRESSED_STORAGE"]:
+            model.store_content(files.path(form.file.data.filename))
+
         else:
             if form.filename.data != form.file.data.filename:
                 os.rename(
@@ -148,8 +191,11 @@ class FileModelView(SecureModelView):
                 )
 
 
-class StaticPageModelView(CKEditorMixin, OrderableModelViewMixin, SecureModelView):
+class StaticPageModelView(
+    FastListMixin, CKEditorMixin, OrderableModelViewMixin, SecureModelView
+):
 
+    keyset_columns = ("id", "order_index")
     column_list = ["name"]
     form_overrides = {"text": CKTextAreaField}
     form_rules = [rules.FieldSet(["name", "text"])]
@@ -158,8 +204,19 @@ class StaticPageModelView(CKEditorMixin, OrderableModelViewMixin, SecureModelVie
         "text": "Text",
     }
 
+    column_searchable_list = ["name", "text"]
+
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        # use the full text index instead of LIKE queries if available
+        ids = search_index.match_ids(search)
+        if ids is None:
+            return super()._apply_search(query, count_query, joins, count_joins, search)
+
+        condition = self.model.id.in_(ids)
+        return query.filter(condition), count_query.filter(condition), joins, count_joins
+
 
-class UserModelView(SuperuserModelView):
+class UserModelView(FastListMixin, SuperuserModelView):
     """ModelView for user management."""
     column_list = ["username", "role", "email"]
 
@@ -0,0 +1,278 @@
+"""Chunked and resumable uploads for large files.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import fcntl
+import json
+import os
+import re
+import time
+import uuid
+import flask_login as login
+from contextlib import contextmanager
+from flask import abort, current_app, jsonify, request
+from flask_admin import BaseView, expose
+from flask_uploads import extension
+from werkzeug.utils import secure_filename
+from .. import db, images, files, metrics, storage
+from ..imaging import delete_variants, is_image
+from ..storage import content_hash, hash_blocks
+
+
+_CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+_BLOCK_SIZE = 64 * 1024
+
+
+class ChunkedUploadView(BaseView):
+    """Receive files in chunks that are streamed into a temporary file.
+
+    The client starts an upload with a POST, sends the chunks with PUT and a
+    Content-Range header and finishes the upload with a POST to `finish`.
+    Chunks are written to disk in small blocks, so memory use doesn't depend
+    on the file size. Requests for an upload hold an exclusive lock on its
+    temporary file, so concurrent requests, possibly in different workers,
+    append in order. Every PUT records the digests of the blocks it
+    completed in the meta file, finishing only hashes the last block to get
+    the content hash (see `app.storage`). An interrupted upload is resumed
+    by asking for the current offset with GET. Finishing checks the content
+    hash and that images can be read, moves the file into place and
+    creates the database row.
+
+    """
+
+    def is_accessible(self):
+        return login.current_user.is_active and login.current_user.is_authenticated
+
+    def is_visible(self):
+        return False
+
+    def _target(self, name):
+        from ..models import Image, File
+
+        targets = {"images": (images, Image), "files": (files, File)}
+        if name not in targets:
+            abort(404)
+        return targets[name]
+
+    def _tmp_dir(self):
+        path = current_app.config["UPLOAD_TMP_DIR"]
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _load(self, upload_id):
+        if not re.match(r"^[0-9a-f]{32}$", upload_id):
+            abort(404)
+        meta_file = os.path.join(self._tmp_dir(), upload_id + ".json")
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            abort(404)
+        return meta, meta_file, os.path.join(self._tmp_dir(), upload_id + ".part")
+
+    def _save_meta(self, meta_file, meta):
+        tmp = f"{meta_file}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, meta_file)
+
+    @contextmanager
+    def _locked(self, upload_id):
+        """Lock the temporary file and yield it with the current meta data.
+
+        Fails with 404 if another request finished the upload before.
+
+        """
+        _, meta_file, part_file = self._load(upload_id)
+        try:
+            fd = os.open(part_file, os.O_RDWR)
+        except FileNotFoundError:
+            abort(404)
+        with os.fdopen(fd, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # finishing removes the meta file before it releases the lock
+            meta, _, _ = self._load(upload_id)
+            yield f, meta, meta_file, part_file
+
+    def _discard(self, meta_file, part_file):
+        for path in (meta_file, part_file):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _discard_image(self, meta_file, path):
+        # Pillow may only fail when decoding all of the image, after some
+        # variants were written
+        config = current_app.config
+        delete_variants(path, config["IMAGE_VARIANTS"], config["IMAGE_FORMATS"])
+        self._discard(meta_file, path)
+
+    def _unique_filename(self, model_class, filename):
+        # display names are only database values in the content addressed store
+        name, ext = os.path.splitext(filename)
+        i = 0
+        while model_class.query.filter_by(filename=filename).count():
+            i += 1
+            filename = f"{name}_{i}{ext}"
+        return filename
+
+    def _remove_expired(self):
+        expires = time.time() - current_app.config["UPLOAD_EXPIRES"]
+        tmp_dir = self._tmp_dir()
+        for name in os.listdir(tmp_dir):
+            path = os.path.join(tmp_dir, name)
+            try:
+                if os.path.getmtime(path) < expires:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @expose("/", methods=("POST",))
+    def index(self):
+        """Start an upload, expects upload_set, filename and size as JSON."""
+        data = request.get_json(force=True)
+        upload_set, _ = self._target(data.get("upload_set"))
+        filename = secure_filename(data.get("filename", ""))
+        size = int(data.get("size", -1))
+
+        if not filename or not upload_set.extension_allowed(extension(filename)):
+            abort(400)
+        if not 0 <= size <= current_app.config["UPLOAD_MAX_SIZE"]:
+            abort(413)
+
+        self._remove_expired()
+
+        upload_id = uuid.uuid4().hex
+        tmp_dir = self._tmp_dir()
+        open(os.path.join(tmp_dir, upload_id + ".part"), "wb").close()
+        self._save_meta(
+            os.path.join(tmp_dir, upload_id + ".json"),
+            {
+                "upload_set": upload_set.name,
+                "filename": filename,
+                "size": size,
+                "started": time.time(),
+                # digests of the complete blocks received so far
+                "blocks": [],
+            },
+        )
+
+        return jsonify(id=upload_id, offset=0, block_size=storage.HASH_BLOCK_SIZE), 201
+
+    @expose("/<upload_id>", methods=("GET", "PUT"))
+    def chunk(self, upload_id):
+        """Return the current offset or append a chunk."""
+        meta, _, part_file = self._load(upload_id)
+        if request.method == "GET":
+            try:
+                offset = os.path.getsize(part_file)
+            except OSError:
+                abort(404)
+            return jsonify(
+                id=upload_id,
+                offset=offset,
+                size=meta["size"],
+                block_size=storage.HASH_BLOCK_SIZE,
+            )
+
+        match = _CONTENT_RANGE.match(request.headers.get("Content-Range", ""))
+        if match is None:
+            abort(400)
+        start, end, total = map(int, match.groups())
+        if total != meta["size"] or not start <= end < total:
+            abort(400)
+
+        with self._locked(upload_id) as (f, meta, meta_file, _):
+            # size under the lock, another request may have appended
+            offset = os.fstat(f.fileno()).st_size
+            if start != offset:
+                # chunk was already received or one is missing, client
+                # continues from the returned offset
+                return jsonify(id=upload_id, offset=offset), 409
+
+            f.seek(offset)
+            remaining = end - start + 1
+            while remaining:
+                block = request.stream.read(min(_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                f.write(block)
+                offset += len(block)
+                remaining -= len(block)
+            f.flush()
+
+            # the new blocks are still in the page cache. Rewriting the meta
+            # file also keeps active uploads from expiring.
+            hash_blocks(f, meta["blocks"])
+            self._save_meta(meta_file, meta)
+
+        return jsonify(id=upload_id, offset=offset)
+
+    @expose("/<upload_id>/finish", methods=("POST",))
+    def finish(self, upload_id):
+        """Move the complete file into place and create its database row."""
+        start = time.perf_counter()
+        with self._locked(upload_id) as (f, meta, meta_file, part_file):
+            offset = os.fstat(f.fileno()).st_size
+            if offset != meta["size"]:
+                return jsonify(id=upload_id, offset=offset), 409
+            # only the incomplete last block is read
+            digests = meta["blocks"]
+            checksum = content_hash(digests, hash_blocks(f, digests))
+
+            expected = (request.get_json(silent=True) or {}).get("content_hash")
+            if expected and expected.lower() != checksum:
+                self._discard(meta_file, part_file)
+                return jsonify(id=upload_id, content_hash=checksum), 422
+
+            model = self._store(meta, meta_file, part_file, checksum)
+            os.remove(meta_file)
+
+        db.session.add(model)
+        db.session.commit()
+
+        metrics.upload_finished(
+            meta["upload_set"],
+            meta["size"],
+            duration=time.time() - meta.get("started", time.time()),
+            processing=time.perf_counter() - start,
+        )
+        return jsonify(
+            id=model.id, filename=model.filename, url=model.url, content_hash=checksum
+        )
+
+    def _store(self, meta, meta_file, part_file, checksum):
+        """Move the upload into place and return the new model."""
+        upload_set, model_class = self._target(meta["upload_set"])
+        processed = hasattr(model_class, "update_variants")
+        if processed and not is_image(part_file):
+            self._discard(meta_file, part_file)
+            abort(400)
+
+        filename = meta["filename"]
+        if current_app.config["CONTENT_ADDRESSED_STORAGE"]:
+            filename = self._unique_filename(model_class, filename)
+            model = model_class(filename=filename)
+            try:
+                model.store_content(part_file, checksum)
+            except (OSError, ValueError):
+                self._discard_image(meta_file, part_file)
+                abort(400)
+        else:
+            if os.path.exists(upload_set.path(filename)):
+                filename = upload_set.resolve_conflict(
+                    upload_set.config.destination, filename
+                )
+            path = upload_set.path(filename)
+            os.replace(part_file, path)
+            model = model_class(filename=filename)
+            if processed:
+                try:
+                    model.update_variants()
+                except (OSError, ValueError):
+                    self._discard_image(meta_file, path)
+                    abort(400)
+        return model
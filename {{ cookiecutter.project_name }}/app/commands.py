@@ -0,0 +1,134 @@
+"""Flask command line commands.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import gzip
+import os
+import shutil
+import click
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from flask import current_app
+from flask.cli import with_appcontext
+from . import assets, db, init_database, init_schema, page_cache, search_index
+from .imaging import delete_stale_variants, delete_variants, process_image
+from .orderable import OrderableModelMixin
+from .pagecache import assets_version
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    """Create the tables, the default roles and the admin user."""
+    init_schema(current_app)
+    init_database()
+    click.echo("Initialized the database")
+
+
+@click.command("renumber-order")
+@with_appcontext
+def renumber_order_command():
+    """Spread the order_index numbers of all orderable models."""
+    for c in list(db.Model._decl_class_registry.values()):
+        if isinstance(c, type) and issubclass(c, OrderableModelMixin):
+            c.renumber_order_index()
+            click.echo(f"Renumbered {c.__tablename__}")
+
+
+@click.command("clear-page-cache")
+@with_appcontext
+def clear_page_cache_command():
+    """Remove all rendered pages from the page cache."""
+    page_cache.clear()
+    click.echo("Cleared the page cache")
+
+
+@click.command("rebuild-search-index")
+@with_appcontext
+def rebuild_search_index_command():
+    """Index all static pages for the full text search again."""
+    if not search_index.enabled:
+        click.echo("The database doesn't support SQLite FTS5, search uses LIKE queries")
+        return
+    with db.engine.begin() as connection:
+        search_index.create(connection)
+        count = search_index.rebuild(connection)
+    click.echo(f"Indexed {count} pages")
+
+
+@click.command("optimize-images")
+@click.option(
+    "-j", "--jobs", type=int, default=None,
+    help="Number of processes, defaults to the number of CPUs.",
+)
+@with_appcontext
+def optimize_images_command(jobs):
+    """Optimize all images and recreate their variants in parallel."""
+    from .models import Image
+
+    config = current_app.config
+    # blobs in the content addressed store were optimized before hashing
+    image_list = Image.query.filter(Image.blob.is_(None)).all()
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                process_image,
+                image.filepath,
+                config["IMAGE_VARIANTS"],
+                config["IMAGE_FORMATS"],
+                config["IMAGE_QUALITY"],
+            ): image
+            for image in image_list
+        }
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                info = future.result()
+            except (OSError, ValueError) as e:
+                # the old variants may be partly overwritten, serve the original
+                delete_variants(
+                    image.filepath,
+                    set(image.variant_names) | set(config["IMAGE_VARIANTS"]),
+                    set(image.format_names) | set(config["IMAGE_FORMATS"]),
+                )
+                image.clear_image_info()
+                click.echo(click.style(f"Error processing {image.filename}: {e}", fg="red"))
+                continue
+            # the new variants are written, remove the ones that aren't needed any more
+            delete_stale_variants(image.filepath, image.variant_names, image.format_names, info)
+            image.set_image_info(info)
+            click.echo(f"Optimized {image.filename}")
+
+    db.session.commit()
+
+
+def _precompress(path):
+    """Write .gz and, if the brotli package is installed, .br siblings."""
+    with open(path, "rb") as src, gzip.GzipFile(
+        path + ".gz", "wb", compresslevel=9, mtime=0
+    ) as dst:
+        shutil.copyfileobj(src, dst)
+
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path, "rb") as src, open(path + ".br", "wb") as dst:
+        dst.write(brotli.compress(src.read()))
+
+
+@click.command("build-assets")
+@with_appcontext
+def build_assets_command():
+    """Compile and minify all bundles into fingerprinted files."""
+    for bundle in assets:
+        bundle.build(force=True)
+        output = bundle.resolve_output(assets, bundle.get_version(assets))
+        _precompress(output)
+        click.echo(f"Built {os.path.relpath(output, assets.directory)}")
+
+    # cached pages link the previous bundles
+    page_cache.clear()
+    page_cache.assets_version = assets_version(current_app.config.get("ASSETS_MANIFEST"))
@@ -9,37 +9,187 @@
 
 """
 import os
+from sqlalchemy.pool import QueuePool
 
 
 APP_DIR = os.path.abspath(os.path.dirname(__file__))
 FILE_DIR = os.path.join(APP_DIR, "static/files")
 IMAGE_DIR = os.path.join(APP_DIR, "static/images")
+DATABASE_URI = os.environ.get(
+    "DATABASE_URL", "sqlite:///" + os.path.join(APP_DIR, "db", "data.sqlite")
+)
+
+
+def engine_options(uri: str, pool_size: int = 5, max_overflow: int = 10) -> dict:
+    """Return SQLAlchemy engine options suitable for the database `uri`."""
+    pool_size = int(os.environ.get("DATABASE_POOL_SIZE", pool_size))
+    max_overflow = int(os.environ.get("DATABASE_MAX_OVERFLOW", max_overflow))
+
+    if uri.startswith("sqlite"):
+        if uri in ("sqlite://", "sqlite:///:memory:"):
+            return {}
+        # keep connections open, connecting runs the SQLITE_PRAGMAS
+        return {
+            "poolclass": QueuePool,
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "connect_args": {"check_same_thread": False},
+        }
+
+    # server databases close idle connections, check them before use
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_pre_ping": True,
+        "pool_recycle": int(os.environ.get("DATABASE_POOL_RECYCLE", 1800)),
+    }
 
 
 class Config:
     """Base configuration settings for development and production."""
     SECRET_KEY = os.environ["FLASK_SECRET_KEY"]
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(APP_DIR, "db", "data.sqlite")
+    SQLALCHEMY_DATABASE_URI = DATABASE_URI
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URI)
+
+    # executed on every new SQLite connection, WAL lets readers continue
+    # while another worker writes
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 1024 * 1024,
+    }
+
+    PERMISSION_CACHE_STAMP = os.path.join(APP_DIR, "db", "roles.stamp")
+
+    # hash method and cost for passwords, existing hashes are upgraded at the
+    # next login of the user. At most PASSWORD_HASH_CONCURRENCY hashes are
+    # computed at the same time on the host, requests that wait longer than
+    # PASSWORD_HASH_TIMEOUT seconds for a slot get a 503.
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:150000")
+    PASSWORD_HASH_CONCURRENCY = int(os.environ.get("PASSWORD_HASH_CONCURRENCY", 2))
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 5))
+    PASSWORD_HASH_SLOT_DIR = os.path.join(APP_DIR, "cache", "password-slots")
+
+    # keep a snapshot of the logged in user in the session instead of
+    # loading the user from the database on every request
+    USER_SNAPSHOT = os.environ.get("USER_SNAPSHOT", "1") == "1"
+    USER_SNAPSHOT_STAMP_DIR = os.path.join(APP_DIR, "db", "users")
+
+    # rendered static pages, shared by all workers
+    PAGE_CACHE_DIR = os.path.join(APP_DIR, "cache", "pages")
+    PAGE_CACHE_STAMP_DIR = os.path.join(APP_DIR, "db", "pages")
+
+    # row counts of the admin list views are cached until rows are inserted
+    # or deleted, at most ROW_COUNT_MAX_AGE seconds
+    ROW_COUNT_STAMP_DIR = os.path.join(APP_DIR, "db", "rowcounts")
+    ROW_COUNT_MAX_AGE = int(os.environ.get("ROW_COUNT_MAX_AGE", 300))
+
+    # Prometheus metrics on METRICS_URL, the workers write them into
+    # METRICS_DIR, which gunicorn empties on start, backups.py into
+    # BACKUP_METRICS_DIR. If METRICS_TOKEN is set, it is required as bearer
+    # token. With METRICS_TOKEN_REQUIRED the endpoint only exists with one.
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+    METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(APP_DIR, "cache", "metrics"))
+    BACKUP_METRICS_DIR = os.environ.get(
+        "BACKUP_METRICS_DIR", os.path.join(APP_DIR, "cache", "backup-metrics")
+    )
+    METRICS_URL = "/metrics"
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+    METRICS_TOKEN_REQUIRED = False
+
+    # log N+1 queries, slow queries with their plan and requests with more
+    # queries than the budget of their endpoint, see app/queryinspector.py
+    QUERY_INSPECTOR = os.environ.get("QUERY_INSPECTOR", "0") == "1"
+    N_PLUS_ONE_THRESHOLD = 5
+    SLOW_QUERY_THRESHOLD = float(os.environ.get("SLOW_QUERY_THRESHOLD", 0.1))
+    QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", 20))
+    QUERY_BUDGETS = {
+        "main.index": 5,
+        "main.search": 5,
+    }
+
+    # maximum width and height of the resized copies of uploaded images
+    IMAGE_VARIANTS = {"thumbnail": 150, "medium": 800, "large": 1600}
+
+    # uploaded images are recompressed without metadata and additionally
+    # stored in these formats if Pillow supports them (AVIF needs a plugin)
+    IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+    IMAGE_FORMATS = ["avif", "webp"]
+
+    # webassets writes fingerprinted bundles to static/gen, the manifest
+    # maps bundles to the current fingerprint
+    ASSETS_VERSIONS = "hash"
+    ASSETS_MANIFEST = "json:" + os.path.join(APP_DIR, "static", "gen", "manifest.json")
+    ASSETS_URL_EXPIRE = False
+    LIBSASS_STYLE = "compressed"
+
     UPLOADED_IMAGES_DEST = IMAGE_DIR
     UPLOADED_IMAGES_URL = "/static/images/"
 
     UPLOADED_FILES_DEST = FILE_DIR
     UPLOADED_FILES_URL = "/static/files/"
 
+    # store new uploads under the hash of their content, identical files
+    # are stored only once and renames don't touch the filesystem
+    CONTENT_ADDRESSED_STORAGE = os.environ.get("CONTENT_ADDRESSED_STORAGE", "0") == "1"
+
+    # uploads only for logged in users: their urls point to the download
+    # route and the container makes the upload directories internal in
+    # nginx. nginx sets the X-Sendfile-Type header and serves
+    # X_ACCEL_REDIRECT_PREFIX as internal location.
+    PROTECTED_DOWNLOADS = os.environ.get("PROTECTED_DOWNLOADS", "0") == "1"
+    X_ACCEL_REDIRECT_PREFIX = "/protected/"
+
+    # size limit of a single request, large files are uploaded in chunks up
+    # to UPLOAD_MAX_SIZE, unfinished chunked uploads expire after one day
+    UPLOAD_REQUEST_MAX_SIZE = int(os.environ.get("UPLOAD_REQUEST_MAX_SIZE", 16 * 1024 * 1024))
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    # unfinished chunked uploads, not below the static directory and on the
+    # filesystem of the upload directories, so finishing is a rename
+    UPLOAD_TMP_DIR = os.path.join(APP_DIR, "cache", "uploads")
+    UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE", 4 * 1024 ** 3))
+    UPLOAD_EXPIRES = 24 * 60 * 60
+
 
 class DevelopmentConfig(Config):
     """Development configuration."""
+    QUERY_INSPECTOR = os.environ.get("QUERY_INSPECTOR", "1") == "1"
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     TEMPLATES_AUTO_RELOAD = True
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URI, pool_size=2, max_overflow=5)
 
 
 class ProductionConfig(Config):
     """Production configuration."""
     TEMPLATES_AUTO_RELOAD = False
 
+    # bundles are built ahead of time with "flask build-assets"
+    ASSETS_AUTO_BUILD = False
+
+    # the request metrics show the endpoints and their traffic
+    METRICS_TOKEN_REQUIRED = True
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URI, pool_size=10, max_overflow=20)
+
+
+class TestingConfig(Config):
+    """Configuration for the test suite."""
+    TESTING = True
+    DEBUG_TB_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+
+    # requests over their query budget raise QueryBudgetExceeded
+    QUERY_INSPECTOR = True
+    METRICS_ENABLED = False
+
+    # cheap hashes, the tests log in a lot
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000"
+
 
 config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
+    'testing': TestingConfig,
 }
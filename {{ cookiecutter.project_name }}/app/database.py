@@ -0,0 +1,25 @@
+"""Database engine setup.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+from sqlalchemy import event
+from . import db
+
+
+def init_engine(app):
+    """Run the SQLITE_PRAGMAS on every new connection of a SQLite engine."""
+    pragmas = app.config.get("SQLITE_PRAGMAS")
+    with app.app_context():
+        engine = db.engine
+
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
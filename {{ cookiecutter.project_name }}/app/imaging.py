@@ -0,0 +1,162 @@
+"""Optimization and resized variants of uploaded images.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import os
+import uuid
+from collections import namedtuple
+from PIL import Image as PILImage, ImageOps
+
+
+ImageInfo = namedtuple(
+    "ImageInfo", ["width", "height", "size", "variants", "formats"]
+)
+
+# formats that are recompressed, others are only resized
+_RECOMPRESS_FORMATS = ("JPEG", "PNG", "WEBP")
+
+# keys of `Image.info` with metadata that may identify the camera, owner or
+# location, XMP in PNG files is an iTXt chunk
+_METADATA_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "comment")
+
+
+def variant_path(path: str, variant: str = None, fmt: str = None) -> str:
+    """Return the path of a variant of the image at `path`.
+
+    Resized variants are stored in a subdirectory named after the variant,
+    alternative formats get the format as additional extension, e.g.
+    `thumbnail/photo.jpg.webp`.
+
+    """
+    if variant:
+        directory, filename = os.path.split(path)
+        path = os.path.join(directory, variant, filename)
+    if fmt:
+        path = f"{path}.{fmt}"
+    return path
+
+
+def is_image(path: str) -> bool:
+    """Return True if Pillow recognizes the file at `path` as an intact image."""
+    try:
+        with PILImage.open(path) as img:
+            img.verify()
+    except (OSError, SyntaxError, ValueError):
+        # Pillow raises SyntaxError for some malformed files
+        return False
+    return True
+
+
+def supported_formats(formats) -> list:
+    """Return the alternative formats Pillow can write, e.g. AVIF needs a plugin."""
+    extensions = PILImage.registered_extensions()
+    return [fmt for fmt in formats if f".{fmt}" in extensions]
+
+
+def _save(img, path: str, fmt: str, quality: int) -> None:
+    params = {"optimize": True}
+    if fmt in ("JPEG", "WEBP", "AVIF"):
+        params["quality"] = quality
+    if fmt == "JPEG":
+        params["progressive"] = True
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+    elif fmt in ("WEBP", "AVIF") and img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+
+    # no exif or icc data is passed, so all metadata is dropped
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    img.save(tmp_path, format=fmt, **params)
+    os.replace(tmp_path, path)
+
+
+def process_image(path: str, sizes: dict, formats=(), quality: int = 85) -> ImageInfo:
+    """Optimize the image at `path` and create its variants.
+
+    The original is recompressed at `quality` without metadata and replaced
+    if that makes it smaller or the original contains metadata. `sizes` maps variant names to the maximum width
+    and height, variants that wouldn't be smaller than the original are
+    skipped. The original and every variant are also written in each of the
+    alternative `formats` that Pillow supports.
+
+    """
+    with PILImage.open(path) as img:
+        fmt = img.format
+        animated = getattr(img, "is_animated", False)
+        metadata = any(key in img.info for key in _METADATA_KEYS)
+        img.load()
+    img = ImageOps.exif_transpose(img)
+    width, height = img.size
+
+    if fmt in _RECOMPRESS_FORMATS and not animated:
+        tmp_path = variant_path(path, fmt="optimized")
+        _save(img, tmp_path, fmt, quality)
+        # the stripped copy is kept even if it's larger, e.g. for images
+        # that were saved at a lower quality
+        if metadata or os.path.getsize(tmp_path) < os.path.getsize(path):
+            os.replace(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+
+    outputs = [(None, img)]
+    for variant, size in sorted(sizes.items(), key=lambda item: item[1]):
+        if max(width, height) <= size:
+            continue
+        resized = img.copy()
+        resized.thumbnail((size, size), PILImage.LANCZOS)
+        dst = variant_path(path, variant)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _save(resized, dst, fmt, quality)
+        outputs.append((variant, resized))
+
+    formats = [] if animated else supported_formats(formats)
+    for variant, output in outputs:
+        for alt in formats:
+            _save(output, variant_path(path, variant, alt), alt.upper(), quality)
+
+    return ImageInfo(
+        width,
+        height,
+        os.path.getsize(path),
+        [variant for variant, _ in outputs[1:]],
+        formats,
+    )
+
+
+def _variant_paths(path: str, variants, formats):
+    for variant in [None] + list(variants):
+        for fmt in [None] + list(formats):
+            if variant or fmt:
+                yield variant_path(path, variant, fmt)
+
+
+def delete_variants(path: str, variants, formats=()) -> None:
+    for variant_file in _variant_paths(path, variants, formats):
+        try:
+            os.remove(variant_file)
+        except OSError:
+            pass
+
+
+def delete_stale_variants(path: str, variants, formats, info: ImageInfo) -> None:
+    """Delete the variants a new `process_image` run didn't write again."""
+    current = set(_variant_paths(path, info.variants, info.formats))
+    for variant_file in _variant_paths(path, variants, formats):
+        if variant_file not in current:
+            try:
+                os.remove(variant_file)
+            except OSError:
+                pass
+
+
+def rename_variants(src: str, dst: str, variants, formats=()) -> None:
+    for src_file, dst_file in zip(
+        _variant_paths(src, variants, formats), _variant_paths(dst, variants, formats)
+    ):
+        try:
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+            os.rename(src_file, dst_file)
+        except OSError:
+            pass
@@ -1,7 +1,131 @@
-from flask import render_template
+import mimetypes
+import os
+from flask import (
+    abort,
+    current_app,
+    make_response,
+    render_template,
+    request,
+    send_file,
+)
+from flask_login import current_user
+from werkzeug.urls import url_quote
 from . import main
+from .. import files, images, login_manager, page_cache, search_index
+from ..imaging import variant_path
+from ..models import File, Image, StaticPage
+
+
+# responses for urls that contain the content version never change
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+SEARCH_RESULTS_PER_PAGE = 20
 
 
 @main.route('/')
 def index():
     return render_template("index.html")
+
+
+@main.route('/page/<name>')
+def static_page(name):
+    # read before the query, a change committed meanwhile bumps the version
+    # and the page rendered from the old row isn't used
+    version = page_cache.version(name)
+    page = page_cache.get(name, version)
+    if page is None:
+        static_page = StaticPage.query.filter_by(name=name).first_or_404()
+        page = page_cache.set(
+            name, version, render_template("static_page.html", page=static_page)
+        )
+
+    response = make_response(page.body)
+    response.set_etag(page.etag)
+    response.last_modified = page.modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@main.route('/search')
+def search():
+    query = request.args.get("q", "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+    # one more result than shown tells if there is a next page
+    results = search_index.search(
+        query,
+        limit=SEARCH_RESULTS_PER_PAGE + 1,
+        offset=(page - 1) * SEARCH_RESULTS_PER_PAGE,
+    )
+    return render_template(
+        "search.html",
+        query=query,
+        results=results[:SEARCH_RESULTS_PER_PAGE],
+        page=page,
+        has_next=len(results) > SEARCH_RESULTS_PER_PAGE,
+    )
+
+
+@main.route('/download/<upload_set>/<int:id>/<path:filename>')
+def download(upload_set, id, filename):
+    """Deliver a file or image after checking the permission.
+
+    Behind nginx the transfer is handed over with X-Accel-Redirect, so the
+    worker is free immediately and nginx serves byte ranges. Without nginx
+    the file is sent by Flask, also with range support.
+
+    """
+    models = {"images": (Image, images), "files": (File, files)}
+    if upload_set not in models:
+        abort(404)
+    model_class, uploads = models[upload_set]
+    item = model_class.query.get_or_404(id)
+
+    protected = current_app.config["PROTECTED_DOWNLOADS"]
+    if protected and not current_user.is_authenticated:
+        return login_manager.unauthorized()
+
+    version = item.version
+    if version is None:
+        abort(404)
+
+    # resized variants and alternative formats of images
+    variant, fmt = request.args.get("variant"), request.args.get("fmt")
+    if (variant or fmt) and (
+        model_class is not Image
+        or (variant and variant not in item.variant_names)
+        or (fmt and fmt not in item.format_names)
+    ):
+        abort(404)
+    name = variant_path(item.storage_name, variant, fmt).replace(os.sep, "/")
+    download_name = os.path.basename(variant_path(item.filename, None, fmt))
+    mimetype = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+
+    if request.headers.get("X-Sendfile-Type") == "X-Accel-Redirect":
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = url_quote(
+            current_app.config["X_ACCEL_REDIRECT_PREFIX"] + f"{upload_set}/{name}"
+        )
+        response.mimetype = mimetype
+        accept_ranges, complete_length = False, None
+    else:
+        path = uploads.path(name)
+        if not os.path.isfile(path):
+            abort(404)
+        response = send_file(path, mimetype=mimetype, add_etags=False)
+        accept_ranges, complete_length = True, os.path.getsize(path)
+
+    response.headers.set("Content-Disposition", "inline", filename=download_name)
+    response.set_etag(version)
+    if request.args.get("v") == version:
+        if protected:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.headers["Cache-Control"] += ", immutable"
+    else:
+        response.cache_control.no_cache = True
+
+    return response.make_conditional(
+        request, accept_ranges=accept_ranges, complete_length=complete_length
+    )
@@ -0,0 +1,160 @@
+"""Request, SQL and upload metrics in the Prometheus text format.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import hmac
+import os
+import time
+from flask import Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # on the execution context, which is dropped if the statement fails
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_start
+    if has_request_context():
+        g.sql_query_count = g.get("sql_query_count", 0) + 1
+        g.sql_query_time = g.get("sql_query_time", 0.0) + elapsed
+
+
+class Metrics:
+    """Record metrics with prometheus_client in multiprocess mode.
+
+    Each worker writes its values into files in METRICS_DIR and the
+    metrics endpoint adds up the files of all workers, so it reports the
+    same numbers whichever worker answers. gunicorn.conf.py empties the
+    directory when gunicorn starts, the backup durations in
+    BACKUP_METRICS_DIR are kept. Without the prometheus_client package or
+    with METRICS_ENABLED off nothing is recorded. With
+    METRICS_TOKEN_REQUIRED the endpoint isn't registered without a
+    METRICS_TOKEN.
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.backup_directory = None
+
+    def init_app(self, app):
+        from . import db
+
+        self.enabled = app.config["METRICS_ENABLED"]
+        if not self.enabled:
+            return
+
+        self.directory = app.config["METRICS_DIR"]
+        self.backup_directory = app.config["BACKUP_METRICS_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+        os.makedirs(self.backup_directory, exist_ok=True)
+        # read when prometheus_client is imported, older versions only
+        # know the lower case name
+        os.environ.setdefault("prometheus_multiproc_dir", self.directory)
+        os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", self.directory)
+        try:
+            from prometheus_client import Counter, Histogram
+        except ImportError:
+            self.enabled = False
+            return
+
+        # not registered globally, the endpoint collects the files instead
+        self.requests = Counter(
+            "http_requests_total", "Requests",
+            ["endpoint", "method", "status"], registry=None,
+        )
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "Time to create the response",
+            ["endpoint", "method"], buckets=LATENCY_BUCKETS, registry=None,
+        )
+        self.response_size = Histogram(
+            "http_response_size_bytes", "Size of the response body",
+            ["endpoint"], buckets=SIZE_BUCKETS, registry=None,
+        )
+        self.query_count = Histogram(
+            "db_queries_per_request", "SQL queries per request",
+            ["endpoint"], buckets=QUERY_COUNT_BUCKETS, registry=None,
+        )
+        self.query_time = Histogram(
+            "db_query_seconds_per_request", "Time spent in SQL queries per request",
+            ["endpoint"], buckets=LATENCY_BUCKETS, registry=None,
+        )
+        self.upload_duration = Histogram(
+            "upload_duration_seconds", "Time from start to end of chunked uploads",
+            ["upload_set"], buckets=DURATION_BUCKETS, registry=None,
+        )
+        self.upload_processing = Histogram(
+            "upload_processing_seconds", "Time to finish an upload, e.g. image variants",
+            ["upload_set"], buckets=LATENCY_BUCKETS, registry=None,
+        )
+        self.upload_size = Histogram(
+            "upload_size_bytes", "Size of uploaded files",
+            ["upload_set"], buckets=SIZE_BUCKETS, registry=None,
+        )
+
+        with app.app_context():
+            engine = db.engine
+        if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        if app.config["METRICS_TOKEN"] or not app.config["METRICS_TOKEN_REQUIRED"]:
+            app.add_url_rule(app.config["METRICS_URL"], "metrics", self.metrics_view)
+        else:
+            app.logger.warning("METRICS_TOKEN isn't set, the metrics endpoint is disabled")
+
+    def _start_request(self):
+        g.request_start = time.perf_counter()
+
+    def _finish_request(self, response):
+        start = g.pop("request_start", None)
+        if start is None:
+            return response
+
+        # endpoints instead of paths keep the number of series bounded
+        endpoint = request.endpoint or "none"
+        self.request_duration.labels(endpoint, request.method).observe(
+            time.perf_counter() - start
+        )
+        self.requests.labels(endpoint, request.method, str(response.status_code)).inc()
+        if response.content_length is not None:
+            self.response_size.labels(endpoint).observe(response.content_length)
+        self.query_count.labels(endpoint).observe(g.get("sql_query_count", 0))
+        self.query_time.labels(endpoint).observe(g.get("sql_query_time", 0.0))
+        return response
+
+    def upload_finished(self, upload_set, size, duration, processing) -> None:
+        """Record a finished chunked upload."""
+        if not self.enabled:
+            return
+        self.upload_duration.labels(upload_set).observe(duration)
+        self.upload_processing.labels(upload_set).observe(processing)
+        self.upload_size.labels(upload_set).observe(size)
+
+    def metrics_view(self):
+        token = current_app.config["METRICS_TOKEN"]
+        if token and not hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {token}"
+        ):
+            abort(401)
+
+        from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+        from prometheus_client.multiprocess import MultiProcessCollector
+
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, path=self.directory)
+        MultiProcessCollector(registry, path=self.backup_directory)
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -9,29 +9,164 @@
 
 """
 import os
-from . import db, login_manager, images, files
+from . import (
+    db,
+    login_manager,
+    images,
+    files,
+    page_cache,
+    password_hasher,
+    permission_cache,
+    row_count_cache,
+    search_index,
+    user_stamps,
+)
+from flask import current_app, session, url_for
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import inspect
 from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session, object_session
+from .imaging import (
+    delete_stale_variants,
+    delete_variants,
+    process_image,
+    rename_variants,
+    variant_path,
+)
 from .orderable import OrderableModelMixin
+from .storage import blob_lock, blob_references, store_blob
 
 
 class FileMixin(db.Model):
-    """Mixin for file handling."""
+    """Mixin for file handling.
+
+    Files are stored under their filename. With CONTENT_ADDRESSED_STORAGE new
+    uploads are stored as blobs named after the hash of their content
+    instead, `filename` is then only the display name. Rows with identical
+    content share one blob, it is removed with the last row referencing it.
+
+    Files are only removed when the transaction ends, see `remove_files`
+    and `discard_files`, so a rollback doesn't lose them.
+
+    """
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(256), unique=True, nullable=False)
+    blob = db.Column(db.String(128), index=True)
     _upload_set = None
+    variant_names = ()
+    format_names = ()
 
     def __repr__(self):
         return self.filename
 
+    @property
+    def storage_name(self):
+        """Name of the file relative to the upload directory."""
+        return self.blob or self.filename
+
     @property
     def url(self):
-        return self._upload_set.url(self.filename)
+        """Url of the file, the download route if downloads are protected."""
+        if current_app.config["PROTECTED_DOWNLOADS"]:
+            return self.download_url
+        return self._upload_set.url(self.storage_name)
 
     @property
     def filepath(self):
-        return self._upload_set.path(self.filename)
+        return self._upload_set.path(self.storage_name)
+
+    @property
+    def version(self):
+        """Token that changes with the content of the file, None if missing."""
+        if self.blob:
+            return os.path.splitext(os.path.basename(self.blob))[0][:16]
+        try:
+            stat = os.stat(self.filepath)
+        except OSError:
+            return None
+        return f"{int(stat.st_mtime):x}-{stat.st_size:x}"
+
+    @property
+    def download_url(self):
+        """Url of the download route, cacheable forever as it has the version."""
+        return self._download_url()
+
+    def _download_url(self, **args):
+        return url_for(
+            "main.download",
+            upload_set=self._upload_set.name,
+            id=self.id,
+            filename=self.filename,
+            v=self.version,
+            **args,
+        )
+
+    def store_content(self, path, digest=None):
+        """Move the uploaded file at `path` into the content addressed store.
+
+        `digest` is the content hash of the file, if it is known already.
+
+        """
+        name, created = store_blob(
+            path, self._upload_set.config.destination, self.filename, digest
+        )
+        self._replace_blob(name, created, path)
+
+    def _replace_blob(self, name, created, path, variants=(), formats=()):
+        """Reference the blob `name` that was stored from the file at `path`.
+
+        If the blob existed already, `path` is kept until the commit in case
+        the blob is deleted meanwhile. The old blob is deleted after the
+        commit if no other row references it.
+
+        """
+        info = db.session.info
+        model = type(self)
+        if created:
+            info.setdefault("blobs_created", []).append((model, name, variants, formats))
+        else:
+            info.setdefault("blob_copies", []).append(
+                (model, name, path, variants, formats)
+            )
+
+        old_blob = self.blob
+        self.blob = name
+        if old_blob and old_blob != name:
+            info.setdefault("files_deleted", []).append(
+                (model, old_blob, self.variant_names, self.format_names)
+            )
+
+    @classmethod
+    def _remove(cls, path, variants=(), formats=()):
+        delete_variants(path, variants, formats)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @classmethod
+    def restore_blob(cls, name, path, variants=(), formats=()):
+        """Move the copy at `path` into place if the blob vanished, else remove it."""
+        dst = cls._upload_set.path(name)
+        with blob_lock(dst):
+            if not os.path.exists(dst):
+                rename_variants(path, dst, variants, formats)
+                os.replace(path, dst)
+                return
+        cls._remove(path, variants, formats)
+
+    @classmethod
+    def delete_unreferenced(cls, name, variants=(), formats=()):
+        """Delete the file `name` and its variants if no row references it."""
+        path = cls._upload_set.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            return
+        with blob_lock(path):
+            with db.engine.connect() as connection:
+                if blob_references(connection, cls.__table__, name):
+                    # other rows have the same content
+                    return
+            cls._remove(path, variants, formats)
 
 
 class Image(FileMixin, db.Model):
@@ -39,16 +174,94 @@ class Image(FileMixin, db.Model):
 
     __tablename__ = "images"
     _upload_set = images
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    size = db.Column(db.Integer)
+    variants = db.Column(db.String(64))
+    formats = db.Column(db.String(32))
 
+    @property
+    def variant_names(self):
+        """Names of the resized variants that exist for this image."""
+        return self.variants.split(",") if self.variants else []
 
-@listens_for(Image, "after_delete")
-def delete_image(mapper, connection, target):
-    if target.filepath:
-        # Delete image
-        try:
-            os.remove(target.filepath)
-        except OSError:
-            pass
+    @property
+    def format_names(self):
+        """Alternative formats that exist for the image and its variants."""
+        return self.formats.split(",") if self.formats else []
+
+    def variant_url(self, variant: str = None, fmt: str = None):
+        """Return the url of a variant or of the original if it is smaller."""
+        variant = variant if variant in self.variant_names else None
+        fmt = fmt if fmt in self.format_names else None
+        if current_app.config["PROTECTED_DOWNLOADS"]:
+            return self._download_url(variant=variant, fmt=fmt)
+        return self._upload_set.url(
+            variant_path(self.storage_name, variant, fmt).replace(os.sep, "/")
+        )
+
+    def srcset(self, fmt: str = None):
+        """Return a srcset attribute value with the original and its variants."""
+        if not self.width:
+            return self.variant_url(fmt=fmt)
+        sizes = current_app.config["IMAGE_VARIANTS"]
+        scale = max(self.width, self.height)
+        candidates = [
+            (self.variant_url(variant, fmt), round(self.width * sizes[variant] / scale))
+            for variant in self.variant_names
+            if variant in sizes
+        ]
+        candidates.append((self.variant_url(fmt=fmt), self.width))
+        return ", ".join(f"{url} {width}w" for url, width in candidates)
+
+    def set_image_info(self, info):
+        """Record the properties returned by `process_image`."""
+        self.width = info.width
+        self.height = info.height
+        self.size = info.size
+        self.variants = ",".join(info.variants)
+        self.formats = ",".join(info.formats)
+
+    def _process(self, path):
+        config = current_app.config
+        return process_image(
+            path,
+            config["IMAGE_VARIANTS"],
+            config["IMAGE_FORMATS"],
+            config["IMAGE_QUALITY"],
+        )
+
+    def clear_image_info(self):
+        """Forget the properties and variants of an image that can't be processed."""
+        self.width = self.height = self.size = None
+        self.variants = self.formats = None
+
+    def update_variants(self):
+        """Optimize the image, create its variants and record its properties.
+
+        The new variants replace the old ones, variants that aren't created
+        any more are deleted afterwards, so the recorded variants exist while
+        the image is processed.
+
+        """
+        info = self._process(self.filepath)
+        delete_stale_variants(self.filepath, self.variant_names, self.format_names, info)
+        self.set_image_info(info)
+
+    def store_content(self, path, digest=None):
+        """Optimize the uploaded image at `path` and move it into the store.
+
+        The image is optimized before hashing, so identical uploads end up
+        with identical blobs and a `digest` of the upload isn't used. The
+        variants are moved along with the blob.
+
+        """
+        info = self._process(path)
+        name, created = store_blob(path, self._upload_set.config.destination, self.filename)
+        if created:
+            rename_variants(path, self._upload_set.path(name), info.variants, info.formats)
+        self._replace_blob(name, created, path, info.variants, info.formats)
+        self.set_image_info(info)
 
 
 class File(FileMixin, db.Model):
@@ -58,14 +271,34 @@ class File(FileMixin, db.Model):
     _upload_set = files
 
 
+@listens_for(Image, "after_delete")
 @listens_for(File, "after_delete")
-def delete_file(mapper, connection, target):
-    if target.filepath:
-        # Delete image
-        try:
-            os.remove(target.filepath)
-        except OSError:
-            pass
+def file_deleted(mapper, connection, target):
+    db_session = object_session(target)
+    if db_session is not None and target.storage_name:
+        db_session.info.setdefault("files_deleted", []).append(
+            (type(target), target.storage_name, target.variant_names, target.format_names)
+        )
+
+
+@listens_for(Session, "after_commit")
+def remove_files(db_session):
+    # only after commit, a rollback keeps the rows that reference the files.
+    # Copies are restored first, another row may have deleted their blob.
+    for model, name, path, variants, formats in db_session.info.pop("blob_copies", ()):
+        model.restore_blob(name, path, variants, formats)
+    for model, name, variants, formats in db_session.info.pop("files_deleted", ()):
+        model.delete_unreferenced(name, variants, formats)
+    db_session.info.pop("blobs_created", None)
+
+
+@listens_for(Session, "after_rollback")
+def discard_files(db_session):
+    for model, name, path, variants, formats in db_session.info.pop("blob_copies", ()):
+        model._remove(path, variants, formats)
+    for model, name, variants, formats in db_session.info.pop("blobs_created", ()):
+        model.delete_unreferenced(name, variants, formats)
+    db_session.info.pop("files_deleted", None)
 
 
 class Permission:
@@ -89,6 +322,35 @@ class Role(db.Model):
         return self.name
 
 
+@listens_for(Role, "after_insert")
+@listens_for(Role, "after_update")
+@listens_for(Role, "after_delete")
+def role_changed(mapper, connection, target):
+    db_session = object_session(target)
+    if db_session is not None:
+        db_session.info["roles_changed"] = True
+
+
+@listens_for(Session, "after_commit")
+def invalidate_caches(db_session):
+    # only after commit, otherwise other workers could reload the old data
+    if db_session.info.pop("roles_changed", False):
+        permission_cache.invalidate()
+    for user_id in db_session.info.pop("users_changed", ()):
+        user_stamps.bump(user_id)
+    for name in db_session.info.pop("pages_changed", ()):
+        page_cache.delete(name)
+    for table in db_session.info.pop("row_counts_changed", ()):
+        row_count_cache.invalidate(table)
+
+
+@listens_for(Session, "after_bulk_delete")
+def rows_bulk_deleted(delete_context):
+    delete_context.session.info.setdefault("row_counts_changed", set()).add(
+        delete_context.primary_table.name
+    )
+
+
 class StaticPage(OrderableModelMixin, db.Model):
 
     __tablename__ = "static_pages"
@@ -100,7 +362,46 @@ class StaticPage(OrderableModelMixin, db.Model):
         return self.name
 
 
-class User(UserMixin, db.Model):
+@listens_for(StaticPage, "after_update")
+@listens_for(StaticPage, "after_delete")
+def static_page_changed(mapper, connection, target):
+    db_session = object_session(target)
+    if db_session is not None:
+        # the old name as well if the page was renamed
+        names = set(inspect(target).attrs.name.history.deleted)
+        names.add(target.name)
+        db_session.info.setdefault("pages_changed", set()).update(names)
+
+
+@listens_for(StaticPage, "after_insert")
+@listens_for(StaticPage, "after_update")
+def index_static_page(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.name.history.has_changes() or state.attrs.text.history.has_changes():
+        search_index.update(connection, target)
+
+
+@listens_for(StaticPage, "after_delete")
+def unindex_static_page(mapper, connection, target):
+    search_index.delete(connection, target)
+
+
+class PermissionMixin:
+    """Permission checks based on the `role_id` of a user."""
+
+    def can(self, permissions: Permission):
+        """Return True if the user has the given permission."""
+        return (
+            self.role_id is not None and
+            (permission_cache.permissions(self.role_id) & permissions) == permissions
+        )
+
+    def is_administrator(self):
+        """Return True if the user is an administrator."""
+        return self.can(Permission.ADMINISTER)
+
+
+class User(PermissionMixin, UserMixin, db.Model):
     """User object."""
 
     __tablename__ = "users"
@@ -123,24 +424,102 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
-    def can(self, permissions: Permission):
-        """Return True if the user has the given permission."""
-        return (
-            self.role is not None and
-            (self.role.permissions & permissions) == permissions
-        )
+    @classmethod
+    def authenticate(cls, username, password):
+        """Return the user if username and password are valid, else None.
 
-    def is_administrator(self):
-        """Return True if the user is an administrator."""
-        return self.can(Permission.ADMINISTER)
+        Unknown usernames take as long as wrong passwords. Password hashes with
+        outdated cost parameters are replaced on a successful login.
+
+        """
+        user = cls.query.filter_by(username=username).first()
+        if user is None or user.password_hash is None:
+            password_hasher.verify(None, password)
+            return None
+
+        if not user.verify_password(password):
+            return None
+
+        if password_hasher.needs_rehash(user.password_hash):
+            user.password = password
+            db.session.commit()
+
+        return user
+
+
+@listens_for(User, "after_update")
+@listens_for(User, "after_delete")
+def user_changed(mapper, connection, target):
+    db_session = object_session(target)
+    if db_session is not None:
+        db_session.info.setdefault("users_changed", set()).add(target.id)
+
+
+class UserSnapshot(PermissionMixin, UserMixin):
+    """Logged in user restored from the session without a database query.
+
+    Only valid as long as the version stamp of the user didn't change, which
+    happens whenever the user is changed or deleted, e.g. a new password or
+    role. Changes of one user don't affect the snapshots of the others.
+
+    """
+
+    SESSION_KEY = "_user_snapshot"
+
+    def __init__(self, id, username, role_id, active):
+        self.id = id
+        self.username = username
+        self.role_id = role_id
+        self.active = active
+
+    def __repr__(self):
+        return "<UserSnapshot %r>" % self.username
+
+    def __str__(self):
+        return self.username
+
+    @property
+    def is_active(self):
+        return self.active
+
+    @classmethod
+    def store(cls, user: User) -> None:
+        """Save a snapshot of the user in the session."""
+        session[cls.SESSION_KEY] = {
+            "id": user.id,
+            "username": user.username,
+            "role_id": user.role_id,
+            "active": user.is_active,
+            "version": user_stamps.read(user.id) or user_stamps.bump(user.id),
+        }
+
+    @classmethod
+    def restore(cls, user_id):
+        """Return the snapshot from the session if it is still valid."""
+        data = session.get(cls.SESSION_KEY)
+        if data is None or str(data["id"]) != str(user_id):
+            return None
+        # without a stamp file the version is unknown, e.g. after it was lost
+        version = user_stamps.read(data["id"])
+        if version is None or data["version"] != version:
+            return None
+        return cls(data["id"], data["username"], data["role_id"], data["active"])
 
 
 @login_manager.user_loader
 def load_user(user_id):
     """User loader."""
-    return User.query.get(user_id)
+    if not current_app.config["USER_SNAPSHOT"]:
+        return User.query.get(user_id)
+
+    user = UserSnapshot.restore(user_id)
+    if user is None:
+        user = User.query.get(user_id)
+        if user is not None:
+            UserSnapshot.store(user)
+    return user
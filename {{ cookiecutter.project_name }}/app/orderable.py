@@ -10,94 +10,254 @@
 from . import db
 from flask import redirect, url_for
 from flask_admin.actions import action
+from sqlalchemy import and_, bindparam, func, or_, select
+from sqlalchemy.event import listens_for
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
-def default_order_index(context) -> int:
-    """Return default order value.
 
-    This is the max value or order plus one.
-    """
-    if context:
-        current_table_name = context.current_column.table.name
-        query = db.engine.execute(f"SELECT MAX(\"order_index\") + 1 FROM {current_table_name}")
-        order_index = query.first()[0]
-        if order_index is None:
-            return 0
-        else:
-            return order_index
+# distance between the order_index values of two neighbouring rows, leaves
+# room for inserting rows between neighbours without touching the others
+ORDER_GAP = 1024
+
+# sort key for rows that have no order_index yet, puts them at the end
+_NULL_ORDER = 2 ** 62
+
+
+class OrderCounter(db.Model):
+    """Last order_index handed out for each orderable table."""
+
+    __tablename__ = "order_counters"
+    table_name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
+
+
+def _insert_if_missing(connection, table, **values) -> None:
+    """Insert a row unless a row with the same primary key exists."""
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        statement = insert(table).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        statement = table.insert().prefix_with("OR IGNORE")
+    elif dialect == "mysql":
+        statement = table.insert().prefix_with("IGNORE")
     else:
-        return 0
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(**values))
+        except IntegrityError:
+            pass
+        return
+    connection.execute(statement.values(**values))
+
+
+def reserve_order_indexes(connection, table, count: int = 1) -> range:
+    """Reserve `count` consecutive order_index values for `table`.
+
+    The counter row is incremented before it is read so concurrent
+    transactions serialize on the row lock and never get the same values.
+    Use this directly for bulk inserts that bypass the session.
+
+    """
+    counters = OrderCounter.__table__
+    step = count * ORDER_GAP
+    increment = (
+        counters.update()
+        .where(counters.c.table_name == table.name)
+        .values(value=counters.c.value + step)
+    )
+    if connection.execute(increment).rowcount == 0:
+        # first insert since the counter exists, start after the existing
+        # rows. Another transaction may insert the row at the same time,
+        # the row that is inserted first wins and both increment it.
+        start = connection.execute(select([func.max(table.c.order_index)])).scalar()
+        if start is None:
+            start = -ORDER_GAP
+        _insert_if_missing(connection, counters, table_name=table.name, value=start)
+        connection.execute(increment)
+    value = connection.execute(
+        select([counters.c.value]).where(counters.c.table_name == table.name)
+    ).scalar()
+    return range(value - step + ORDER_GAP, value + ORDER_GAP, ORDER_GAP)
+
+
+@listens_for(Session, "before_flush")
+def assign_order_index(session, flush_context, instances):
+    """Hand out order_index numbers for all new orderable rows of a flush."""
+    pending = {}
+    for obj in session.new:
+        if isinstance(obj, OrderableModelMixin) and obj.order_index is None:
+            pending.setdefault(type(obj).__table__, []).append(obj)
+
+    for table, objs in pending.items():
+        indexes = reserve_order_indexes(session.connection(), table, len(objs))
+        for obj, order_index in zip(objs, indexes):
+            obj.order_index = order_index
 
 
 class OrderableModelMixin:
-    """Mixin for orderable database objects."""
+    """Mixin for orderable database objects.
 
-    order_index = db.Column(db.Integer, index=True, default=default_order_index)
+    Rows are sorted by `order_index` and `id`. Neighbouring rows are spaced
+    `ORDER_GAP` apart so moving a row only touches the row itself and its
+    neighbour. The whole table is only renumbered if two rows share the same
+    `order_index` or a row has none. New rows get their order_index from a
+    per table counter row when the session is flushed.
 
-    def _get_model_class(self):
-        for c in db.Model._decl_class_registry.values():
-            if (
-                hasattr(c, "__tablename__")
-                and c.__tablename__ == self.__tablename__
-            ):
-                return c
+    """
 
-    def move_up(self) -> None:
-        """Move item up."""
-        self._model = self._get_model_class()
-        items = self._model.query.order_by(self._model.order_index).all()
-        id_ = items.index(self)
+    order_index = db.Column(db.Integer, index=True)
 
-        # if first item then do nothing
-        if id_ == 0:
-            return
+    @classmethod
+    def _order_key(cls):
+        return func.coalesce(cls.order_index, _NULL_ORDER)
 
-        # get the item before which we swap position with
-        item_before = items[id_ - 1]
+    def _neighbour(self, before: bool):
+        """Return the row directly before or after this one."""
+        model = type(self)
+        key = model._order_key()
+        own_key = func.coalesce(self.order_index, _NULL_ORDER)
+        if before:
+            criterion = or_(key < own_key, and_(key == own_key, model.id < self.id))
+            ordering = (key.desc(), model.id.desc())
+        else:
+            criterion = or_(key > own_key, and_(key == own_key, model.id > self.id))
+            ordering = (key, model.id)
+        return model.query.filter(criterion).order_by(*ordering).first()
 
-        # swap order_index numbers with the item before
-        x = self.order_index
-        self.order_index = item_before.order_index
-        item_before.order_index = x
+    def _swap(self, before: bool) -> None:
+        other = self._neighbour(before)
 
+        # if first or last item then do nothing
+        if other is None:
+            return
+
+        # equal or missing order_index numbers can't be swapped, spread them
+        if other.order_index is None or other.order_index == self.order_index:
+            type(self).renumber_order_index(commit=False)
+            db.session.refresh(self)
+            db.session.refresh(other)
+
+        # swap order_index numbers with the neighbour
+        self.order_index, other.order_index = other.order_index, self.order_index
         db.session.add(self)
-        db.session.add(item_before)
+        db.session.add(other)
         db.session.commit()
 
-        # normalize order_index numbers for all items
-        for i, item in enumerate(
-            self._model.query.order_by(self._model.order_index)
-        ):
-            item.order_index = i
-        db.session.commit()
+    def move_up(self) -> None:
+        """Move item up."""
+        self._swap(before=True)
 
     def move_down(self) -> None:
         """Move item down."""
-        self._model = self._get_model_class()
-        items = self._model.query.order_by(self._model.order_index).all()
-        id_ = items.index(self)
+        self._swap(before=False)
 
-        # if first item then do nothing
-        if id_ == len(items) - 1:
-            return
-
-        # get the item before which we swap position with
-        item_after = items[id_ + 1]
+    @classmethod
+    def _ordered_rows(cls):
+        """Return (id, order_index) of all rows in their current order."""
+        db.session.flush()
+        return (
+            db.session.query(cls.id, cls.order_index)
+            .order_by(cls._order_key(), cls.id)
+            .all()
+        )
 
-        # swap order_index numbers with the item before
-        x = self.order_index
-        self.order_index = item_after.order_index
-        item_after.order_index = x
+    @classmethod
+    def _write_order(cls, rows, new_order, spread: bool = False) -> None:
+        """Store `new_order`, a permutation of the ids in `rows`.
 
-        db.session.add(self)
-        db.session.add(item_after)
-        db.session.commit()
+        The existing order_index values are handed out again in the new order
+        so only rows that changed position get updated. If the values are not
+        strictly increasing or `spread` is set all rows are numbered
+        `ORDER_GAP` apart. The changes are written with a single executemany
+        statement.
 
-        # normalize order_index numbers for all items
-        for i, item in enumerate(
-            self._model.query.order_by(self._model.order_index)
+        """
+        values = [order_index for _, order_index in rows]
+        if spread or None in values or any(
+            a >= b for a, b in zip(values, values[1:])
         ):
-            item.order_index = i
-        db.session.commit()
+            values = [i * ORDER_GAP for i in range(len(rows))]
+
+        params = [
+            {"_id": id_, "_order_index": value}
+            for (old_id, old_value), id_, value in zip(rows, new_order, values)
+            if id_ != old_id or value != old_value
+        ]
+        if params:
+            table = cls.__table__
+            db.session.execute(
+                table.update()
+                .where(table.c.id == bindparam("_id"))
+                .values(order_index=bindparam("_order_index")),
+                params,
+            )
+
+    @classmethod
+    def renumber_order_index(cls, commit: bool = True) -> None:
+        """Spread the order_index numbers of all rows by `ORDER_GAP`."""
+        rows = cls._ordered_rows()
+        cls._write_order(rows, [id_ for id_, _ in rows], spread=True)
+        if commit:
+            db.session.commit()
+
+    @classmethod
+    def move_rows(cls, ids, offset: int, commit: bool = True) -> None:
+        """Move the rows with the given ids by `offset` positions.
+
+        Negative offsets move the rows up, positive ones down. The selected
+        rows keep their relative order and stop at the top or bottom just as
+        if they were moved one by one.
+
+        """
+        rows = cls._ordered_rows()
+        order = [id_ for id_, _ in rows]
+        selected = {int(id_) for id_ in ids}
+
+        if offset > 0:
+            order.reverse()
+
+        positions = [i for i, id_ in enumerate(order) if id_ in selected]
+        targets = []
+        last = -1
+        for pos in positions:
+            last = max(pos - abs(offset), last + 1)
+            targets.append(last)
+
+        moved = dict(zip(targets, (order[pos] for pos in positions)))
+        rest = iter([id_ for id_ in order if id_ not in selected])
+        new_order = [
+            moved[i] if i in moved else next(rest) for i in range(len(order))
+        ]
+
+        if offset > 0:
+            new_order.reverse()
+
+        cls._write_order(rows, new_order)
+        if commit:
+            db.session.commit()
+
+    @classmethod
+    def move_rows_to(cls, ids, position: int = None, commit: bool = True) -> None:
+        """Move the rows with the given ids as a block to `position`.
+
+        `position` is counted among the rows that are not moved, 0 puts the
+        block at the top, None puts it at the bottom.
+
+        """
+        rows = cls._ordered_rows()
+        selected = {int(id_) for id_ in ids}
+        block = [id_ for id_, _ in rows if id_ in selected]
+        rest = [id_ for id_, _ in rows if id_ not in selected]
+        if position is None:
+            position = len(rest)
+        position = max(0, min(position, len(rest)))
+
+        cls._write_order(rows, rest[:position] + block + rest[position:])
+        if commit:
+            db.session.commit()
 
 
 class OrderableModelViewMixin:
@@ -110,11 +270,7 @@ class OrderableModelViewMixin:
         "Sollen die ausgewählten Elemente nach oben verschoben werden?",
     )
     def action_move_up(self, ids):
-        selected = self.model.query.filter(self.model.id.in_(ids)).order_by(
-            self.model.order_index
-        )
-        for item in selected:
-            item.move_up()
+        self.model.move_rows(ids, -1)
         return redirect(url_for(".index_view"))
 
     @action(
@@ -123,9 +279,23 @@ class OrderableModelViewMixin:
         "Sollen die ausgewählten Elemente nach unten verschoben werden?",
     )
     def action_move_down(self, ids):
-        selected = self.model.query.filter(self.model.id.in_(ids)).order_by(
-            self.model.order_index.desc()
-        )
-        for item in selected:
-            item.move_down()
+        self.model.move_rows(ids, 1)
+        return redirect(url_for(".index_view"))
+
+    @action(
+        "move_top",
+        "Ganz nach oben bewegen",
+        "Sollen die ausgewählten Elemente ganz nach oben verschoben werden?",
+    )
+    def action_move_top(self, ids):
+        self.model.move_rows_to(ids, 0)
+        return redirect(url_for(".index_view"))
+
+    @action(
+        "move_bottom",
+        "Ganz nach unten bewegen",
+        "Sollen die ausgewählten Elemente ganz nach unten verschoben werden?",
+    )
+    def action_move_bottom(self, ids):
+        self.model.move_rows_to(ids)
         return redirect(url_for(".index_view"))
@@ -0,0 +1,108 @@
+"""Rendered page cache shared by all worker processes.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import hashlib
+import os
+import shutil
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from .permissions import StampDirectory
+
+
+CachedPage = namedtuple("CachedPage", ["body", "etag", "modified"])
+
+
+def assets_version(manifest) -> str:
+    """Return a hash of the webassets manifest file, "" without one."""
+    if not isinstance(manifest, str) or not manifest.startswith("json:"):
+        return ""
+    try:
+        with open(manifest[len("json:"):], "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+class PageCache:
+    """Store rendered pages as files in `PAGE_CACHE_DIR`.
+
+    All workers of a host share the directory, so a page is rendered once
+    after it changed. Files are replaced atomically, readers never see a
+    partly written page. Pages link the fingerprinted asset bundles, so the
+    keys include the version of the assets manifest and pages cached before
+    "flask build-assets" aren't used with the new bundles.
+
+    Every key has a `VersionStamp` in `PAGE_CACHE_STAMP_DIR` that is part of
+    the file name. Callers read the version before they load the data of a
+    page and store the page with it. `delete` bumps the version, so a page
+    rendered from data loaded before the change is stored under the old
+    version and never read.
+
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.assets_version = ""
+        self.stamps = StampDirectory("PAGE_CACHE_STAMP_DIR")
+
+    def init_app(self, app):
+        self.directory = app.config["PAGE_CACHE_DIR"]
+        self.assets_version = assets_version(app.config.get("ASSETS_MANIFEST"))
+        self.stamps.init_app(app)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _stamp_key(self, key: str) -> str:
+        # keys are page names from urls
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str, version: str) -> str:
+        digest = hashlib.sha1(
+            f"{self.assets_version}:{version}:{key}".encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.directory, digest + ".html")
+
+    def version(self, key: str) -> str:
+        """Return the current version of `key`, read before loading the data."""
+        return self.stamps.read(self._stamp_key(key)) or ""
+
+    def get(self, key: str, version: str):
+        """Return the page cached with `version` or None."""
+        path = self._path(key, version)
+        try:
+            with open(path, "rb") as f:
+                etag = f.readline().strip().decode("ascii")
+                body = f.read()
+            modified = os.stat(path).st_mtime
+        except OSError:
+            return None
+        return CachedPage(body, etag, datetime.utcfromtimestamp(int(modified)))
+
+    def set(self, key: str, version: str, body: str) -> CachedPage:
+        """Store a page rendered after reading `version` and return it."""
+        data = body.encode("utf-8")
+        etag = hashlib.sha1(data).hexdigest()
+        path = self._path(key, version)
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "wb") as f:
+            f.write(etag.encode("ascii") + b"\n")
+            f.write(data)
+        os.replace(tmp_path, path)
+        modified = os.stat(path).st_mtime
+        return CachedPage(data, etag, datetime.utcfromtimestamp(int(modified)))
+
+    def delete(self, key: str) -> None:
+        """Invalidate the page, call it after the change is committed."""
+        path = self._path(key, self.version(key))
+        self.stamps.bump(self._stamp_key(key))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
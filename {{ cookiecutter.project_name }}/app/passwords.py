@@ -0,0 +1,117 @@
+"""Password hashing with bounded concurrency.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import fcntl
+import os
+import random
+import time
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS,
+    check_password_hash,
+    generate_password_hash,
+)
+
+
+class HashingBusy(ServiceUnavailable):
+    """No hash slot became free in time, the client should retry later."""
+
+    description = "Zu viele gleichzeitige Anmeldungen, bitte gleich noch einmal versuchen."
+
+    def get_headers(self, environ=None):
+        return super().get_headers(environ) + [("Retry-After", "1")]
+
+
+def normalize_method(method: str) -> str:
+    """Return the method as werkzeug writes it into the hash.
+
+    werkzeug adds the default number of iterations to PBKDF2 methods
+    without one, e.g. "pbkdf2:sha256" becomes "pbkdf2:sha256:150000".
+
+    """
+    if not method.startswith("pbkdf2:"):
+        return method
+    hash_name, _, iterations = method[len("pbkdf2:"):].partition(":")
+    return f"pbkdf2:{hash_name}:{int(iterations or 0) or DEFAULT_PBKDF2_ITERATIONS}"
+
+
+class PasswordHasher:
+    """Hash and verify passwords, a limited number at a time.
+
+    At most `PASSWORD_HASH_CONCURRENCY` hashes are computed at the same time
+    on the host, across all worker processes and their threads. Each
+    computation holds an exclusive flock on one of as many slot files in
+    `PASSWORD_HASH_SLOT_DIR`. A request that doesn't get a slot within
+    `PASSWORD_HASH_TIMEOUT` seconds fails with 503, so a burst of login
+    attempts can't occupy all workers with hashing. The hash method
+    including the number of iterations is set with `PASSWORD_HASH_METHOD`.
+
+    """
+
+    def __init__(self):
+        self.method = "pbkdf2:sha256"
+        self.concurrency = 2
+        self.timeout = 5.0
+        self.slot_dir = None
+        self._dummy_hash = None
+
+    def init_app(self, app):
+        self.method = app.config["PASSWORD_HASH_METHOD"]
+        self.concurrency = app.config["PASSWORD_HASH_CONCURRENCY"]
+        self.timeout = app.config["PASSWORD_HASH_TIMEOUT"]
+        self.slot_dir = app.config["PASSWORD_HASH_SLOT_DIR"]
+        os.makedirs(self.slot_dir, exist_ok=True)
+        # computed on start, not by the first login of an unknown user
+        self._dummy_hash = generate_password_hash(os.urandom(16).hex(), self.method)
+
+    def _acquire(self):
+        """Return the file descriptor of a locked slot file."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            # different start slots, so waiting requests don't all try the
+            # same slot first
+            first = random.randrange(self.concurrency)
+            for i in range(self.concurrency):
+                path = os.path.join(self.slot_dir, f"{(first + i) % self.concurrency}.lock")
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            if time.monotonic() >= deadline:
+                raise HashingBusy()
+            time.sleep(0.01)
+
+    def _run(self, fn, *args):
+        # closing the descriptor releases the lock, also if the process dies
+        fd = self._acquire()
+        try:
+            return fn(*args)
+        finally:
+            os.close(fd)
+
+    def hash(self, password: str) -> str:
+        """Return a salted hash of the password."""
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password: str) -> bool:
+        """Check the password against the hash.
+
+        If there is no hash, e.g. because the user doesn't exist, the password
+        is checked against a dummy hash so the answer takes as long as for a
+        wrong password.
+
+        """
+        if pwhash is None:
+            self._run(check_password_hash, self._dummy_hash, password)
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """Return True if the hash was created with other cost parameters."""
+        stored = pwhash.split("$", 1)[0]
+        return normalize_method(stored) != normalize_method(self.method)
@@ -0,0 +1,128 @@
+"""Process wide cache for role permissions.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import os
+import threading
+import uuid
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class VersionStamp:
+    """Token in a small file shared by all worker processes.
+
+    Writing a new token tells every worker that its cached data is outdated.
+    Reading the token is a local file read and doesn't touch the database.
+
+    """
+
+    def __init__(self, config_key: str):
+        self.config_key = config_key
+        self.path = None
+
+    def init_app(self, app):
+        self.path = app.config[self.config_key]
+        if not os.path.isfile(self.path):
+            self.bump()
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except (OSError, TypeError):
+            return None
+
+    def bump(self):
+        """Write a new token and return it."""
+        if self.path is None:
+            return None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        token = uuid.uuid4().hex
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "w") as f:
+            f.write(token)
+        os.replace(tmp_path, self.path)
+        return token
+
+
+class StampDirectory:
+    """One `VersionStamp` per key, e.g. per user, in a shared directory."""
+
+    def __init__(self, config_key: str):
+        self.config_key = config_key
+        self.directory = None
+
+    def init_app(self, app):
+        self.directory = app.config[self.config_key]
+        os.makedirs(self.directory, exist_ok=True)
+
+    def stamp(self, key) -> VersionStamp:
+        stamp = VersionStamp(self.config_key)
+        if self.directory is not None:
+            stamp.path = os.path.join(self.directory, f"{key}.stamp")
+        return stamp
+
+    def read(self, key):
+        """Return the token of `key` or None if it has none yet."""
+        return self.stamp(key).read()
+
+    def bump(self, key):
+        """Write a new token for `key` and return it."""
+        return self.stamp(key).bump()
+
+
+class PermissionCache:
+    """Cache the permissions of all roles in each worker process.
+
+    The roles table is small and rarely changes, so it is loaded once and
+    permission checks don't touch the database. Changes to a role bump a
+    `VersionStamp`. Each lookup compares its token with the one seen at load
+    time and reloads the roles if it differs.
+
+    """
+
+    def __init__(self):
+        self.stamp = VersionStamp("PERMISSION_CACHE_STAMP")
+        self._permissions = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.stamp.init_app(app)
+
+        # preload, tables may not exist yet on a fresh installation
+        with app.app_context():
+            try:
+                self.load()
+            except SQLAlchemyError:
+                self._permissions = None
+
+    def load(self) -> dict:
+        """Load the permissions of all roles from the database."""
+        from . import db
+        from .models import Role
+
+        with self._lock:
+            token = self.stamp.read()
+            permissions = {
+                id_: permissions or 0
+                for id_, permissions in db.session.query(Role.id, Role.permissions)
+            }
+            self._permissions = permissions
+            self._token = token
+        return permissions
+
+    def invalidate(self) -> None:
+        """Make all workers reload the roles on their next lookup."""
+        self._permissions = None
+        self.stamp.bump()
+
+    def permissions(self, role_id) -> int:
+        """Return the permission bits of the given role."""
+        # another thread may invalidate the cache at any time
+        permissions = self._permissions
+        if permissions is None or self.stamp.read() != self._token:
+            permissions = self.load()
+        return permissions.get(role_id, 0)
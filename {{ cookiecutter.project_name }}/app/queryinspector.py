@@ -0,0 +1,146 @@
+"""Detect N+1 queries, slow queries and requests over their query budget.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import re
+import time
+from collections import Counter
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAM_RE = re.compile(r"%\(\w+\)s|%s|\?")
+_PARAM_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def statement_shape(statement: str) -> str:
+    """Return the statement with literals and parameters replaced by "?".
+
+    Statements that only differ in their values, e.g. the lazy loads of the
+    same relationship for different rows, have the same shape.
+
+    """
+    shape = _LITERAL_RE.sub("?", statement)
+    shape = _PARAM_RE.sub("?", shape)
+    shape = _PARAM_LIST_RE.sub("(?)", shape)
+    return " ".join(shape.split())
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # on the execution context, which is dropped if the statement fails
+    context._inspector_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._inspector_start
+    if not has_request_context():
+        return
+
+    g.setdefault("inspected_queries", []).append((statement, elapsed))
+    threshold = current_app.config["SLOW_QUERY_THRESHOLD"]
+    if threshold is not None and elapsed >= threshold:
+        current_app.logger.warning(
+            "%s: slow query (%.3f s): %s\n%s",
+            request.endpoint or request.path,
+            elapsed,
+            " ".join(statement.split()),
+            "\n".join(_explain(conn, statement, parameters, executemany)),
+        )
+
+
+def _explain(conn, statement, parameters, executemany):
+    """Return the query plan of a SELECT statement as lines."""
+    if executemany or not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+        return []
+    sqlite = conn.dialect.name == "sqlite"
+    # separate cursor, the result of the statement may not be fetched yet
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(("EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN ") + statement, parameters)
+        rows = cursor.fetchall()
+    except conn.dialect.dbapi.Error as e:
+        return [f"  no query plan: {e}"]
+    finally:
+        cursor.close()
+    # SQLite returns id, parent, notused, detail
+    return ["  " + (str(row[-1]) if sqlite else " ".join(map(str, row))) for row in rows]
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request issued more queries than its budget, raised in tests."""
+
+    def __init__(self, endpoint, count, budget):
+        super().__init__(f"{endpoint} issued {count} queries, the budget is {budget}")
+        self.endpoint = endpoint
+        self.count = count
+        self.budget = budget
+
+
+class QueryInspector:
+    """Count and inspect the SQL queries of every request.
+
+    Meant for development and tests, enabled with QUERY_INSPECTOR. Logs a
+    warning for
+
+    * statements with the same shape repeated at least N_PLUS_ONE_THRESHOLD
+      times in one request, usually lazy loads in a loop
+    * queries slower than SLOW_QUERY_THRESHOLD seconds with their query plan
+    * requests with more queries than the budget of their endpoint in
+      QUERY_BUDGETS, QUERY_BUDGET for all others
+
+    With app.testing set, exceeding the budget raises `QueryBudgetExceeded`
+    and fails the test.
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        from . import db
+
+        self.enabled = app.config["QUERY_INSPECTOR"]
+        if not self.enabled:
+            return
+
+        with app.app_context():
+            engine = db.engine
+        if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+        app.after_request(self._check_request)
+
+    @staticmethod
+    def queries() -> list:
+        """Return the statements and durations of the current request."""
+        return g.get("inspected_queries", [])
+
+    def _check_request(self, response):
+        queries = self.queries()
+        if not queries:
+            return response
+
+        config = current_app.config
+        endpoint = request.endpoint or request.path
+        logger = current_app.logger
+
+        shapes = Counter(statement_shape(statement) for statement, _ in queries)
+        for shape, count in shapes.most_common():
+            if count < config["N_PLUS_ONE_THRESHOLD"]:
+                break
+            logger.warning(
+                "%s: same statement %d times, possible N+1 query: %s", endpoint, count, shape
+            )
+
+        budget = config["QUERY_BUDGETS"].get(endpoint, config["QUERY_BUDGET"])
+        if budget is not None and len(queries) > budget:
+            if current_app.testing:
+                raise QueryBudgetExceeded(endpoint, len(queries), budget)
+            logger.warning(
+                "%s: %d queries, the budget is %d", endpoint, len(queries), budget
+            )
+        return response
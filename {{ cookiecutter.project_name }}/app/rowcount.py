@@ -0,0 +1,82 @@
+"""Process wide cache for the row counts of the admin list views.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import os
+import threading
+import time
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import object_session
+from .permissions import VersionStamp
+
+
+class RowCountCache:
+    """Cache the number of rows of watched tables in each worker process.
+
+    Counting all rows of a large table is a full scan in SQLite. The count is
+    kept until a row is inserted into or deleted from the table, which bumps
+    a `VersionStamp` per table in `ROW_COUNT_STAMP_DIR`. Counts are reloaded
+    after `ROW_COUNT_MAX_AGE` seconds anyway, so changes that bypass the ORM
+    are picked up eventually.
+
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.max_age = 0
+        self._stamps = {}
+        self._counts = {}
+        self._watched = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.directory = app.config["ROW_COUNT_STAMP_DIR"]
+        self.max_age = app.config["ROW_COUNT_MAX_AGE"]
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _stamp(self, table: str) -> VersionStamp:
+        stamp = self._stamps.get(table)
+        if stamp is None:
+            stamp = VersionStamp("ROW_COUNT_STAMP_DIR")
+            if self.directory is not None:
+                stamp.path = os.path.join(self.directory, table + ".stamp")
+            self._stamps[table] = stamp
+        return stamp
+
+    def watch(self, model) -> None:
+        """Invalidate the count of the table of `model` on insert and delete."""
+        with self._lock:
+            if model in self._watched:
+                return
+            self._watched.add(model)
+
+        @listens_for(model, "after_insert")
+        @listens_for(model, "after_delete")
+        def row_count_changed(mapper, connection, target):
+            db_session = object_session(target)
+            if db_session is not None:
+                db_session.info.setdefault("row_counts_changed", set()).add(
+                    mapper.local_table.name
+                )
+
+    def count(self, table: str, count_query) -> int:
+        """Return the cached count of `table` or run `count_query`."""
+        token = self._stamp(table).read()
+        cached = self._counts.get(table)
+        if (
+            cached is not None
+            and cached[1] == token
+            and time.monotonic() - cached[2] < self.max_age
+        ):
+            return cached[0]
+
+        count = count_query.scalar()
+        self._counts[table] = (count, token, time.monotonic())
+        return count
+
+    def invalidate(self, table: str) -> None:
+        """Make all workers count the rows of `table` again."""
+        self._counts.pop(table, None)
+        self._stamp(table).bump()
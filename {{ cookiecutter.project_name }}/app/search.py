@@ -0,0 +1,229 @@
+"""Full text search over the static pages.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import re
+from collections import namedtuple
+from jinja2 import Markup, escape
+from sqlalchemy import or_, text
+from sqlalchemy.exc import OperationalError
+
+
+SearchResult = namedtuple("SearchResult", ["id", "name", "title", "snippet"])
+
+# highlight delimiters, replaced by <mark> after the text is escaped
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def search_terms(query: str) -> list:
+    """Split a user query into words, operators of the query are ignored."""
+    return _TERM_RE.findall(query or "")
+
+
+def plain_text(html: str) -> str:
+    """Return the text of a page without markup."""
+    return Markup(html or "").striptags()
+
+
+def _highlight(value: str) -> Markup:
+    return Markup(
+        str(escape(value))
+        .replace(_MARK_START, "<mark>")
+        .replace(_MARK_END, "</mark>")
+    )
+
+
+class SearchIndex:
+    """SQLite FTS5 index over the name and text of the static pages.
+
+    The index is a separate virtual table with the id of the page as rowid.
+    It holds the plain text of the pages and is kept in sync by mapper
+    listeners in the transaction that changes the page. On other databases
+    or without FTS5 the search falls back to LIKE queries.
+
+    """
+
+    TABLE = "static_pages_fts"
+    SNIPPET_TOKENS = 24
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        from . import db
+
+        with app.app_context():
+            engine = db.engine
+            if engine.dialect.name != "sqlite":
+                self.enabled = False
+                return
+            with engine.connect() as connection:
+                self.enabled = bool(connection.scalar(
+                    text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+                ))
+
+    def create(self, connection) -> None:
+        """Create the index table and fill it if it was missing."""
+        if not self.enabled:
+            return
+        exists = connection.scalar(
+            text("SELECT count(*) FROM sqlite_master WHERE name = :name"),
+            name=self.TABLE,
+        )
+        if exists:
+            return
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE {self.TABLE} USING fts5("
+            "name, text, tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+        self.rebuild(connection)
+
+    def rebuild(self, connection) -> int:
+        """Index all pages again and return their number."""
+        from .models import StaticPage
+
+        if not self.enabled:
+            return 0
+        connection.execute(text(f"DELETE FROM {self.TABLE}"))
+        table = StaticPage.__table__
+        rows = [
+            {"id": id_, "name": name, "text": plain_text(html)}
+            for id_, name, html in connection.execute(
+                table.select().with_only_columns([table.c.id, table.c.name, table.c.text])
+            )
+        ]
+        if rows:
+            connection.execute(
+                text(f"INSERT INTO {self.TABLE} (rowid, name, text) VALUES (:id, :name, :text)"),
+                rows,
+            )
+        return len(rows)
+
+    def update(self, connection, page) -> None:
+        """Index the current version of a page."""
+        if not self.enabled:
+            return
+        self.delete(connection, page)
+        connection.execute(
+            text(f"INSERT INTO {self.TABLE} (rowid, name, text) VALUES (:id, :name, :text)"),
+            id=page.id, name=page.name, text=plain_text(page.text),
+        )
+
+    def delete(self, connection, page) -> None:
+        """Remove a page from the index."""
+        if not self.enabled:
+            return
+        connection.execute(text(f"DELETE FROM {self.TABLE} WHERE rowid = :id"), id=page.id)
+
+    def _match(self, query: str):
+        # quote every word, all words must occur, the last one as prefix
+        terms = ['"{}"'.format(term) for term in search_terms(query)]
+        if not terms:
+            return None
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def match_ids(self, query: str):
+        """Return a select of the ids of all matching pages or None.
+
+        None means the index can't be used and the caller has to fall back
+        to a LIKE query.
+
+        """
+        match = self._match(query)
+        if not self.enabled or match is None:
+            return None
+        return text(
+            f"SELECT rowid FROM {self.TABLE} WHERE {self.TABLE} MATCH :match"
+        ).bindparams(match=match)
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> list:
+        """Return the matching pages as `SearchResult`, best matches first."""
+        if not search_terms(query):
+            return []
+        if self.enabled:
+            try:
+                return self._search_index(query, limit, offset)
+            except OperationalError:
+                # index table is missing, e.g. before "flask init-db"
+                pass
+        return self._search_like(query, limit, offset)
+
+    def _search_index(self, query, limit, offset):
+        from . import db
+
+        # matches in the name weigh ten times as much as in the text
+        rows = db.session.execute(
+            text(
+                f"SELECT rowid, name, "
+                f"highlight({self.TABLE}, 0, :start, :end), "
+                f"snippet({self.TABLE}, 1, :start, :end, '…', :tokens) "
+                f"FROM {self.TABLE} WHERE {self.TABLE} MATCH :match "
+                f"ORDER BY bm25({self.TABLE}, 10.0, 1.0) "
+                f"LIMIT :limit OFFSET :offset"
+            ),
+            {
+                "start": _MARK_START,
+                "end": _MARK_END,
+                "tokens": self.SNIPPET_TOKENS,
+                "match": self._match(query),
+                "limit": limit,
+                "offset": offset,
+            },
+        )
+        return [
+            SearchResult(id_, name, _highlight(title), _highlight(snippet))
+            for id_, name, title, snippet in rows
+        ]
+
+    def _search_like(self, query, limit, offset):
+        from .models import StaticPage
+
+        terms = search_terms(query)
+        conditions = [
+            or_(StaticPage.name.ilike(f"%{term}%"), StaticPage.text.ilike(f"%{term}%"))
+            for term in terms
+        ]
+        name_match = or_(*[StaticPage.name.ilike(f"%{term}%") for term in terms])
+        pages = (
+            StaticPage.query.filter(*conditions)
+            .order_by(name_match.desc(), StaticPage.id)
+            .limit(limit)
+            .offset(offset)
+            .all()
+        )
+        return [
+            SearchResult(
+                page.id,
+                page.name,
+                _highlight(self._mark(page.name, terms)),
+                _highlight(self._mark(self._excerpt(plain_text(page.text), terms), terms)),
+            )
+            for page in pages
+        ]
+
+    def _excerpt(self, value, terms):
+        words = value.split()
+        pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+        for i, word in enumerate(words):
+            if pattern.search(word):
+                start = max(i - self.SNIPPET_TOKENS // 2, 0)
+                break
+        else:
+            start = 0
+        excerpt = " ".join(words[start:start + self.SNIPPET_TOKENS])
+        if start > 0:
+            excerpt = "…" + excerpt
+        if start + self.SNIPPET_TOKENS < len(words):
+            excerpt += "…"
+        return excerpt
+
+    @staticmethod
+    def _mark(value, terms):
+        pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+        return pattern.sub(lambda m: _MARK_START + m.group(0) + _MARK_END, value)
@@ -0,0 +1,219 @@
+/*
+ * Upload large files in chunks with resume support.
+ *
+ * Every input with a data-chunked-upload attribute sends the selected file
+ * to the chunked upload view. The upload id is kept in localStorage, so
+ * selecting the same file again after an interruption continues where the
+ * previous attempt stopped. Finishing sends the content hash of the file,
+ * the SHA-256 of the SHA-256 digests of its blocks, so the server can
+ * reject a corrupted upload. The server hashes the blocks while they
+ * arrive and tells the block size when the upload starts.
+ */
+(function () {
+  'use strict';
+
+  var K = [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+  ];
+
+  /*
+   * Incremental SHA-256, crypto.subtle.digest needs the whole file in memory.
+   */
+  function Sha256() {
+    this.state = [
+      0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+    ];
+    this.block = new Uint8Array(64);
+    this.blockLength = 0;
+    this.length = 0;
+    this.w = new Uint32Array(64);
+  }
+
+  function rotr(x, n) {
+    return (x >>> n) | (x << (32 - n));
+  }
+
+  Sha256.prototype.compress = function () {
+    var w = this.w, block = this.block, s = this.state, i;
+    for (i = 0; i < 16; i++) {
+      w[i] = (block[4 * i] << 24) | (block[4 * i + 1] << 16) | (block[4 * i + 2] << 8) | block[4 * i + 3];
+    }
+    for (i = 16; i < 64; i++) {
+      var s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+      var s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+      w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+    var a = s[0], b = s[1], c = s[2], d = s[3], e = s[4], f = s[5], g = s[6], h = s[7];
+    for (i = 0; i < 64; i++) {
+      var t1 = (h + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + K[i] + w[i]) | 0;
+      var t2 = ((rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+      h = g;
+      g = f;
+      f = e;
+      e = (d + t1) | 0;
+      d = c;
+      c = b;
+      b = a;
+      a = (t1 + t2) | 0;
+    }
+    s[0] = (s[0] + a) | 0;
+    s[1] = (s[1] + b) | 0;
+    s[2] = (s[2] + c) | 0;
+    s[3] = (s[3] + d) | 0;
+    s[4] = (s[4] + e) | 0;
+    s[5] = (s[5] + f) | 0;
+    s[6] = (s[6] + g) | 0;
+    s[7] = (s[7] + h) | 0;
+  };
+
+  Sha256.prototype.update = function (bytes) {
+    this.length += bytes.length;
+    for (var i = 0; i < bytes.length; i++) {
+      this.block[this.blockLength++] = bytes[i];
+      if (this.blockLength === 64) {
+        this.compress();
+        this.blockLength = 0;
+      }
+    }
+  };
+
+  Sha256.prototype.digest = function () {
+    var bits = this.length * 8;
+    var padding = new Uint8Array((this.blockLength < 56 ? 56 : 120) - this.blockLength + 8);
+    var view = new DataView(padding.buffer);
+    padding[0] = 0x80;
+    view.setUint32(padding.length - 8, Math.floor(bits / 0x100000000));
+    view.setUint32(padding.length - 4, bits >>> 0);
+    this.update(padding);
+    var digest = new Uint8Array(32);
+    var view32 = new DataView(digest.buffer);
+    this.state.forEach(function (x, i) { view32.setUint32(4 * i, x >>> 0); });
+    return digest;
+  };
+
+  Sha256.prototype.hexdigest = function () {
+    return Array.prototype.map.call(this.digest(), function (x) {
+      return ('0' + x.toString(16)).slice(-2);
+    }).join('');
+  };
+
+  function contentHash(file, blockSize, hasher, offset) {
+    hasher = hasher || new Sha256();
+    offset = offset || 0;
+    if (offset >= file.size) {
+      return Promise.resolve(hasher.hexdigest());
+    }
+    var end = Math.min(offset + blockSize, file.size);
+    return file.slice(offset, end).arrayBuffer().then(function (buffer) {
+      var block = new Sha256();
+      block.update(new Uint8Array(buffer));
+      hasher.update(block.digest());
+      return contentHash(file, blockSize, hasher, end);
+    });
+  }
+
+  function request(method, url, options) {
+    options = options || {};
+    options.method = method;
+    options.credentials = 'same-origin';
+    return fetch(url, options).then(function (response) {
+      return response.json().then(function (data) {
+        if (!response.ok && response.status !== 409) {
+          throw new Error('Upload failed with status ' + response.status);
+        }
+        return data;
+      });
+    });
+  }
+
+  function storageKey(input, file) {
+    return ['chunked-upload', input.dataset.uploadSet, file.name, file.size, file.lastModified].join(':');
+  }
+
+  function start(input, file) {
+    var baseUrl = input.dataset.chunkedUpload;
+    var key = storageKey(input, file);
+    var uploadId = localStorage.getItem(key);
+
+    var begin = uploadId
+      ? request('GET', baseUrl + uploadId).catch(function () { return null; })
+      : Promise.resolve(null);
+
+    return begin.then(function (state) {
+      if (state) {
+        return state;
+      }
+      return request('POST', baseUrl, {
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({upload_set: input.dataset.uploadSet, filename: file.name, size: file.size})
+      }).then(function (state) {
+        localStorage.setItem(key, state.id);
+        return state;
+      });
+    });
+  }
+
+  function sendChunks(input, file, state, progress) {
+    var chunkSize = parseInt(input.dataset.chunkSize, 10);
+    var url = input.dataset.chunkedUpload + state.id;
+    progress.value = state.offset;
+
+    if (state.offset >= file.size) {
+      return Promise.resolve(state);
+    }
+    var end = Math.min(state.offset + chunkSize, file.size);
+    return request('PUT', url, {
+      headers: {
+        'Content-Type': 'application/octet-stream',
+        'Content-Range': 'bytes ' + state.offset + '-' + (end - 1) + '/' + file.size
+      },
+      body: file.slice(state.offset, end)
+    }).then(function (next) {
+      return sendChunks(input, file, next, progress);
+    });
+  }
+
+  function upload(input) {
+    var file = input.files[0];
+    var progress = document.getElementById(input.dataset.progress);
+    if (!file) {
+      return;
+    }
+    progress.max = file.size;
+    input.disabled = true;
+
+    var blockSize;
+    start(input, file)
+      .then(function (state) {
+        blockSize = state.block_size;
+        return sendChunks(input, file, state, progress);
+      })
+      .then(function (state) {
+        return contentHash(file, blockSize).then(function (hash) {
+          return request('POST', input.dataset.chunkedUpload + state.id + '/finish', {
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({content_hash: hash})
+          });
+        });
+      })
+      .then(function () {
+        localStorage.removeItem(storageKey(input, file));
+        window.location.reload();
+      })
+      .catch(function (error) {
+        input.disabled = false;
+        window.alert(error.message);
+      });
+  }
+
+  document.querySelectorAll('input[data-chunked-upload]').forEach(function (input) {
+    input.addEventListener('change', function () { upload(input); });
+  });
+})();
@@ -0,0 +1,106 @@
+"""Content addressed storage for uploaded files.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+from sqlalchemy import func, select
+
+
+# content hashes are the SHA-256 of the SHA-256 digests of blocks of this
+# size, so chunked uploads can hash the file while it arrives
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def hash_blocks(f, digests: list) -> bytes:
+    """Hash the complete blocks of `f` that follow the ones in `digests`.
+
+    The hex digests are appended to `digests`, the bytes of the incomplete
+    last block are returned.
+
+    """
+    f.seek(len(digests) * HASH_BLOCK_SIZE)
+    while True:
+        block = f.read(HASH_BLOCK_SIZE)
+        if len(block) < HASH_BLOCK_SIZE:
+            return block
+        digests.append(hashlib.sha256(block).hexdigest())
+
+
+def content_hash(digests, tail: bytes = b"") -> str:
+    """Return the content hash of the blocks with `digests` and `tail`."""
+    hasher = hashlib.sha256()
+    for digest in digests:
+        hasher.update(bytes.fromhex(digest))
+    if tail:
+        hasher.update(hashlib.sha256(tail).digest())
+    return hasher.hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """Return the content hash of the file at `path`."""
+    digests = []
+    with open(path, "rb") as f:
+        tail = hash_blocks(f, digests)
+    return content_hash(digests, tail)
+
+
+def blob_name(content_hash: str, filename: str) -> str:
+    """Return the storage name of a blob relative to the upload directory.
+
+    The extension of the display filename is kept, so the web server still
+    sends the right content type.
+
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return f"blobs/{content_hash[:2]}/{content_hash}{ext}"
+
+
+@contextmanager
+def blob_lock(path: str):
+    """Hold an exclusive lock on the directory of the blob at `path`.
+
+    Deleting a blob after checking that no row references it and restoring
+    a blob that vanished hold the lock, so neither happens between the check
+    and the change of the other.
+
+    """
+    fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def store_blob(path: str, destination: str, filename: str, digest: str = None):
+    """Move the file at `path` into the store below `destination`.
+
+    If a blob with the same content exists already the file at `path` is
+    left in place. The blob may be deleted before the row referencing it is
+    committed, so the caller keeps the file until then and moves it into
+    place if the blob vanished meanwhile. `digest` is the content hash of
+    the file if the caller knows it already.
+
+    :return: storage name of the blob and True if it was newly created
+
+    """
+    name = blob_name(digest or file_hash(path), filename)
+    dst = os.path.join(destination, name)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with blob_lock(dst):
+        if os.path.exists(dst):
+            return name, False
+        os.replace(path, dst)
+    return name, True
+
+
+def blob_references(connection, table, name: str) -> int:
+    """Return the number of rows in `table` that reference the blob."""
+    return connection.execute(
+        select([func.count()]).select_from(table).where(table.c.blob == name)
+    ).scalar()
@@ -1,4 +1,16 @@
-"""
+"""Nightly snapshots of the application data on a backup server.
+
+Every snapshot is a directory on the server. Files that didn't change since
+the previous snapshot are hardlinks to it (rsync --link-dest), so a new
+snapshot only costs the time and space of the changed files and deleting a
+snapshot only frees the files no other snapshot shares. A SHA256SUMS file
+in each snapshot allows to verify it. It is written on the server after the
+copy, hardlinked files keep the checksum of the previous snapshot.
+
+    python backup.py            create a snapshot and delete old ones
+    python backup.py list       list the snapshots and their new data
+    python backup.py verify     check the files of the snapshots
+
 :author: Stefan Lehmann <stlm@posteo.de>
 :license: MIT, see license file or https://opensource.org/licenses/MIT
 
@@ -7,10 +19,17 @@
 :last modified time: 2019-06-09 13:43:56
 
 """
+import datetime
+import os
+import pathlib
+import shutil
 import sys
+import tempfile
+import time
+import click
 import fabric
-import datetime
 from subprocess import call
+from backups import is_sqlite, record_duration, remote_command, scan, snapshot_sqlite
 
 
 {% if cookiecutter.backup_server %}
@@ -19,9 +38,6 @@ SSH_SERVER = "{{ cookiecutter.backup_server }}"
 SSH_SERVER = None
 {% endif %}
 
-if SSH_SERVER is None:
-    sys.exit()
-
 SSH_USERNAME = "{{ cookiecutter.backup_username }}"
 KEEP_BACKUPS_FOR_DAYS = 10
 DIRECTORIES = [
@@ -29,21 +45,149 @@ DIRECTORIES = [
     "app/db"
 ]
 
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_NAME_FORMAT = "%Y%m%d_%H%M%S"
+CHECKSUMS = "SHA256SUMS"
+
 hostname = f"{SSH_USERNAME}@{SSH_SERVER}"
 
-# Use rsync to backup files
-for d in DIRECTORIES:
-    call(["rsync", "-a", "--delete", d, f"{hostname}:backup"])
+
+def snapshot_time(name):
+    try:
+        return datetime.datetime.strptime(name, SNAPSHOT_NAME_FORMAT)
+    except ValueError:
+        return None
+
+
+def list_snapshots(c):
+    """Return the names of all complete snapshots on the server, oldest first."""
+    result = c.run(f"ls -1 {SNAPSHOT_DIR}", hide=True, warn=True)
+    return sorted(name for name in result.stdout.split() if snapshot_time(name))
+
+
+def stage_databases(directory, staging):
+    """Copy the files of `directory` with consistent database snapshots."""
+    name = os.path.basename(directory)
+    for arcname, path in scan({name: directory}).items():
+        target = staging / arcname
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if is_sqlite(path):
+            snapshot_sqlite(path, target)
+        else:
+            shutil.copy2(path, target)
+    return staging / name
+
+
+def create_snapshot(c):
+    name = datetime.datetime.utcnow().strftime(SNAPSHOT_NAME_FORMAT)
+    partial = f"{SNAPSHOT_DIR}/.{name}.partial"
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        staging = pathlib.Path(tmpdir)
+        sources = {}
+        for d in DIRECTORIES:
+            if d.endswith("db"):
+                # the live database may change while rsync reads it
+                sources[os.path.basename(d)] = str(stage_databases(d, staging))
+            else:
+                sources[os.path.basename(d)] = d
+
+        c.run(f"mkdir -p {SNAPSHOT_DIR} && rm -rf {SNAPSHOT_DIR}/.*.partial")
+        link_dest = []
+        if c.run(f"test -d {SNAPSHOT_DIR}/latest", warn=True, hide=True).ok:
+            link_dest = ["--link-dest=../latest"]
+        ret = call(
+            ["rsync", "-a", "--delete"]
+            + link_dest
+            + list(sources.values())
+            + [f"{hostname}:{partial}/"]
+        )
+        if ret != 0:
+            click.echo(click.style(f"rsync failed, returncode={ret}", fg="red"))
+            sys.exit(1)
+
+    # checksums of what arrived, the live images may change during the copy
+    c.run(remote_command(
+        SNAPSHOT_DIR, "checksums", f".{name}.partial", CHECKSUMS, "--previous", "latest"
+    ))
+    c.run(f"cd {SNAPSHOT_DIR} && mv .{name}.partial {name} && ln -sfn {name} latest")
+    return name
+
+
+def prune_snapshots(c):
+    """Delete snapshots older than KEEP_BACKUPS_FOR_DAYS, except the newest."""
+    limit = datetime.datetime.utcnow() - datetime.timedelta(days=KEEP_BACKUPS_FOR_DAYS)
+    deleted = []
+    for name in list_snapshots(c)[:-1]:
+        if snapshot_time(name) < limit:
+            c.run(f"rm -rf {SNAPSHOT_DIR}/{name}")
+            deleted.append(name)
+    return deleted
+
+
+def connect():
+    if SSH_SERVER is None:
+        sys.exit()
+    return fabric.Connection(hostname)
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def cli(ctx):
+    """Create a snapshot and delete the expired ones."""
+    if ctx.invoked_subcommand is not None:
+        return
+    c = connect()
+    start = time.monotonic()
+    name = create_snapshot(c)
+    record_duration("app", "snapshot", time.monotonic() - start)
+    click.echo(f"Created snapshot {name}")
+    for name in prune_snapshots(c):
+        click.echo(f"Deleted snapshot {name}")
+
+
+@cli.command("list")
+def list_command():
+    """List the snapshots with the size of the data new in each."""
+    c = connect()
+    names = list_snapshots(c)
+    if not names:
+        click.echo("No snapshots")
+        return
+    # du counts files with several hardlinks only at their first snapshot
+    result = c.run(f"cd {SNAPSHOT_DIR} && du -sh {' '.join(names)}", hide=True)
+    sizes = dict(reversed(line.split("\t", 1)) for line in result.stdout.splitlines())
+    # one line per snapshot, "?" for snapshots without checksums
+    result = c.run(
+        f"cd {SNAPSHOT_DIR} && for s in {' '.join(names)}; do "
+        f"echo \"$s $(wc -l 2>/dev/null < $s/{CHECKSUMS} || echo '?')\"; done",
+        hide=True,
+    )
+    counts = dict(line.split() for line in result.stdout.splitlines() if line.strip())
+    for name in names:
+        click.echo(f"{name}  {counts.get(name, '?'):>8} files  {sizes.get(name, '?'):>6} new")
 
 
-# Create new TAR file with content
-now = datetime.datetime.utcnow()
-filename = "backup_{0}.tgz".format(now.strftime("%Y%m%d_%H%M"))
-c = fabric.Connection(hostname)
-c.run(f"tar -czvf {filename} backup")
+@cli.command()
+@click.argument("names", nargs=-1)
+def verify(names):
+    """Check the files of the snapshots against their checksums."""
+    c = connect()
+    failed = []
+    for name in names or list_snapshots(c):
+        result = c.run(
+            f"cd {SNAPSHOT_DIR}/{name} && sha256sum -c --quiet {CHECKSUMS}",
+            hide=True, warn=True,
+        )
+        if result.ok:
+            click.echo(f"{name}  OK")
+        else:
+            failed.append(name)
+            click.echo(click.style(f"{name}  FAILED", fg="red"))
+            click.echo(result.stdout + result.stderr)
+    if failed:
+        sys.exit(1)
 
 
-# Delete old tarfiles
-{% raw %}
-c.run(f"find * -mtime +{KEEP_BACKUPS_FOR_DAYS} -exec rm {{}} \;")
-{% endraw %}
+if __name__ == "__main__":
+    cli()
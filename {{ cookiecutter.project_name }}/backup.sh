@@ -1,2 +1,2 @@
 #!/bin/sh
-cd /flask && python backup.py
+cd /flaskapp && python backup.py
@@ -0,0 +1,788 @@
+"""Incremental backups of the application data.
+
+A backup repository is a directory with one subdirectory per backup. Each
+backup has a manifest with path, size, mtime and SHA-256 of every file and
+the name of the backup whose archive holds the content. A full backup
+archives all files, an incremental backup only files that are new or whose
+size or mtime changed since its parent. Restoring any backup extracts every
+file from the backup of the chain that holds it.
+
+Remote hosts run this module with "python3 -c" and stream a single archive
+through stdin or stdout of the command, see `remote_command`.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import argparse
+import base64
+import contextlib
+import datetime
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import shlex
+import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 1
+
+# application data below the app directory and its name in the backup
+DATA_DIRS = {
+    "db": pathlib.Path("db"),
+    "images": pathlib.Path("static") / "images",
+}
+
+# already compressed files are archived without compression
+STORED_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".gz", ".br", ".zip"}
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+SQLITE_SIDE_FILES = ("-wal", "-shm", "-journal")
+
+# stamps in the db directory that tell the workers to drop their caches
+STAMP_SUFFIX = ".stamp"
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# databases up to this size are snapshotted in memory if sqlite3 can
+# serialize them (Python 3.11), larger ones into a temporary file
+SNAPSHOT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# backup durations for the metrics of the app, see app/metrics.py. Not the
+# directory of the workers, gunicorn empties that one on start.
+METRICS_DIR = pathlib.Path("cache") / "backup-metrics"
+
+
+class BackupError(Exception):
+    pass
+
+
+def is_sqlite(path) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+
+def data_dirs(app_dir) -> dict:
+    """Return the data directories below `app_dir` by their name in the backup."""
+    return {name: pathlib.Path(app_dir) / rel for name, rel in DATA_DIRS.items()}
+
+
+def scan(targets) -> dict:
+    """Return the paths of all files in the `targets` directories.
+
+    The keys are the names of the files in the backup, the directory name
+    of `targets` followed by the path relative to the directory.
+
+    """
+    paths = {}
+    for name, root in targets.items():
+        root = pathlib.Path(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(SQLITE_SIDE_FILES):
+                    continue
+                path = pathlib.Path(dirpath) / filename
+                arcname = pathlib.PurePosixPath(name) / path.relative_to(root).as_posix()
+                paths[str(arcname)] = path
+    return paths
+
+
+def snapshot_sqlite(path, dst) -> None:
+    """Copy a live database with the SQLite online backup API.
+
+    The copy is consistent even while workers write to the database, it
+    contains all transactions committed before the backup started.
+
+    """
+    source = sqlite3.connect(str(path))
+    target = sqlite3.connect(str(dst))
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def _snapshot_bytes(path) -> bytes:
+    source = sqlite3.connect(str(path))
+    target = sqlite3.connect(":memory:")
+    try:
+        # a memory database can't change its page size during the backup
+        page_size = source.execute("PRAGMA page_size").fetchone()[0]
+        target.execute(f"PRAGMA page_size = {page_size}")
+        source.backup(target)
+        return target.serialize()
+    finally:
+        target.close()
+        source.close()
+
+
+@contextlib.contextmanager
+def sqlite_snapshot(path):
+    """Yield a snapshot of a live database as binary file and its size.
+
+    The snapshot is taken like in `snapshot_sqlite`, but only exists while
+    the block runs, so archives get one database at a time instead of
+    copies of all of them.
+
+    """
+    if hasattr(sqlite3.Connection, "serialize") and os.path.getsize(path) <= SNAPSHOT_MEMORY_LIMIT:
+        data = _snapshot_bytes(path)
+        yield io.BytesIO(data), len(data)
+        return
+
+    fd, tmp = tempfile.mkstemp(prefix=".snapshot-")
+    os.close(fd)
+    try:
+        snapshot_sqlite(path, tmp)
+        with open(tmp, "rb") as f:
+            yield f, os.fstat(f.fileno()).st_size
+    finally:
+        os.remove(tmp)
+
+
+def _add_file(tar, arcname, path, mtime) -> tuple:
+    """Add a file to `tar`, databases as snapshot, and return SHA-256 and size."""
+    tarinfo = tar.gettarinfo(str(path), arcname)
+    tarinfo.mtime = mtime
+    if is_sqlite(path):
+        with sqlite_snapshot(path) as (f, size):
+            tarinfo.size = size
+            reader = _HashingReader(f)
+            tar.addfile(tarinfo, reader)
+    else:
+        with open(path, "rb") as f:
+            reader = _HashingReader(f)
+            tar.addfile(tarinfo, reader)
+    return reader.sha256.hexdigest(), reader.size
+
+
+def _safe_arcname(arcname: str, names=DATA_DIRS) -> str:
+    parts = pathlib.PurePosixPath(arcname).parts
+    if not parts or parts[0] not in names or ".." in parts or arcname.startswith("/"):
+        raise BackupError(f"Invalid path in backup: {arcname}")
+    return arcname
+
+
+class _HashingReader:
+    """File wrapper that computes the SHA-256 of everything read."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+class _HashingWriter:
+    """File wrapper that computes the SHA-256 of everything written."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def _write_part(path, compressed, files):
+    """Write files into a tar archive and return their SHA-256 and size."""
+    hashes = {}
+    options = {"mode": "w:gz", "compresslevel": 6} if compressed else {"mode": "w"}
+    with tarfile.open(path, **options) as tar:
+        for arcname, src, mtime in files:
+            hashes[arcname] = _add_file(tar, arcname, src, mtime)
+    return hashes
+
+
+def _partition(files, parts):
+    """Split files into at most `parts` groups of about the same size."""
+    groups = [[] for _ in range(min(parts, len(files)))]
+    sizes = [0] * len(groups)
+    for item in sorted(files, key=lambda item: item[3], reverse=True):
+        i = sizes.index(min(sizes))
+        groups[i].append(item[:3])
+        sizes[i] += item[3]
+    return groups
+
+
+def load_manifest(backup_dir) -> dict:
+    try:
+        with open(pathlib.Path(backup_dir) / MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise BackupError(f"No valid backup in {backup_dir}: {e}")
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise BackupError(f"Unsupported backup version in {backup_dir}")
+    return manifest
+
+
+def list_backups(repository) -> list:
+    """Return the names of all complete backups, oldest first."""
+    repository = pathlib.Path(repository)
+    if not repository.is_dir():
+        return []
+    return sorted(
+        p.name for p in repository.iterdir()
+        if not p.name.startswith(".") and (p / MANIFEST).is_file()
+    )
+
+
+def backup_chain(repository, name) -> list:
+    """Return the manifests from the last full backup up to `name`."""
+    chain = []
+    while name is not None:
+        manifest = load_manifest(pathlib.Path(repository) / name)
+        chain.append(manifest)
+        name = manifest["parent"]
+    return list(reversed(chain))
+
+
+def create_backup(app_dir, repository, full=False, full_every=7, jobs=None) -> dict:
+    """Write a new backup of the application data into `repository`.
+
+    A full backup is made if `full` is set, if there is no backup yet or if
+    the last full backup is followed by `full_every` incremental ones. The
+    archives are written by `jobs` processes in parallel. Returns the
+    manifest of the new backup.
+
+    """
+    start = time.monotonic()
+    repository = pathlib.Path(repository)
+    repository.mkdir(parents=True, exist_ok=True)
+
+    backups = list_backups(repository)
+    parent = backups[-1] if backups else None
+    full = full or parent is None or len(backup_chain(repository, parent)) > full_every
+    if full:
+        parent = None
+    previous = load_manifest(repository / parent)["files"] if parent else {}
+
+    now = datetime.datetime.utcnow()
+    name = now.strftime("%Y%m%dT%H%M%S.%f") + ("-full" if full else "-incr")
+    partial = repository / f".{name}.partial"
+    partial.mkdir()
+
+    try:
+        entries = {}
+        changed = []
+        for arcname, path in scan(data_dirs(app_dir)).items():
+            stat = path.stat()
+            entry = previous.get(arcname)
+            # mtime in seconds, that's what survives the tar archive
+            mtime = int(stat.st_mtime)
+            if is_sqlite(path):
+                # archived as snapshot, the live file may change while it is read
+                entries[arcname] = {"size": stat.st_size, "mtime": mtime}
+                changed.append((arcname, path, mtime, stat.st_size))
+            elif entry is not None and (entry["size"], entry["mtime"]) == (stat.st_size, mtime):
+                entries[arcname] = entry
+            else:
+                entries[arcname] = {"size": stat.st_size, "mtime": mtime}
+                changed.append((arcname, path, mtime, stat.st_size))
+
+        jobs = jobs or os.cpu_count() or 1
+        groups = {True: [], False: []}
+        for item in changed:
+            suffix = pathlib.PurePosixPath(item[0]).suffix.lower()
+            groups[suffix not in STORED_SUFFIXES].append(item)
+        tasks = []
+        for is_compressed, files in groups.items():
+            for group in _partition(files, jobs):
+                part = "part-{:03d}.tar{}".format(len(tasks), ".gz" if is_compressed else "")
+                tasks.append((part, is_compressed, group))
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                part: executor.submit(_write_part, str(partial / part), is_compressed, group)
+                for part, is_compressed, group in tasks
+            }
+            for part, future in futures.items():
+                for arcname, (sha256, size) in future.result().items():
+                    entries[arcname].update(size=size, sha256=sha256, backup=name, part=part)
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "name": name,
+            "parent": parent,
+            "created": now.isoformat() + "Z",
+            "archived": len(changed),
+            "archived_size": sum(entries[item[0]]["size"] for item in changed),
+            "files": entries,
+        }
+        with open(partial / MANIFEST, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        partial.rename(repository / name)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    record_duration(app_dir, "full" if full else "incremental", time.monotonic() - start)
+    return manifest
+
+
+def selected(arcname: str, paths) -> bool:
+    """Return if `arcname` is one of `paths` or below one of them."""
+    if not paths:
+        return True
+    return any(arcname == path or arcname.startswith(path.rstrip("/") + "/") for path in paths)
+
+
+def _extract_file(tar, member, staging) -> str:
+    """Extract a regular file and return its SHA-256."""
+    target = pathlib.Path(staging) / member.name
+    target.parent.mkdir(parents=True, exist_ok=True)
+    sha256 = hashlib.sha256()
+    with tar.extractfile(member) as src, open(target, "wb") as dst:
+        for chunk in iter(lambda: src.read(STREAM_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            dst.write(chunk)
+    os.chmod(target, member.mode)
+    os.utime(target, (member.mtime, member.mtime))
+    return sha256.hexdigest()
+
+
+def _extract_part(path, members, staging) -> list:
+    """Extract `members` with their expected SHA-256 from an archive.
+
+    Returns the names of the members that are missing or corrupt.
+
+    """
+    remaining = dict(members)
+    failed = []
+    with tarfile.open(path, "r:*") as tar:
+        for member in tar:
+            expected = remaining.pop(member.name, None)
+            if expected is None or not member.isfile():
+                continue
+            if _extract_file(tar, member, staging) != expected:
+                failed.append(member.name)
+    return failed + sorted(remaining)
+
+
+def _restore_sqlite(staged, live) -> None:
+    """Copy the staged database into the live one in one transaction.
+
+    Workers keep their connections, they see the old data until the copy
+    is complete and the restored data afterwards.
+
+    """
+    source = sqlite3.connect(str(staged))
+    target = sqlite3.connect(str(live))
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def _swap_in(staging, targets, page_cache=None, complete=None) -> None:
+    """Move the staged data in place of the live directories in `targets`.
+
+    Databases are copied into the live files. Directories in `complete`
+    are replaced with renames, in the others only the staged files are
+    replaced. All directories are complete by default.
+
+    """
+    if complete is None:
+        complete = set(targets)
+
+    for name, live in targets.items():
+        staged_dir = staging / name
+        live = pathlib.Path(live)
+        if not staged_dir.is_dir():
+            continue
+
+        if name != "db" and name in complete:
+            live.parent.mkdir(parents=True, exist_ok=True)
+            if live.exists():
+                live.rename(staging / f"old-{name}")
+            staged_dir.rename(live)
+            continue
+
+        for staged in sorted(staged_dir.rglob("*")):
+            if not staged.is_file():
+                continue
+            live_file = live / staged.relative_to(staged_dir)
+            live_file.parent.mkdir(parents=True, exist_ok=True)
+            if is_sqlite(staged) and is_sqlite(live_file):
+                _restore_sqlite(staged, live_file)
+            else:
+                os.replace(str(staged), str(live_file))
+
+        # workers drop roles, users and row counts cached before the restore
+        for stamp in live.rglob("*" + STAMP_SUFFIX):
+            tmp = stamp.with_name(f"{stamp.name}.{uuid.uuid4().hex}")
+            tmp.write_text(uuid.uuid4().hex)
+            os.replace(str(tmp), str(stamp))
+
+    # rendered pages show the data before the restore
+    if page_cache is not None and pathlib.Path(page_cache).is_dir():
+        for page in pathlib.Path(page_cache).iterdir():
+            page.unlink()
+
+
+def _complete_dirs(paths) -> set:
+    """Return the data directories that `paths` select as a whole."""
+    if not paths:
+        return set(DATA_DIRS)
+    return {path.strip("/") for path in paths if path.strip("/") in DATA_DIRS}
+
+
+def restore_backup(app_dir, source, jobs=None, paths=None) -> dict:
+    """Restore the backup in directory `source` into `app_dir`.
+
+    `source` may also be a repository, its newest backup is restored then.
+    Files are extracted in parallel into a staging directory next to the
+    live data and verified against the SHA-256 in the manifest. The live
+    data is only replaced if all files are intact. With `paths` only these
+    files or directories are restored, e.g. ["db"]. Returns the manifest
+    of the restored backup.
+
+    """
+    start = time.monotonic()
+    source = pathlib.Path(source)
+    if not (source / MANIFEST).is_file():
+        backups = list_backups(source)
+        if not backups:
+            raise BackupError(f"No backup found in {source}")
+        source = source / backups[-1]
+    repository = source.parent
+    manifest = load_manifest(source)
+
+    parts = defaultdict(dict)
+    for arcname, entry in manifest["files"].items():
+        if selected(_safe_arcname(arcname), paths):
+            parts[entry["backup"], entry["part"]][arcname] = entry["sha256"]
+    if not parts:
+        raise BackupError(f"Nothing to restore for {', '.join(paths)}")
+    for backup, part in parts:
+        if not (repository / backup / part).is_file():
+            raise BackupError(f"Archive {backup}/{part} of the backup chain is missing")
+
+    app_dir = pathlib.Path(app_dir)
+    staging = app_dir / f".restore-{uuid.uuid4().hex}"
+    staging.mkdir()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            futures = [
+                executor.submit(_extract_part, str(repository / backup / part), members, str(staging))
+                for (backup, part), members in parts.items()
+            ]
+            failed = [name for future in futures for name in future.result()]
+        if failed:
+            raise BackupError(
+                f"{len(failed)} files are missing or corrupt, the live data is "
+                f"unchanged: {', '.join(failed[:10])}"
+            )
+        _swap_in(
+            staging,
+            data_dirs(app_dir),
+            page_cache=app_dir / "cache" / "pages",
+            complete=_complete_dirs(paths),
+        )
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    record_duration(app_dir, "restore", time.monotonic() - start)
+    return manifest
+
+
+def stream_backup(targets, out) -> tuple:
+    """Write a tar.gz archive of the `targets` directories to `out`.
+
+    Databases are added as snapshots like in `create_backup`. Returns the
+    SHA-256 and the size of the written stream.
+
+    """
+    writer = _HashingWriter(out)
+    with gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=6) as compressed:
+        with tarfile.open(fileobj=compressed, mode="w|") as tar:
+            for arcname, path in scan(targets).items():
+                _add_file(tar, arcname, path, int(path.stat().st_mtime))
+    writer.flush()
+    return writer.sha256.hexdigest(), writer.size
+
+
+def stream_restore(infile, targets, sha256=None, page_cache=None, paths=None) -> None:
+    """Restore the tar.gz archive read from `infile` into `targets`.
+
+    The archive is extracted into a staging directory while it is read.
+    The live data is only replaced if the SHA-256 of the whole stream
+    matches `sha256`, if given. With `paths` only these files or
+    directories are restored.
+
+    """
+    reader = _HashingReader(infile)
+    first = pathlib.Path(next(iter(targets.values())))
+    staging = pathlib.Path(tempfile.mkdtemp(prefix=".restore-", dir=str(first.parent)))
+    try:
+        with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+            for member in tar:
+                _safe_arcname(member.name, targets)
+                if member.isfile() and selected(member.name, paths):
+                    _extract_file(tar, member, staging)
+        # padding after the end of the archive
+        while reader.read(STREAM_CHUNK_SIZE):
+            pass
+        if sha256 is not None and reader.sha256.hexdigest() != sha256:
+            raise BackupError("Checksum mismatch, the live data is unchanged")
+        _swap_in(staging, targets, page_cache=page_cache, complete=_complete_dirs(paths))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def remote_command(directory, *args) -> str:
+    """Return a shell command that runs this module in `directory`.
+
+    The source of the module is part of the command, the host only needs
+    Python 3.6 or newer.
+
+    """
+    source = base64.b64encode(pathlib.Path(__file__).read_bytes()).decode("ascii")
+    code = f"import base64; exec(base64.b64decode('{source}'))"
+    return " ".join(
+        [f"cd {shlex.quote(directory)} &&", "python3 -c", shlex.quote(code)]
+        + [shlex.quote(arg) for arg in args]
+    )
+
+
+def _checksum_line(sha256, size) -> str:
+    return f"sha256 {sha256} {size}"
+
+
+def _read_in_background(stream):
+    """Read `stream` to the end on a thread, return a function for the text.
+
+    stderr of a process is read while its stdout or stdin are busy, a full
+    stderr pipe would block the process otherwise.
+
+    """
+    chunks = []
+
+    def read():
+        for chunk in iter(lambda: stream.read(STREAM_CHUNK_SIZE), b""):
+            chunks.append(chunk)
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+
+    def text():
+        thread.join()
+        return b"".join(chunks).decode("utf-8", "replace").strip()
+    return text
+
+
+def receive_backup(process, dst, progress=None) -> str:
+    """Store the archive streamed by `process` in `dst` and verify it.
+
+    `process` is a command started with `remote_command(directory,
+    "stream-backup", ...)`. Returns the SHA-256 of the archive.
+
+    """
+    process.close_stdin()
+    read_errors = _read_in_background(process.stderr)
+    dst = pathlib.Path(dst)
+    partial = dst.with_name(f".{dst.name}.partial")
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(partial, "wb") as f:
+            for chunk in iter(lambda: process.stdout.read(STREAM_CHUNK_SIZE), b""):
+                f.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+                if progress is not None:
+                    progress(size)
+        errors = read_errors()
+        if process.wait() != 0:
+            raise BackupError(f"Backup on the host failed: {errors}")
+        if _checksum_line(sha256.hexdigest(), size) not in errors.splitlines():
+            raise BackupError("Checksum mismatch, the archive is incomplete")
+        os.replace(str(partial), str(dst))
+    except BaseException:
+        if partial.exists():
+            partial.unlink()
+        raise
+    return sha256.hexdigest()
+
+
+def send_backup(process, src, progress=None) -> None:
+    """Stream the archive `src` to `process` and wait for the restore.
+
+    `process` is a command started with `remote_command(directory,
+    "stream-restore", file_hash(src), ...)`.
+
+    """
+    read_errors = _read_in_background(process.stderr)
+    size = 0
+    try:
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                process.stdin.write(chunk)
+                size += len(chunk)
+                if progress is not None:
+                    progress(size)
+    finally:
+        process.close_stdin()
+    errors = read_errors()
+    if process.wait() != 0:
+        raise BackupError(f"Restore on the host failed: {errors}")
+
+
+def record_duration(app_dir, operation: str, seconds: float) -> None:
+    """Add the duration of a backup operation to the metrics of the app.
+
+    Nothing is recorded if prometheus_client isn't installed or the app
+    doesn't write metrics into `app_dir`.
+
+    """
+    directory = os.environ.get("BACKUP_METRICS_DIR") or str(pathlib.Path(app_dir) / METRICS_DIR)
+    if not os.path.isdir(directory):
+        return
+    os.environ.setdefault("prometheus_multiproc_dir", directory)
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", directory)
+    try:
+        from prometheus_client import Histogram, values
+    except ImportError:
+        return
+    # every run writes into the same file instead of one file per pid that
+    # is kept forever, the lock serializes concurrent runs
+    values.ValueClass = values.MultiProcessValue(lambda: "backup")
+    with open(os.path.join(directory, "backup.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        Histogram(
+            "backup_duration_seconds", "Duration of backups and restores", ["operation"],
+            buckets=(1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200), registry=None,
+        ).labels(operation).observe(seconds)
+
+
+def file_hash(path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _same_file(path, other) -> bool:
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+
+def write_checksums(directory, name, previous=None) -> int:
+    """Write the SHA-256 of all files below `directory` into the file `name`.
+
+    The file has the sha256sum format. Files that are hardlinks to the same
+    file in the `previous` directory, as rsync --link-dest creates them for
+    unchanged files, keep the checksum from its file `name`. Returns the
+    number of files that were hashed.
+
+    """
+    directory = pathlib.Path(directory)
+    known = {}
+    if previous is not None:
+        previous = pathlib.Path(previous)
+        try:
+            with open(previous / name) as f:
+                for line in f:
+                    sha256, _, arcname = line.rstrip("\n").partition("  ")
+                    known[arcname] = sha256
+        except OSError:
+            pass
+
+    hashed = 0
+    lines = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = pathlib.Path(dirpath) / filename
+            arcname = path.relative_to(directory).as_posix()
+            if arcname == name:
+                continue
+            sha256 = known.get(arcname)
+            if sha256 is None or not _same_file(path, previous / arcname):
+                sha256 = file_hash(path)
+                hashed += 1
+            lines.append(f"{sha256}  {arcname}\n")
+
+    tmp = directory / f".{name}.{uuid.uuid4().hex}"
+    tmp.write_text("".join(lines))
+    os.replace(str(tmp), str(directory / name))
+    return hashed
+
+
+def _targets(value):
+    name, _, directory = value.partition("=")
+    if not name or not directory:
+        raise argparse.ArgumentTypeError("expected NAME=DIRECTORY")
+    return name, directory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream backups and check snapshots of a host.")
+    subparsers = parser.add_subparsers(dest="command")
+    backup_parser = subparsers.add_parser("stream-backup")
+    backup_parser.add_argument("targets", type=_targets, nargs="+")
+    restore_parser = subparsers.add_parser("stream-restore")
+    restore_parser.add_argument("sha256")
+    restore_parser.add_argument("targets", type=_targets, nargs="+")
+    restore_parser.add_argument("--page-cache")
+    restore_parser.add_argument("--only", action="append")
+    checksums_parser = subparsers.add_parser("checksums")
+    checksums_parser.add_argument("directory")
+    checksums_parser.add_argument("name")
+    checksums_parser.add_argument("--previous")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "stream-backup":
+            sha256, size = stream_backup(dict(args.targets), sys.stdout.buffer)
+            print(_checksum_line(sha256, size), file=sys.stderr)
+        elif args.command == "stream-restore":
+            stream_restore(
+                sys.stdin.buffer, dict(args.targets), args.sha256, args.page_cache, args.only
+            )
+        elif args.command == "checksums":
+            write_checksums(args.directory, args.name, args.previous)
+        else:
+            parser.print_help()
+    except BackupError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Measure the schema check a worker runs when it creates the application.
+
+Times init_schema, once with the schema version in the database up to date
+and once with the version row removed before each run, which makes every
+call create the tables and the search index like every worker start did
+before the version check. Run from the project directory after
+"flask init-db", uses the database of the environment.
+
+Usage: python benchmarks/app_startup.py [--runs 50]
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db, init_schema, schema_info  # noqa: E402
+
+
+def measure(app, runs, current):
+    times = []
+    for _ in range(runs):
+        if not current:
+            with app.app_context():
+                db.session.execute(schema_info.delete())
+                db.session.commit()
+        start = time.perf_counter()
+        init_schema(app)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app()
+    for label, current in (("schema current", True), ("schema created", False)):
+        times = measure(app, args.runs, current)
+        print(
+            f"{label}: init_schema min {min(times) * 1000:.2f} ms, "
+            f"median {statistics.median(times) * 1000:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
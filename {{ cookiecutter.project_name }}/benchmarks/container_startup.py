@@ -0,0 +1,89 @@
+"""Measure the startup time of the docker image.
+
+Starts a container of the image several times and measures the time from
+"docker run" to the first response with status 200 for the start page
+through nginx. Reports the image size as well. Run from the project
+directory, --build builds the image from the Dockerfile first.
+
+Usage: python benchmarks/container_startup.py [--build] [--runs 5]
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import time
+import urllib.error
+import urllib.request
+
+
+def docker(*args):
+    return subprocess.run(
+        ["docker"] + list(args), check=True, stdout=subprocess.PIPE
+    ).stdout.decode().strip()
+
+
+def image_size(image):
+    """Return the size of the image in MiB."""
+    return json.loads(docker("image", "inspect", image))[0]["Size"] / 1024 ** 2
+
+
+def wait_for_200(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # nginx answers 502 until gunicorn is up
+            with urllib.request.urlopen(url) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"{url} didn't respond within {timeout} seconds")
+
+
+def measure(image, port, env_file, timeout):
+    """Return the seconds from docker run to the first 200 on /."""
+    start = time.monotonic()
+    container = docker(
+        "run", "-d", "-p", f"{port}:8000", "--env-file", env_file,
+        "-e", "FLASK_ENV=production", image,
+    )
+    try:
+        wait_for_200(f"http://localhost:{port}/", timeout)
+        return time.monotonic() - start
+    finally:
+        docker("rm", "-f", container)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--image", default="flaskapp-startup")
+    parser.add_argument("--build", action="store_true", help="build the image first")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8055)
+    parser.add_argument("--env-file", default=".env")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    if args.build:
+        start = time.monotonic()
+        subprocess.run(["docker", "build", "-t", args.image, "."], check=True)
+        print(f"build: {time.monotonic() - start:.1f} s")
+
+    print(f"image size: {image_size(args.image):.0f} MiB")
+    times = [
+        measure(args.image, args.port, args.env_file, args.timeout)
+        for _ in range(args.runs)
+    ]
+    print(
+        f"startup to first 200: min {min(times):.2f} s, "
+        f"median {statistics.median(times):.2f} s, max {max(times):.2f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
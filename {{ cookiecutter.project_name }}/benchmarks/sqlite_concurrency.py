@@ -0,0 +1,104 @@
+"""Compare concurrent read/write throughput of SQLite with and without WAL.
+
+Starts a number of reader and writer processes, similar to gunicorn workers
+serving pages while the admin interface writes, and counts the finished
+operations per second for the default journal and for SQLITE_PRAGMAS.
+
+Usage: python benchmarks/sqlite_concurrency.py [--seconds 5] [--readers 4]
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+
+DEFAULT_PRAGMAS = {"busy_timeout": 5000}
+TUNED_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 268435456,
+}
+
+
+def connect(path, pragmas):
+    con = sqlite3.connect(path, timeout=5, isolation_level=None)
+    for name, value in pragmas.items():
+        con.execute(f"PRAGMA {name}={value}")
+    return con
+
+
+def setup(path, pragmas, rows=5000):
+    con = connect(path, pragmas)
+    con.execute("CREATE TABLE pages (id INTEGER PRIMARY KEY, name TEXT, text TEXT)")
+    con.executemany(
+        "INSERT INTO pages (name, text) VALUES (?, ?)",
+        ((f"page{i}", "x" * 500) for i in range(rows)),
+    )
+    con.close()
+
+
+def reader(path, pragmas, deadline, counter):
+    con = connect(path, pragmas)
+    n = 0
+    while time.time() < deadline:
+        con.execute("SELECT name, text FROM pages WHERE id = ?", (n % 5000 + 1,)).fetchall()
+        con.execute("SELECT COUNT(*) FROM pages").fetchone()
+        n += 1
+    with counter.get_lock():
+        counter.value += n
+
+
+def writer(path, pragmas, deadline, counter):
+    con = connect(path, pragmas)
+    n = 0
+    while time.time() < deadline:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("UPDATE pages SET text = ? WHERE id = ?", ("y" * 500, n % 5000 + 1))
+        con.execute("COMMIT")
+        n += 1
+    with counter.get_lock():
+        counter.value += n
+
+
+def run(pragmas, seconds, readers, writers):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.sqlite")
+        setup(path, pragmas)
+        reads = multiprocessing.Value("i", 0)
+        writes = multiprocessing.Value("i", 0)
+        deadline = time.time() + seconds
+        procs = [
+            multiprocessing.Process(target=reader, args=(path, pragmas, deadline, reads))
+            for _ in range(readers)
+        ] + [
+            multiprocessing.Process(target=writer, args=(path, pragmas, deadline, writes))
+            for _ in range(writers)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        return reads.value / seconds, writes.value / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=1)
+    args = parser.parse_args()
+
+    for label, pragmas in (("default journal", DEFAULT_PRAGMAS), ("WAL", TUNED_PRAGMAS)):
+        reads, writes = run(pragmas, args.seconds, args.readers, args.writers)
+        print(f"{label:16} reads/s: {reads:10.0f}  writes/s: {writes:8.0f}")
+
+
+if __name__ == "__main__":
+    main()
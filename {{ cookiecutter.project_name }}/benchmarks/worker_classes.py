@@ -0,0 +1,116 @@
+"""Compare the throughput of the gunicorn worker classes.
+
+Starts gunicorn with gunicorn.conf.py once per worker class and measures
+requests per second for the start page and the admin list views with a
+number of concurrent clients. Run from the project directory after
+"flask init-db", the admin user is used to log in.
+
+Usage: python benchmarks/worker_classes.py [--seconds 10] [--clients 16]
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import argparse
+import http.cookiejar
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+URLS = ["/", "/admin/image/", "/admin/file/", "/admin/staticpage/", "/admin/user/"]
+
+
+def opener_for(base_url, username, password):
+    """Return an url opener with a logged in session."""
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+    )
+    data = urllib.parse.urlencode({"username": username, "password": password})
+    opener.open(base_url + "/admin/login/", data.encode()).read()
+    return opener
+
+
+def wait_until_ready(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/").read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn didn't start")
+
+
+def measure(base_url, path, seconds, clients, credentials):
+    counts = []
+    deadline = time.time() + seconds
+
+    def client():
+        opener = opener_for(base_url, *credentials)
+        n = 0
+        while time.time() < deadline:
+            opener.open(base_url + path).read()
+            n += 1
+        counts.append(n)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument(
+        "--worker-classes", nargs="+", default=["sync", "gthread", "gevent"]
+    )
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = {}
+    for worker_class in args.worker_classes:
+        env = dict(
+            os.environ,
+            GUNICORN_WORKER_CLASS=worker_class,
+            GUNICORN_BIND=f"127.0.0.1:{args.port}",
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:application"],
+            env=env,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_ready(base_url)
+            results[worker_class] = [
+                measure(
+                    base_url, path, args.seconds, args.clients,
+                    (args.username, args.password),
+                )
+                for path in URLS
+            ]
+        except RuntimeError as e:
+            print(f"{worker_class}: {e}")
+        finally:
+            server.terminate()
+            server.wait()
+
+    print("requests/s".ljust(20) + "".join(c.rjust(10) for c in results))
+    for i, path in enumerate(URLS):
+        print(path.ljust(20) + "".join(f"{r[i]:10.0f}" for r in results.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Gunicorn configuration.
+
+Start with: gunicorn -c gunicorn.conf.py wsgi:application
+
+All settings can be changed with environment variables, e.g.
+GUNICORN_WORKER_CLASS=gthread GUNICORN_THREADS=8.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import glob
+import multiprocessing
+import os
+
+
+def _memory_limit():
+    """Return the memory available to the container in bytes or None."""
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _default_workers():
+    """2 * CPUs + 1, but not more than fit into memory."""
+    workers = multiprocessing.cpu_count() * 2 + 1
+    limit = _memory_limit()
+    if limit is not None:
+        worker_memory = int(os.environ.get("GUNICORN_WORKER_MEMORY_MB", 128)) * 1024 ** 2
+        workers = min(workers, max(1, limit // worker_memory))
+    return workers
+
+
+# only nginx in the same container connects, it restricts /metrics
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5000")
+
+# sync, gthread or gevent (gevent needs the gevent package)
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+workers = int(os.environ.get("GUNICORN_WORKERS", _default_workers()))
+threads = int(os.environ.get("GUNICORN_THREADS", 4 if worker_class == "gthread" else 1))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# load the application once in the master, workers share the memory
+# copy-on-write. gevent has to patch the standard library before the
+# application is imported, so it loads the application in each worker.
+preload_app = worker_class != "gevent"
+
+# restart workers regularly to contain memory leaks, the jitter keeps them
+# from restarting all at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG")
+errorlog = "-"
+
+# the workers write their metrics into this directory, app.metrics adds
+# them up. Must match METRICS_DIR of the app config.
+metrics_dir = os.environ.get(
+    "METRICS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "app", "cache", "metrics"),
+)
+
+
+def on_starting(server):
+    # values of the previous run, counters start at zero again
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+
+
+def post_fork(server, worker):
+    # database connections opened in the master must not be shared
+    if preload_app:
+        from app import db
+        from wsgi import application
+
+        with application.app_context():
+            db.engine.dispose()
@@ -8,14 +8,22 @@
 :last modified time: 2019-06-09 13:20:49
 
 """
+import os
 import pathlib
-import shutil
-import tempfile
-import tarfile
 import click
 import subprocess
 import sys
 from fabric import Connection
+from backups import (
+    create_backup,
+    data_dirs,
+    file_hash,
+    receive_backup,
+    remote_command,
+    restore_backup,
+    send_backup,
+    stream_restore,
+)
 
 
 {% if cookiecutter.docker_registry %}
@@ -48,6 +56,80 @@ def checked_call(cmd):
         sys.exit(1)
 
 
+class SSHTransport:
+    """Run commands on a host over SSH with binary stdin and stdout."""
+
+    def __init__(self, host):
+        self.host = host
+
+    def run(self, command):
+        c = Connection(self.host)
+        c.open()
+        stdin, stdout, stderr = c.client.exec_command(command)
+        return RemoteProcess(stdin, stdout, stderr)
+
+
+class RemoteProcess:
+    def __init__(self, stdin, stdout, stderr):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def close_stdin(self):
+        self.stdin.channel.shutdown_write()
+
+    def wait(self):
+        return self.stdout.channel.recv_exit_status()
+
+
+class LocalTransport:
+    """Run commands in a local shell, stands in for a remote host."""
+
+    def run(self, command):
+        return LocalProcess(
+            subprocess.Popen(
+                command,
+                shell=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        )
+
+
+class LocalProcess:
+    def __init__(self, popen):
+        self.popen = popen
+        self.stdin = popen.stdin
+        self.stdout = popen.stdout
+        self.stderr = popen.stderr
+
+    def close_stdin(self):
+        self.stdin.close()
+
+    def wait(self):
+        return self.popen.wait()
+
+
+def read_checksum(path):
+    """Return the SHA-256 from the sha256sum file of a backup or None."""
+    try:
+        with open(f"{path}.sha256") as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def transfer_progress(label, total=None):
+    """Return a callback that shows the transferred megabytes."""
+    def progress(size):
+        text = f"\r{label}: {size / 1024 ** 2:.1f} MiB"
+        if total:
+            text += f" of {total / 1024 ** 2:.1f} MiB ({size / total:.0%})"
+        click.echo(text, nl=False)
+    return progress
+
+
 class AbstractHost:
     def __init__(self, host, directory):
         self.host = host
@@ -67,38 +149,53 @@ class LocalHost(AbstractHost):
     def deploy(self, host):
         pass
 
-    def backup(self, host, dst):
-        app_p = pathlib.Path("./app")
-        dst_p = pathlib.Path(dst)
-
-        if dst_p.is_file():
-            dst_p.unlink()
-
-        tar = tarfile.open(dst, mode="w:gz")
-        tar.add(app_p / "db", "db")
-        tar.add(app_p / "static" / "images", "images")
-        tar.close()
-
-    def restore(self, host, src):
-        app_p = pathlib.Path() / "app"
+    def backup(self, host, dst, full=False, full_every=7, jobs=None):
+        app_p = pathlib.Path(self.directory) / "app"
+        manifest = create_backup(app_p, dst, full=full, full_every=full_every, jobs=jobs)
+        click.echo(
+            f"Created backup {manifest['name']}: {manifest['archived']} of "
+            f"{len(manifest['files'])} files archived "
+            f"({manifest['archived_size'] / 1024 ** 2:.1f} MiB)"
+        )
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tmpdir_p = pathlib.Path(tmpdir)
+    def restore(self, host, src, jobs=None, only=None):
+        app_p = pathlib.Path(self.directory) / "app"
+
+        if pathlib.Path(src).is_dir():
+            manifest = restore_backup(app_p, src, jobs=jobs, paths=only)
+            click.echo(f"Restored backup {manifest['name']}")
+            return
+
+        # single archive from a remote host, verified if the checksum
+        # file of the backup is next to it
+        sha256 = read_checksum(src)
+        with open(src, "rb") as f:
+            stream_restore(
+                f,
+                data_dirs(app_p),
+                sha256,
+                page_cache=app_p / "cache" / "pages",
+                paths=only,
+            )
+        click.echo(f"Restored {src}")
 
-            with tarfile.open(src, "r:gz") as tar:
-                tar.extractall(tmpdir_p)
 
-            shutil.rmtree(app_p / "db", ignore_errors=True)
-            shutil.copytree(tmpdir_p / "db", app_p / "db")
+class RemoteHost(AbstractHost):
+    """Host with the data in `directory`, reached over SSH.
 
-            shutil.rmtree(app_p / "static/images", ignore_errors=True)
-            shutil.copytree(tmpdir_p / "images", app_p / "static/images")
+    Backups and restores stream one tar.gz archive through the SSH channel,
+    the host runs backups.py for that. Databases are read and written with
+    the SQLite backup API, so the app keeps running.
 
+    """
 
-class RemoteHost(AbstractHost):
+    def __init__(self, host, directory, transport=None):
+        super().__init__(host, directory)
+        self.transport = transport or SSHTransport(host)
 
     def deploy(self, host):
         c = Connection(host)
+        # the image build compiles the static assets
         checked_call(["docker-compose", "build"])
         checked_call(["docker-compose", "push", "flask"])
         c.run(f"docker login {DOCKER_REGISTRY}")
@@ -106,20 +203,31 @@ class RemoteHost(AbstractHost):
         c.run(f"cd {self.directory} && docker-compose down")
         c.run(f"cd {self.directory} && docker-compose up -d")
 
-    def backup(self, host, dst):
-        c = Connection(host)
-        c.run(f"cd {self.directory} && tar -cvzf backup.tgz db images")
-        c.get(f"{self.directory}/backup.tgz", dst)
-        c.run(f"rm {self.directory}/backup.tgz")
-
-    def restore(self, host, src):
-        c = Connection(host)
-        c.put(src, f"{self.directory}/backup.tgz")
-        c.run(f"cd {self.directory} && docker-compose stop")
-        c.run(f"cd {self.directory} && rm -rf db images", warn=True)
-        c.run(f"cd {self.directory} && tar -xvzf backup.tgz")
-        c.run(f"rm {self.directory}/backup.tgz")
-        c.run(f"cd {self.directory} && docker-compose start")
+    def backup(self, host, dst, **options):
+        process = self.transport.run(
+            remote_command(self.directory, "stream-backup", "db=db", "images=images")
+        )
+        sha256 = receive_backup(process, dst, progress=transfer_progress("Backup"))
+        # same format as sha256sum, "sha256sum -c" verifies the archive
+        with open(f"{dst}.sha256", "w") as f:
+            f.write(f"{sha256}  {os.path.basename(dst)}\n")
+        click.echo(f"\nStored backup in {dst}, sha256 {sha256}")
+
+    def restore(self, host, src, **options):
+        sha256 = file_hash(src)
+        if read_checksum(src) not in (None, sha256):
+            click.echo(click.style(f"Checksum of {src} doesn't match {src}.sha256", fg="red"))
+            sys.exit(1)
+
+        args = ["stream-restore", sha256, "db=db", "images=images", "--page-cache", "cache/pages"]
+        for path in options.get("only") or ():
+            args += ["--only", path]
+        process = self.transport.run(remote_command(self.directory, *args))
+        send_backup(
+            process, src,
+            progress=transfer_progress("Restore", os.path.getsize(src)),
+        )
+        click.echo(f"\nRestored {src}, sha256 {sha256}")
 
 
 hosts = dict(
@@ -129,6 +237,13 @@ hosts = dict(
     {% endif %}
 )
 
+# a local directory that stands in for the remote host, e.g. to try a
+# backup and restore: STANDIN_DIRECTORY=/tmp/site python manage.py ...
+if os.environ.get("STANDIN_DIRECTORY"):
+    hosts["standin"] = RemoteHost(
+        "standin", os.environ["STANDIN_DIRECTORY"], transport=LocalTransport()
+    )
+
 
 @click.group()
 def cli():
@@ -144,18 +259,40 @@ def deploy(host):
 
 @cli.command()
 @click.option("-h", "--host", type=click.Choice(hosts.keys()))
+@click.option("--full", is_flag=True, help="Force a full backup (localhost).")
+@click.option(
+    "--full-every", type=int, default=7, show_default=True,
+    help="Incremental backups between two full backups (localhost).",
+)
+@click.option("-j", "--jobs", type=int, default=None, help="Number of processes (localhost).")
 @click.argument("dst", type=click.types.Path())
-def backup(host, dst):
-    """Backup application data to file."""
-    hosts[host].backup(host, dst)
+def backup(host, dst, full, full_every, jobs):
+    """Backup application data to file.
+
+    On localhost DST is a backup directory that keeps a chain of full and
+    incremental backups.
+
+    """
+    hosts[host].backup(host, dst, full=full, full_every=full_every, jobs=jobs)
 
 
 @cli.command()
 @click.option("-h", "--host", type=click.Choice(hosts.keys()))
+@click.option("-j", "--jobs", type=int, default=None, help="Number of processes (localhost).")
+@click.option(
+    "--only", multiple=True,
+    help="Restore only this path of the backup, e.g. db or images/logo.png.",
+)
 @click.argument("src", type=click.types.Path())
-def restore(host, src):
-    """Restore application data from file."""
-    hosts[host].restore(host, src)
+def restore(host, src, jobs, only):
+    """Restore application data from file.
+
+    On localhost SRC may be a backup or a backup directory, the newest
+    backup in it is restored then. All files are verified before the live
+    data is replaced.
+
+    """
+    hosts[host].restore(host, src, jobs=jobs, only=only)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+"""Fixtures of the test suite.
+
+Flask-Admin and webassets only support one application per process, so
+the app is created once per session with all its files in a temporary
+directory. Every test gets an empty database with the default roles and
+the admin user.
+
+:author: Stefan Lehmann <stlm@posteo.de>
+:license: MIT, see license file or https://opensource.org/licenses/MIT
+
+"""
+import os
+import pytest
+from sqlalchemy import event
+
+os.environ.setdefault("FLASK_SECRET_KEY", "test")
+
+from app import (  # noqa: E402
+    create_app,
+    db,
+    init_database,
+    page_cache,
+    row_count_cache,
+    search_index,
+)
+from app.config import APP_DIR, TestingConfig, config  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    data = tmp_path_factory.mktemp("data")
+    (data / "images").mkdir()
+    (data / "files").mkdir()
+
+    class Config(TestingConfig):
+        PERMISSION_CACHE_STAMP = str(data / "db" / "roles.stamp")
+        USER_SNAPSHOT_STAMP_DIR = str(data / "db" / "users")
+        ROW_COUNT_STAMP_DIR = str(data / "db" / "rowcounts")
+        PAGE_CACHE_DIR = str(data / "cache" / "pages")
+        PAGE_CACHE_STAMP_DIR = str(data / "db" / "pages")
+        METRICS_DIR = str(data / "cache" / "metrics")
+        UPLOADED_IMAGES_DEST = str(data / "images")
+        UPLOADED_FILES_DEST = str(data / "files")
+        UPLOAD_TMP_DIR = str(data / "cache" / "uploads")
+        PASSWORD_HASH_SLOT_DIR = str(data / "cache" / "password-slots")
+        # bundles are built into the temporary directory
+        ASSETS_LOAD_PATH = [os.path.join(APP_DIR, "static")]
+        ASSETS_DIRECTORY = str(data / "assets")
+        ASSETS_MANIFEST = "json:" + str(data / "assets" / "manifest.json")
+
+    testing = config["testing"]
+    config["testing"] = Config
+    try:
+        app = create_app("testing")
+    finally:
+        config["testing"] = testing
+    return app
+
+
+@pytest.fixture
+def database(app):
+    """Empty database with the default roles and the admin user."""
+    with app.app_context():
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.execute(f"DROP TABLE IF EXISTS {search_index.TABLE}")
+        db.create_all()
+        with db.engine.begin() as connection:
+            search_index.create(connection)
+        for table in db.metadata.tables:
+            row_count_cache.invalidate(table)
+        page_cache.clear()
+        init_database()
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    """Log in with username and password through the admin login form."""
+    def login(username="admin", password="admin"):
+        response = client.post(
+            "/admin/login/", data={"username": username, "password": password}
+        )
+        assert response.status_code == 302
+    return login
+
+
+@pytest.fixture
+def queries(app):
+    """List of the SQL statements executed while the test runs."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # without an app context, its teardown would remove the session
+    engine = db.get_engine(app)
+    event.listen(engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(engine, "before_cursor_execute", record)
@@ -0,0 +1,248 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import pytest
+import backups
+
+
+@pytest.fixture
+def app_dir(tmp_path):
+    app_dir = tmp_path / "app"
+    (app_dir / "db").mkdir(parents=True)
+    (app_dir / "static" / "images").mkdir(parents=True)
+    (app_dir / "static" / "images" / "photo.jpg").write_bytes(b"jpeg data")
+    connection = sqlite3.connect(str(app_dir / "db" / "data.sqlite"))
+    connection.execute("CREATE TABLE pages (name TEXT)")
+    connection.execute("INSERT INTO pages VALUES ('first')")
+    connection.commit()
+    connection.close()
+    return app_dir
+
+
+def page_names(app_dir):
+    connection = sqlite3.connect(str(app_dir / "db" / "data.sqlite"))
+    try:
+        return [name for name, in connection.execute("SELECT name FROM pages ORDER BY rowid")]
+    finally:
+        connection.close()
+
+
+def add_page(app_dir, name):
+    connection = sqlite3.connect(str(app_dir / "db" / "data.sqlite"))
+    connection.execute("INSERT INTO pages VALUES (?)", (name,))
+    connection.commit()
+    connection.close()
+
+
+@pytest.mark.parametrize("memory_limit", [backups.SNAPSHOT_MEMORY_LIMIT, 0])
+def test_backup_and_restore(app_dir, tmp_path, monkeypatch, memory_limit):
+    monkeypatch.setattr(backups, "SNAPSHOT_MEMORY_LIMIT", memory_limit)
+    repository = tmp_path / "backups"
+    manifest = backups.create_backup(app_dir, repository, jobs=1)
+
+    entry = manifest["files"]["db/data.sqlite"]
+    assert entry["size"] == (app_dir / "db" / "data.sqlite").stat().st_size
+    assert sorted(p.name for p in (repository / manifest["name"]).iterdir()) == [
+        "manifest.json", "part-000.tar.gz", "part-001.tar"
+    ]
+
+    add_page(app_dir, "second")
+    (app_dir / "static" / "images" / "photo.jpg").unlink()
+    backups.restore_backup(app_dir, repository, jobs=1)
+
+    assert page_names(app_dir) == ["first"]
+    assert (app_dir / "static" / "images" / "photo.jpg").read_bytes() == b"jpeg data"
+
+
+def test_stream_backup_and_restore(app_dir):
+    targets = backups.data_dirs(app_dir)
+    out = io.BytesIO()
+    sha256, size = backups.stream_backup(targets, out)
+    assert size == len(out.getvalue())
+
+    add_page(app_dir, "second")
+    backups.stream_restore(io.BytesIO(out.getvalue()), targets, sha256)
+    assert page_names(app_dir) == ["first"]
+    assert not list(app_dir.glob(".restore-*"))
+
+
+def test_incremental_backup_archives_changed_files(app_dir, tmp_path):
+    repository = tmp_path / "backups"
+    backups.create_backup(app_dir, repository, jobs=1)
+    (app_dir / "static" / "images" / "new.png").write_bytes(b"png data")
+    manifest = backups.create_backup(app_dir, repository, jobs=1)
+
+    assert manifest["name"].endswith("-incr")
+    # the database is always archived
+    archived = {
+        arcname for arcname, entry in manifest["files"].items()
+        if entry["backup"] == manifest["name"]
+    }
+    assert archived == {"db/data.sqlite", "images/new.png"}
+    with open(repository / manifest["name"] / "manifest.json") as f:
+        assert json.load(f)["parent"] == manifest["parent"]
+
+
+def corrupt(path):
+    """Flip a byte of the archived content of an uncompressed tar."""
+    data = bytearray(path.read_bytes())
+    offset = data.index(b"jpeg data")
+    data[offset] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+
+def test_restore_rejects_corrupt_files(app_dir, tmp_path):
+    repository = tmp_path / "backups"
+    manifest = backups.create_backup(app_dir, repository, jobs=1)
+    corrupt(repository / manifest["name"] / manifest["files"]["images/photo.jpg"]["part"])
+    add_page(app_dir, "second")
+
+    with pytest.raises(backups.BackupError, match="images/photo.jpg"):
+        backups.restore_backup(app_dir, repository, jobs=1)
+    # nothing was replaced, not even the intact database
+    assert page_names(app_dir) == ["first", "second"]
+    assert not list(app_dir.glob(".restore-*"))
+
+
+def test_restore_rejects_missing_archives(app_dir, tmp_path):
+    repository = tmp_path / "backups"
+    manifest = backups.create_backup(app_dir, repository, jobs=1)
+    (repository / manifest["name"] / manifest["files"]["db/data.sqlite"]["part"]).unlink()
+
+    with pytest.raises(backups.BackupError, match="missing"):
+        backups.restore_backup(app_dir, repository, jobs=1)
+
+
+def test_restore_selected_paths(app_dir, tmp_path):
+    repository = tmp_path / "backups"
+    backups.create_backup(app_dir, repository, jobs=1)
+    add_page(app_dir, "second")
+    (app_dir / "static" / "images" / "photo.jpg").write_bytes(b"changed")
+
+    backups.restore_backup(app_dir, repository, jobs=1, paths=["db"])
+    assert page_names(app_dir) == ["first"]
+    assert (app_dir / "static" / "images" / "photo.jpg").read_bytes() == b"changed"
+
+
+def test_restore_rejects_paths_outside_the_data(app_dir, tmp_path):
+    repository = tmp_path / "backups"
+    manifest = backups.create_backup(app_dir, repository, jobs=1)
+    manifest_file = repository / manifest["name"] / "manifest.json"
+    data = json.loads(manifest_file.read_text())
+    data["files"]["images/../../wsgi.py"] = data["files"]["images/photo.jpg"]
+    manifest_file.write_text(json.dumps(data))
+
+    with pytest.raises(backups.BackupError, match="Invalid path"):
+        backups.restore_backup(app_dir, repository, jobs=1)
+
+
+def test_stream_restore_rejects_wrong_checksum(app_dir):
+    targets = backups.data_dirs(app_dir)
+    out = io.BytesIO()
+    backups.stream_backup(targets, out)
+    add_page(app_dir, "second")
+
+    with pytest.raises(backups.BackupError, match="Checksum mismatch"):
+        backups.stream_restore(io.BytesIO(out.getvalue()), targets, "0" * 64)
+    assert page_names(app_dir) == ["first", "second"]
+
+
+def test_checksums_reuse_hardlinked_files(tmp_path):
+    previous = tmp_path / "previous"
+    (previous / "images").mkdir(parents=True)
+    (previous / "images" / "same.jpg").write_bytes(b"same")
+    (previous / "images" / "changed.jpg").write_bytes(b"old")
+    assert backups.write_checksums(previous, "SHA256SUMS") == 2
+
+    snapshot = tmp_path / "snapshot"
+    (snapshot / "images").mkdir(parents=True)
+    os.link(previous / "images" / "same.jpg", snapshot / "images" / "same.jpg")
+    (snapshot / "images" / "changed.jpg").write_bytes(b"new")
+    assert backups.write_checksums(snapshot, "SHA256SUMS", previous) == 1
+
+    lines = (snapshot / "SHA256SUMS").read_text().splitlines()
+    assert lines == [
+        f"{hashlib.sha256(b'new').hexdigest()}  images/changed.jpg",
+        f"{hashlib.sha256(b'same').hexdigest()}  images/same.jpg",
+    ]
+
+
+def test_backup_durations_share_one_metrics_file(app_dir, monkeypatch):
+    values = pytest.importorskip("prometheus_client.values")
+    from prometheus_client import CollectorRegistry
+    from prometheus_client.multiprocess import MultiProcessCollector
+
+    directory = app_dir / "cache" / "backup-metrics"
+    directory.mkdir(parents=True)
+    monkeypatch.setenv("BACKUP_METRICS_DIR", str(directory))
+    monkeypatch.setenv("prometheus_multiproc_dir", str(directory))
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(directory))
+    monkeypatch.setattr(values, "ValueClass", values.ValueClass)
+    for pid, seconds in ((100, 2.0), (101, 3.0)):
+        # separate runs of the script
+        monkeypatch.setattr(os, "getpid", lambda: pid)
+        backups.record_duration(app_dir, "backup", seconds)
+
+    assert [path.name for path in directory.glob("*.db")] == ["histogram_backup.db"]
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry, str(directory))
+    assert registry.get_sample_value(
+        "backup_duration_seconds_sum", {"operation": "backup"}
+    ) == 5.0
+
+
+class Process:
+    def __init__(self, code):
+        self.popen = subprocess.Popen(
+            [sys.executable, "-c", code],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        self.stdin = self.popen.stdin
+        self.stdout = self.popen.stdout
+        self.stderr = self.popen.stderr
+
+    def close_stdin(self):
+        self.stdin.close()
+
+    def wait(self):
+        return self.popen.wait()
+
+
+def finishes(fn, *args):
+    # a deadlock would hang the test run
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn(*args)), daemon=True)
+    thread.start()
+    thread.join(30)
+    return result
+
+
+def test_receive_backup_with_large_stderr(tmp_path):
+    data = b"archive" * 1000
+    sha256 = hashlib.sha256(data).hexdigest()
+    process = Process(
+        "import sys\n"
+        "sys.stderr.write('warning\\n' * 200000)\n"
+        "sys.stderr.flush()\n"
+        f"sys.stdout.buffer.write({data!r})\n"
+        f"sys.stderr.write('sha256 {sha256} {len(data)}\\n')\n"
+    )
+    assert finishes(backups.receive_backup, process, tmp_path / "backup.tar.gz") == [sha256]
+    assert (tmp_path / "backup.tar.gz").read_bytes() == data
+
+
+def test_send_backup_with_large_stderr(tmp_path):
+    src = tmp_path / "backup.tar.gz"
+    src.write_bytes(b"archive" * 200000)
+    process = Process(
+        "import sys\n"
+        "sys.stderr.write('warning\\n' * 200000)\n"
+        "sys.stderr.flush()\n"
+        "sys.stdin.buffer.read()\n"
+    )
+    assert finishes(backups.send_backup, process, src) == [None]
@@ -0,0 +1,68 @@
+import pytest
+from PIL import Image as PILImage
+from app import db
+from app.models import File, Image
+
+
+@pytest.fixture
+def protected(app, monkeypatch):
+    monkeypatch.setitem(app.config, "PROTECTED_DOWNLOADS", True)
+
+
+@pytest.fixture
+def image(app, database):
+    with app.test_request_context():
+        image = Image(filename="protected.png")
+        PILImage.new("RGB", (400, 300), "green").save(image.filepath)
+        image.update_variants()
+        db.session.add(image)
+        db.session.commit()
+    return image
+
+
+def test_public_urls_point_to_the_upload_directory(app, image):
+    with app.test_request_context():
+        assert image.url == "/static/images/protected.png"
+        assert image.variant_url("thumbnail") == "/static/images/thumbnail/protected.png"
+
+
+def test_protected_urls_point_to_the_download_route(app, image, protected):
+    with app.test_request_context():
+        assert image.url.startswith("/download/images/")
+        assert "variant=thumbnail" in image.variant_url("thumbnail")
+        assert "variant" not in image.variant_url("large")
+
+
+def test_protected_download_needs_login(app, client, image, login, protected):
+    with app.test_request_context():
+        url = image.variant_url("thumbnail")
+    response = client.get(url)
+    assert response.status_code == 302
+    assert "/admin/login/" in response.headers["Location"]
+
+    login()
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert "private" in response.headers["Cache-Control"]
+
+    response = client.get(url, headers={"X-Sendfile-Type": "X-Accel-Redirect"})
+    assert response.headers["X-Accel-Redirect"] == "/protected/images/thumbnail/protected.png"
+    assert response.data == b""
+
+
+def test_unknown_variants_are_not_found(app, client, image, database):
+    with app.test_request_context():
+        url = image.download_url
+    assert client.get(url + "&variant=large").status_code == 404
+    assert client.get(url + "&variant=../../config.py").status_code == 404
+
+    item = File(filename="notes.txt")
+    with open(item.filepath, "w") as f:
+        f.write("notes")
+    db.session.add(item)
+    db.session.commit()
+    with app.test_request_context():
+        url = item.download_url
+    assert client.get(url).data == b"notes"
+    assert client.get(url + "&variant=thumbnail").status_code == 404
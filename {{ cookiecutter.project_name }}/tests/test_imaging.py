@@ -0,0 +1,69 @@
+import os
+from PIL import Image as PILImage
+from app import db
+from app.commands import optimize_images_command
+from app.imaging import process_image, variant_path
+from app.models import Image
+
+
+def add_image(filename, variants, formats=""):
+    image = Image(filename=filename, variants=variants, formats=formats)
+    db.session.add(image)
+    db.session.commit()
+    for name in image.variant_names:
+        path = variant_path(image.filepath, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"old variant")
+    return image
+
+
+def optimize(app):
+    result = app.test_cli_runner().invoke(optimize_images_command, ["-j", "1"])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_optimize_replaces_variants(app, database):
+    image = add_image("photo.jpg", "thumbnail,medium")
+    PILImage.new("RGB", (400, 300), "red").save(image.filepath)
+
+    optimize(app)
+
+    image = Image.query.filter_by(filename="photo.jpg").one()
+    assert image.variant_names == ["thumbnail"]
+    assert (image.width, image.height) == (400, 300)
+    with PILImage.open(variant_path(image.filepath, "thumbnail")) as thumbnail:
+        assert thumbnail.size == (150, 113)
+    # the image is smaller than the medium size now
+    assert not os.path.exists(variant_path(image.filepath, "medium"))
+
+
+def test_optimize_clears_variants_of_broken_images(app, database):
+    image = add_image("broken.jpg", "thumbnail")
+    with open(image.filepath, "wb") as f:
+        f.write(b"not an image")
+
+    assert "Error processing broken.jpg" in optimize(app)
+
+    image = Image.query.filter_by(filename="broken.jpg").one()
+    assert image.variant_names == []
+    assert image.width is None
+    assert not os.path.exists(variant_path(image.filepath, "thumbnail"))
+    assert image.variant_url("thumbnail") == image.url
+
+
+def test_metadata_is_removed_if_reencoding_isnt_smaller(tmp_path):
+    path = str(tmp_path / "noisy.jpg")
+    exif = PILImage.Exif()
+    exif[0x010F] = "Camera"
+    PILImage.effect_noise((300, 200), 100).convert("RGB").save(
+        path, quality=30, exif=exif.tobytes()
+    )
+    size = os.path.getsize(path)
+
+    info = process_image(path, {}, quality=85)
+    with PILImage.open(path) as img:
+        assert "exif" not in img.info
+        assert not img.getexif()
+    assert info.size == os.path.getsize(path) > size
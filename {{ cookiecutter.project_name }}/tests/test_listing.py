@@ -0,0 +1,39 @@
+import re
+from app import db
+from app.models import Role, User
+
+
+def pager_links(response):
+    pager = response.data.decode().split('<ul class="pagination">')[1].split("</ul>")[0]
+    return [link.replace("&amp;", "&") for link in re.findall(r'href="([^"]*)"', pager)]
+
+
+def test_keyset_pages_link_only_previous_and_next(client, database, login, queries):
+    role = Role.query.filter_by(name="user").first() or Role(name="user")
+    db.session.add_all(User(username=f"user{i:02}", role=role) for i in range(44))
+    db.session.commit()
+    login()
+
+    response = client.get("/admin/user/")
+    links = pager_links(response)
+    assert len(links) == 2
+    assert "after=" in links[1]
+    assert not any("page=2" in link for link in links)
+
+    seen = []
+    url = links[1]
+    for _ in range(2):
+        del queries[:]
+        response = client.get(url)
+        assert response.status_code == 200
+        # continues after the cursor, SQLite always gets an OFFSET of 0
+        assert [q for q in queries if "FROM users" in q and "WHERE users.id > ?" in q]
+        seen.extend(re.findall(r"user\d\d", response.data.decode()))
+        url = pager_links(response)[1]
+    # admin and user00 to user18 are on the first page
+    assert seen[0] == "user19" and seen[-1] == "user43"
+
+    previous = pager_links(response)[0]
+    assert "before=" in previous
+    names = re.findall(r"user\d\d", client.get(previous).data.decode())
+    assert names[0] == "user19" and names[-1] == "user38"
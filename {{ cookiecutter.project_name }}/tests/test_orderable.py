@@ -0,0 +1,255 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event
+from app import db
+from app.models import StaticPage
+from app.orderable import ORDER_GAP, OrderCounter, reserve_order_indexes
+
+
+@pytest.fixture
+def pages(database):
+    """Five pages a to e in this order."""
+    pages = [StaticPage(name=name) for name in "abcde"]
+    db.session.add_all(pages)
+    db.session.commit()
+    return {page.name: page.id for page in pages}
+
+
+def order():
+    return "".join(
+        page.name
+        for page in StaticPage.query.order_by(StaticPage._order_key(), StaticPage.id)
+    )
+
+
+def set_order_index(pages, names, value):
+    db.session.execute(
+        StaticPage.__table__.update()
+        .where(StaticPage.id.in_([pages[name] for name in names]))
+        .values(order_index=value)
+    )
+    db.session.commit()
+
+
+def page(name):
+    return StaticPage.query.filter_by(name=name).one()
+
+
+def indexes():
+    return [
+        order_index
+        for order_index, in db.session.query(StaticPage.order_index).order_by(
+            StaticPage._order_key(), StaticPage.id
+        )
+    ]
+
+
+@pytest.mark.parametrize("names, position, expected", [
+    ("bd", 0, "bdace"),
+    ("bd", None, "acebd"),
+    ("bd", 1, "abdce"),
+    ("ae", 2, "bcaed"),
+    ("c", 99, "abdec"),
+])
+def test_move_rows_to(pages, names, position, expected):
+    StaticPage.move_rows_to([pages[name] for name in names], position)
+    assert order() == expected
+
+
+@pytest.mark.parametrize("names, offset, expected", [
+    ("bd", -1, "badce"),
+    ("bd", -5, "bdace"),
+    ("bd", 1, "acbed"),
+    ("ab", -1, "abcde"),
+    ("de", 3, "abcde"),
+])
+def test_move_rows(pages, names, offset, expected):
+    StaticPage.move_rows([pages[name] for name in names], offset)
+    assert order() == expected
+
+
+def test_move_rows_only_updates_moved_rows(pages, queries):
+    del queries[:]
+    StaticPage.move_rows_to([pages["c"]], 0)
+    updates = [q for q in queries if q.startswith("UPDATE static_pages")]
+    # one executemany statement
+    assert len(updates) == 1
+    assert order() == "cabde"
+
+
+def test_move_rows_renumbers_rows_without_order_index(pages):
+    db.session.execute(
+        StaticPage.__table__.update()
+        .where(StaticPage.id.in_([pages["a"], pages["b"]]))
+        .values(order_index=None)
+    )
+    StaticPage.move_rows_to([pages["e"]], 0)
+    indexes = [page.order_index for page in StaticPage.query.order_by(StaticPage.order_index)]
+    assert order() == "ecdab"
+    assert None not in indexes
+    assert len(set(indexes)) == len(indexes)
+
+
+@pytest.mark.parametrize("name, before, expected", [
+    ("c", True, "b"),
+    ("c", False, "d"),
+    ("a", True, None),
+    ("e", False, None),
+])
+def test_neighbour(pages, name, before, expected):
+    neighbour = page(name)._neighbour(before)
+    assert (neighbour and neighbour.name) == expected
+
+
+def test_neighbour_with_equal_and_missing_order_index(pages):
+    set_order_index(pages, "bc", 5000)
+    set_order_index(pages, "de", None)
+    # ties are broken by id, rows without order_index come last
+    assert page("b")._neighbour(before=False).name == "c"
+    assert page("c")._neighbour(before=True).name == "b"
+    assert page("c")._neighbour(before=False).name == "d"
+    assert page("d")._neighbour(before=True).name == "c"
+    assert page("e")._neighbour(before=True).name == "d"
+    assert page("e")._neighbour(before=False) is None
+
+
+@pytest.mark.parametrize("name, method, expected", [
+    ("c", "move_up", "acbde"),
+    ("c", "move_down", "abdce"),
+    ("a", "move_up", "abcde"),
+    ("e", "move_down", "abcde"),
+    ("a", "move_down", "bacde"),
+    ("e", "move_up", "abced"),
+])
+def test_move_up_and_down(pages, name, method, expected):
+    getattr(page(name), method)()
+    assert order() == expected
+
+
+def test_swap_keeps_the_other_indexes(pages):
+    before = indexes()
+    page("b").move_down()
+    assert order() == "acbde"
+    assert sorted(indexes()) == before
+
+
+@pytest.mark.parametrize("names, value", [("bc", 5000), ("bc", None), ("abcde", 0)])
+def test_swap_renumbers_equal_and_missing_indexes(pages, names, value):
+    set_order_index(pages, names, value)
+    current = list(order())
+    position = current.index(names[0])
+    page(names[0]).move_down()
+
+    current[position:position + 2] = reversed(current[position:position + 2])
+    assert order() == "".join(current)
+    assert None not in indexes()
+    assert indexes() == sorted(set(indexes()))
+
+
+def test_moves_in_a_row(pages):
+    page("e").move_up()
+    assert order() == "abced"
+    page("e").move_up()
+    assert order() == "abecd"
+    page("a").move_down()
+    assert order() == "baecd"
+    page("d").move_down()
+    assert order() == "baecd"
+
+
+def test_renumber_order_index(pages):
+    set_order_index(pages, "ab", 7)
+    set_order_index(pages, "d", None)
+    StaticPage.renumber_order_index()
+    assert order() == "abced"
+    assert indexes() == [i * ORDER_GAP for i in range(5)]
+
+
+def test_renumber_order_index_keeps_uncommitted_with_commit_false(pages):
+    set_order_index(pages, "abcde", 1)
+    StaticPage.renumber_order_index(commit=False)
+    db.session.rollback()
+    assert indexes() == [1] * 5
+
+
+@pytest.mark.parametrize("action, names, expected", [
+    ("move_up", "c", "acbde"),
+    ("move_up", "a", "abcde"),
+    ("move_up", "ace", "acbed"),
+    ("move_down", "c", "abdce"),
+    ("move_down", "e", "abcde"),
+    ("move_down", "bd", "acbed"),
+    ("move_top", "ce", "ceabd"),
+    ("move_bottom", "ab", "cdeab"),
+])
+def test_admin_actions(client, login, pages, action, names, expected):
+    login()
+    response = client.post(
+        "/admin/staticpage/action/",
+        data={"action": action, "rowid": [pages[name] for name in names]},
+    )
+    assert response.status_code == 302
+    assert order() == expected
+
+
+@pytest.mark.parametrize("action, expected", [
+    ("move_up", "acbde"),
+    ("move_down", "abdce"),
+])
+def test_admin_actions_with_duplicate_indexes(client, login, pages, action, expected):
+    set_order_index(pages, "abcde", ORDER_GAP)
+    login()
+    client.post("/admin/staticpage/action/", data={"action": action, "rowid": pages["c"]})
+    assert order() == expected
+    assert indexes() == sorted(set(indexes()))
+
+
+def test_reserve_order_indexes_starts_after_existing_rows(pages):
+    table = StaticPage.__table__
+    last = db.session.query(db.func.max(StaticPage.order_index)).scalar()
+    with db.engine.begin() as connection:
+        first = reserve_order_indexes(connection, table, 3)
+        second = reserve_order_indexes(connection, table)
+    assert list(first) == [last + ORDER_GAP * i for i in (1, 2, 3)]
+    assert list(second) == [last + ORDER_GAP * 4]
+
+
+def test_concurrent_reservations_dont_overlap(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'order.sqlite'}", connect_args={"timeout": 30}
+    )
+    db.metadata.create_all(engine, tables=[OrderCounter.__table__, StaticPage.__table__])
+    table = StaticPage.__table__
+
+    def reserve(count):
+        reserved = []
+        for _ in range(20):
+            with engine.begin() as connection:
+                reserved.extend(reserve_order_indexes(connection, table, count))
+        return reserved
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(reserve, [1, 2, 3, 4] * 2))
+
+    values = [value for reserved in results for value in reserved]
+    assert len(values) == 20 * 2 * (1 + 2 + 3 + 4)
+    assert len(set(values)) == len(values)
+    assert all(value % ORDER_GAP == 0 for value in values)
+
+
+def test_reservation_when_counter_is_seeded_meanwhile(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'order.sqlite'}")
+    db.metadata.create_all(engine, tables=[OrderCounter.__table__, StaticPage.__table__])
+    table = StaticPage.__table__
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def seed(conn, cursor, statement, parameters, context, executemany):
+        # another transaction seeds the counter after it was found missing
+        if "max(" in statement:
+            conn.connection.cursor().execute(
+                "INSERT INTO order_counters VALUES (?, ?)", (table.name, 10 * ORDER_GAP)
+            )
+
+    with engine.begin() as connection:
+        reserved = reserve_order_indexes(connection, table, 2)
+    assert list(reserved) == [11 * ORDER_GAP, 12 * ORDER_GAP]
@@ -0,0 +1,66 @@
+from app import db, page_cache
+from app.commands import build_assets_command
+from app.models import StaticPage
+from app.pagecache import PageCache
+
+
+def cached(key):
+    return page_cache.get(key, page_cache.version(key))
+
+
+def test_pages_are_cached_until_they_change(client, database):
+    db.session.add(StaticPage(name="about", text="<p>first</p>"))
+    db.session.commit()
+    assert b"first" in client.get("/page/about").data
+    assert cached("about") is not None
+
+    page = StaticPage.query.filter_by(name="about").first()
+    page.text = "<p>second</p>"
+    db.session.commit()
+    assert cached("about") is None
+    assert b"second" in client.get("/page/about").data
+
+
+def test_keys_depend_on_the_assets_manifest(tmp_path):
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text('{"gen/styles.%(version)s.css": "aaaa"}')
+
+    class App:
+        config = {
+            "PAGE_CACHE_DIR": str(tmp_path / "pages"),
+            "PAGE_CACHE_STAMP_DIR": str(tmp_path / "stamps"),
+            "ASSETS_MANIFEST": f"json:{manifest}",
+        }
+
+    cache = PageCache()
+    cache.init_app(App)
+    cache.set("about", "", "<link href='styles.aaaa.css'>")
+    assert cache.get("about", "") is not None
+
+    manifest.write_text('{"gen/styles.%(version)s.css": "bbbb"}')
+    cache.init_app(App)
+    assert cache.get("about", "") is None
+
+
+def test_build_assets_clears_the_page_cache(app, database):
+    page_cache.set("about", page_cache.version("about"), "<p>old</p>")
+    result = app.test_cli_runner().invoke(build_assets_command)
+    assert result.exit_code == 0, result.output
+    assert cached("about") is None
+
+
+def test_page_rendered_before_a_change_is_not_used(client, database):
+    db.session.add(StaticPage(name="news", text="<p>old</p>"))
+    db.session.commit()
+
+    # a request reads the version and the old row, then the page changes
+    # before it stores the rendered page
+    version = page_cache.version("news")
+    page = StaticPage.query.filter_by(name="news").first()
+    body = f"<html>{page.text}</html>"
+    page.text = "<p>new</p>"
+    db.session.commit()
+    page_cache.set("news", version, body)
+
+    assert cached("news") is None
+    assert b"new" in client.get("/page/news").data
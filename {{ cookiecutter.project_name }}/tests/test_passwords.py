@@ -0,0 +1,99 @@
+import fcntl
+import os
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash
+from app import password_hasher
+from app.models import User
+from app.passwords import HashingBusy, PasswordHasher, normalize_method
+
+
+@pytest.fixture
+def hasher(tmp_path):
+    hasher = PasswordHasher()
+    hasher.concurrency = 2
+    hasher.slot_dir = str(tmp_path)
+    return hasher
+
+
+@pytest.mark.parametrize("method, normalized", [
+    ("pbkdf2:sha256", "pbkdf2:sha256:150000"),
+    ("pbkdf2:sha256:", "pbkdf2:sha256:150000"),
+    ("pbkdf2:sha512:1000", "pbkdf2:sha512:1000"),
+    ("sha256", "sha256"),
+])
+def test_normalize_method(method, normalized):
+    assert normalize_method(method) == normalized
+
+
+def test_needs_rehash_with_default_iterations(monkeypatch):
+    hasher = PasswordHasher()
+    monkeypatch.setattr(hasher, "method", "pbkdf2:sha256")
+    assert not hasher.needs_rehash(generate_password_hash("x", "pbkdf2:sha256"))
+    assert not hasher.needs_rehash(generate_password_hash("x", "pbkdf2:sha256:150000"))
+    assert hasher.needs_rehash(generate_password_hash("x", "pbkdf2:sha256:1000"))
+    assert hasher.needs_rehash(generate_password_hash("x", "pbkdf2:sha512"))
+
+
+def test_login_keeps_current_hashes(database, queries):
+    del queries[:]
+    assert User.authenticate("admin", "admin") is not None
+    assert not [q for q in queries if q.startswith("UPDATE")]
+
+
+def test_login_upgrades_outdated_hashes(database, monkeypatch):
+    monkeypatch.setattr(password_hasher, "method", "pbkdf2:sha256:2000")
+    user = User.authenticate("admin", "admin")
+    assert user.password_hash.startswith("pbkdf2:sha256:2000$")
+    assert User.authenticate("admin", "admin") is not None
+
+
+def test_dummy_hash_is_computed_on_start():
+    assert password_hasher._dummy_hash.startswith(password_hasher.method + "$")
+
+
+def test_concurrent_hashes_are_limited(hasher):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def slow_hash(password):
+        with lock:
+            running.append(password)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(password)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: hasher._run(slow_hash, i), range(16)))
+    assert max(peak) == 2
+
+
+def test_slots_are_shared_with_other_processes(hasher):
+    # locks of another process on all slot files
+    fds = []
+    for slot in range(hasher.concurrency):
+        fd = os.open(os.path.join(hasher.slot_dir, f"{slot}.lock"), os.O_RDWR | os.O_CREAT)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        fds.append(fd)
+    hasher.timeout = 0.05
+    with pytest.raises(HashingBusy):
+        hasher._run(len, "x")
+
+    os.close(fds.pop())
+    assert hasher._run(len, "x") == 1
+    for fd in fds:
+        os.close(fd)
+
+
+def test_busy_login_is_unavailable(client, database, monkeypatch):
+    def busy():
+        raise HashingBusy()
+
+    monkeypatch.setattr(password_hasher, "_acquire", busy)
+    response = client.post("/admin/login/", data={"username": "admin", "password": "admin"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
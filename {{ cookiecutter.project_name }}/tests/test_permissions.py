@@ -0,0 +1,43 @@
+from app import db, permission_cache
+from app.models import Permission, Role
+
+
+def test_permissions_are_cached(database, queries):
+    role = Role.query.filter_by(name="Superuser").first()
+    permission_cache.permissions(role.id)
+    del queries[:]
+    assert permission_cache.permissions(role.id) == Permission.ADMINISTER
+    assert permission_cache.permissions(12345) == 0
+    assert queries == []
+
+
+def test_role_changes_reload_the_permissions(database):
+    role = Role.query.filter_by(name="User").first()
+    assert permission_cache.permissions(role.id) == Permission.MODIFY
+    role.permissions = Permission.MODIFY | Permission.ADMINISTER
+    db.session.commit()
+    assert permission_cache.permissions(role.id) == Permission.MODIFY | Permission.ADMINISTER
+
+
+def test_other_workers_reload_after_a_stamp_change(database, queries):
+    role = Role.query.filter_by(name="User").first()
+    permission_cache.permissions(role.id)
+    # what another worker does after changing a role
+    permission_cache.stamp.bump()
+    del queries[:]
+    assert permission_cache.permissions(role.id) == Permission.MODIFY
+    assert len(queries) == 1
+
+
+def test_invalidate_during_lookup(database, monkeypatch):
+    role = Role.query.filter_by(name="User").first()
+    permission_cache.permissions(role.id)
+    read = permission_cache.stamp.read
+
+    def read_while_invalidated():
+        # another thread invalidates between the check and the lookup
+        permission_cache._permissions = None
+        return read()
+
+    monkeypatch.setattr(permission_cache.stamp, "read", read_while_invalidated)
+    assert permission_cache.permissions(role.id) == Permission.MODIFY
@@ -0,0 +1,70 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from app import db, queryinspector
+from app.metrics import _after_cursor_execute, _before_cursor_execute
+from app.models import Role, User
+from app.queryinspector import QueryBudgetExceeded, statement_shape
+
+
+def test_statement_shape_ignores_values():
+    assert statement_shape(
+        "SELECT a FROM t WHERE id IN (?, ?, ?) AND x = 'it''s' LIMIT 10"
+    ) == "SELECT a FROM t WHERE id IN (?) AND x = ? LIMIT ?"
+    assert statement_shape("SELECT a FROM t WHERE id = %(id_1)s") == statement_shape(
+        "SELECT a FROM t\n  WHERE id = 42"
+    )
+
+
+def test_statement_shape_keeps_names_with_digits():
+    assert statement_shape("SELECT t1.a FROM t1") == "SELECT t1.a FROM t1"
+
+
+def test_request_within_budget(app, client, database, login, monkeypatch):
+    monkeypatch.setitem(app.config["QUERY_BUDGETS"], "main.index", 5)
+    login()
+    assert client.get("/").status_code == 200
+
+
+def test_request_over_budget_fails(app, client, database, login, monkeypatch):
+    monkeypatch.setitem(app.config["QUERY_BUDGETS"], "main.index", 0)
+    monkeypatch.setitem(app.config, "USER_SNAPSHOT", False)
+    login()
+    with pytest.raises(QueryBudgetExceeded) as excinfo:
+        client.get("/")
+    assert excinfo.value.endpoint == "main.index"
+    assert excinfo.value.budget == 0
+
+
+def test_user_list_queries_dont_grow_with_the_rows(client, database, login, queries):
+    login()
+    client.get("/admin/user/")
+
+    def list_queries(users):
+        for i in range(users):
+            db.session.add(User(username=f"user{users}-{i}", role=Role(name=f"role{users}-{i}")))
+        db.session.commit()
+        del queries[:]
+        response = client.get("/admin/user/")
+        assert response.status_code == 200
+        assert f"role{users}-{users - 1}".encode() in response.data
+        return len(queries)
+
+    # the roles are loaded with the users, not one query per row
+    assert list_queries(2) == list_queries(15)
+
+
+@pytest.mark.parametrize("before, after", [
+    (_before_cursor_execute, _after_cursor_execute),
+    (queryinspector._before_cursor_execute, queryinspector._after_cursor_execute),
+])
+def test_failed_statements_leave_no_timing_state(app, before, after):
+    engine = create_engine("sqlite://")
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    with engine.connect() as connection, app.test_request_context():
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute("SELECT * FROM missing")
+        assert connection.execute("SELECT 1").scalar() == 1
+        assert not any(connection.info.values())
@@ -0,0 +1,30 @@
+from app import SCHEMA_VERSION, db, init_schema, schema_info, schema_version
+
+
+def test_current_schema_is_not_created_again(app, database, queries):
+    init_schema(app)
+    del queries[:]
+    init_schema(app)
+    assert len(queries) == 1
+    assert schema_version(db.engine) == SCHEMA_VERSION
+
+
+def test_empty_database_gets_the_schema(app, database):
+    # e.g. a new DATABASE_URL or a deleted SQLite file
+    db.drop_all()
+    assert schema_version(db.engine) is None
+
+    init_schema(app)
+    assert schema_version(db.engine) == SCHEMA_VERSION
+    assert "users" in db.engine.table_names()
+
+
+def test_outdated_schema_is_updated(app, database):
+    db.session.execute(schema_info.delete())
+    db.session.execute(schema_info.insert().values(version=SCHEMA_VERSION - 1))
+    db.session.commit()
+    db.session.execute("DROP TABLE static_pages")
+
+    init_schema(app)
+    assert schema_version(db.engine) == SCHEMA_VERSION
+    assert "static_pages" in db.engine.table_names()
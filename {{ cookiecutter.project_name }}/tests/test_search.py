@@ -0,0 +1,90 @@
+import pytest
+from app import db, search_index
+from app.commands import rebuild_search_index_command
+from app.models import StaticPage
+
+
+@pytest.fixture
+def pages(database):
+    db.session.add_all([
+        StaticPage(name="kontakt", text="<p>Schreiben Sie uns im <b>Café</b> am Markt.</p>"),
+        StaticPage(name="markt", text="<p>Öffnungszeiten des Wochenmarkts</p>"),
+        StaticPage(name="impressum", text="<p>Angaben &amp; Verantwortliche</p>"),
+    ])
+    db.session.commit()
+
+
+@pytest.fixture(params=["fts", "like"])
+def index(request, monkeypatch, pages):
+    """Runs the test with the index and with the LIKE fallback."""
+    if request.param == "like":
+        monkeypatch.setattr(search_index, "enabled", False)
+    elif not search_index.enabled:
+        pytest.skip("SQLite without FTS5")
+    return search_index
+
+
+def names(query):
+    return [result.name for result in search_index.search(query)]
+
+
+def test_matches_in_the_name_come_first(index):
+    assert names("markt") == ["markt", "kontakt"]
+
+
+def test_all_words_must_match(index):
+    assert names("café markt") == ["kontakt"]
+    assert names("café impressum") == []
+
+
+def test_last_word_is_a_prefix(index):
+    assert names("Öffnungs") == ["markt"]
+
+
+def test_query_operators_are_ignored(index):
+    assert names('"markt (') == ["markt", "kontakt"]
+    assert names("-markt:*") == ["markt", "kontakt"]
+    assert names("*") == []
+
+
+def test_results_are_escaped_and_highlighted(index):
+    result = search_index.search("verantwortliche")[0]
+    assert "<mark>Verantwortliche</mark>" in result.snippet
+    assert "&amp;" in result.snippet
+    assert "<p>" not in result.snippet
+
+
+def test_diacritics_are_ignored(pages):
+    if not search_index.enabled:
+        pytest.skip("SQLite without FTS5")
+    assert names("cafe") == ["kontakt"]
+
+
+def test_index_follows_changes(pages):
+    page = StaticPage.query.filter_by(name="impressum").one()
+    page.text = "<p>Datenschutz</p>"
+    db.session.commit()
+    assert names("verantwortliche") == []
+    assert names("datenschutz") == ["impressum"]
+
+    db.session.delete(page)
+    db.session.commit()
+    assert names("datenschutz") == []
+
+
+def test_search_page(client, pages):
+    response = client.get("/search?q=markt")
+    assert response.status_code == 200
+    assert b"<mark>markt</mark>" in response.data
+
+
+def test_rebuild_search_index(app, pages):
+    if not search_index.enabled:
+        pytest.skip("SQLite without FTS5")
+    with db.engine.begin() as connection:
+        connection.execute(f"DELETE FROM {search_index.TABLE}")
+    assert names("markt") == []
+
+    result = app.test_cli_runner().invoke(rebuild_search_index_command)
+    assert "Indexed 3 pages" in result.output
+    assert names("markt") == ["markt", "kontakt"]
@@ -0,0 +1,139 @@
+import os
+import pytest
+import shutil
+from PIL import Image as PILImage
+from app import db, files, images
+from app.imaging import variant_path
+from app.models import File, Image
+
+
+@pytest.fixture(autouse=True)
+def empty_store(database):
+    for upload_set in (files, images):
+        shutil.rmtree(upload_set.path("blobs"), ignore_errors=True)
+
+
+def upload(filename, data=b"same content"):
+    path = files.path(filename + ".upload")
+    with open(path, "wb") as f:
+        f.write(data)
+    item = File(filename=filename)
+    item.store_content(path)
+    db.session.add(item)
+    return item, path
+
+
+def upload_image(filename):
+    path = images.path(filename + ".upload")
+    PILImage.new("RGB", (400, 300), "green").save(path, "PNG")
+    item = Image(filename=filename)
+    item.store_content(path)
+    db.session.add(item)
+    return item, path
+
+
+@pytest.fixture
+def shared(database):
+    first, _ = upload("first.txt")
+    db.session.commit()
+    second, copy = upload("second.txt")
+    db.session.commit()
+    return first, second, copy
+
+
+def test_identical_content_shares_a_blob(shared):
+    first, second, copy = shared
+    assert first.blob == second.blob
+    assert os.path.exists(first.filepath)
+    # the copy is only kept until the commit
+    assert not os.path.exists(copy)
+
+
+def test_shared_blob_is_removed_with_the_last_row(shared):
+    first, second, _ = shared
+    db.session.delete(first)
+    db.session.commit()
+    assert os.path.exists(second.filepath)
+
+    db.session.delete(second)
+    db.session.commit()
+    assert not os.path.exists(second.filepath)
+
+
+def test_delete_keeps_the_file_until_the_commit(shared):
+    first, second, _ = shared
+    db.session.delete(first)
+    db.session.delete(second)
+    db.session.flush()
+    assert os.path.exists(first.filepath)
+
+    db.session.rollback()
+    assert os.path.exists(first.filepath)
+    assert File.query.count() == 2
+    # a later commit doesn't delete the files of the rolled back delete
+    db.session.commit()
+    assert os.path.exists(first.filepath)
+
+
+def test_rollback_removes_new_blob(database):
+    item, path = upload("new.txt", b"new content")
+    assert os.path.exists(item.filepath)
+    db.session.rollback()
+    assert not os.path.exists(item.filepath)
+
+
+def test_rollback_keeps_blob_of_other_rows(shared):
+    first, _, _ = shared
+    third, copy = upload("third.txt")
+    db.session.rollback()
+    assert os.path.exists(first.filepath)
+    assert not os.path.exists(copy)
+
+
+def test_vanished_blob_is_restored(database):
+    first, _ = upload("first.txt")
+    db.session.commit()
+    second, copy = upload("second.txt")
+    # another request deleted the last row referencing the blob
+    os.remove(first.filepath)
+    db.session.commit()
+
+    with open(second.filepath, "rb") as f:
+        assert f.read() == b"same content"
+    assert not os.path.exists(copy)
+
+
+def test_replaced_blob_is_removed_after_the_commit(database):
+    item, _ = upload("replaced.txt", b"old content")
+    db.session.commit()
+    old_path = item.filepath
+
+    path = files.path("replaced.txt.upload")
+    with open(path, "wb") as f:
+        f.write(b"new content")
+    item.store_content(path)
+    assert os.path.exists(old_path)
+    db.session.commit()
+    assert not os.path.exists(old_path)
+    assert os.path.exists(item.filepath)
+
+
+def test_shared_image_variants(database):
+    first, _ = upload_image("first.png")
+    db.session.commit()
+    second, copy = upload_image("second.png")
+    os.remove(variant_path(first.filepath, "thumbnail"))
+    os.remove(first.filepath)
+    db.session.commit()
+    thumbnail = variant_path(second.filepath, "thumbnail")
+    assert os.path.exists(second.filepath)
+    assert os.path.exists(thumbnail)
+    assert not os.path.exists(variant_path(copy, "thumbnail"))
+
+    db.session.delete(first)
+    db.session.commit()
+    assert os.path.exists(thumbnail)
+    db.session.delete(second)
+    db.session.commit()
+    assert not os.path.exists(second.filepath)
+    assert not os.path.exists(thumbnail)
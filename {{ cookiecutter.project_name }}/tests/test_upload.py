@@ -0,0 +1,178 @@
+import io
+import json
+import os
+import pytest
+import shutil
+from PIL import Image as PILImage
+from app import files, images, storage
+from app.models import File, Image
+
+
+def png(size=(40, 30)):
+    data = io.BytesIO()
+    PILImage.new("RGB", size, "blue").save(data, "PNG")
+    return data.getvalue()
+
+
+@pytest.fixture
+def uploads(app, client, database, login):
+    login()
+    shutil.rmtree(app.config["UPLOAD_TMP_DIR"], ignore_errors=True)
+
+    def start(filename, data, upload_set="images"):
+        response = client.post(
+            "/admin/upload/",
+            data=json.dumps(
+                {"upload_set": upload_set, "filename": filename, "size": len(data)}
+            ),
+        )
+        assert response.status_code == 201
+        assert response.get_json()["block_size"] == storage.HASH_BLOCK_SIZE
+        return response.get_json()["id"]
+    return start
+
+
+@pytest.fixture
+def tmp_files(app):
+    def tmp_files():
+        return sorted(os.listdir(app.config["UPLOAD_TMP_DIR"]))
+    return tmp_files
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(storage, "HASH_BLOCK_SIZE", 64)
+
+
+def put(client, upload_id, data, start, end):
+    return client.put(
+        f"/admin/upload/{upload_id}",
+        data=data[start:end + 1],
+        headers={"Content-Range": f"bytes {start}-{end}/{len(data)}"},
+    )
+
+
+def content_hash(data):
+    digests = []
+    tail = storage.hash_blocks(io.BytesIO(data), digests)
+    return storage.content_hash(digests, tail)
+
+
+def finish(client, upload_id, data=None):
+    body = {"content_hash": content_hash(data)} if data is not None else {}
+    return client.post(f"/admin/upload/{upload_id}/finish", data=json.dumps(body),
+                       content_type="application/json")
+
+
+def test_content_hash_of_blocks(tmp_path, small_blocks):
+    path = tmp_path / "data"
+    path.write_bytes(bytes(range(200)))
+    digests = []
+    with open(path, "rb") as f:
+        assert storage.hash_blocks(f, digests) == bytes(range(192, 200))
+    assert len(digests) == 3
+    assert storage.file_hash(str(path)) == content_hash(bytes(range(200)))
+    assert storage.file_hash(str(path)) != content_hash(bytes(range(199)))
+
+
+def test_upload_in_chunks(client, uploads, tmp_files):
+    data = png()
+    upload_id = uploads("chunks.png", data)
+    half = len(data) // 2
+
+    assert put(client, upload_id, data, 0, half - 1).get_json()["offset"] == half
+    # a repeated chunk is rejected with the current offset
+    response = put(client, upload_id, data, 0, half - 1)
+    assert response.status_code == 409
+    assert response.get_json()["offset"] == half
+    assert client.get(f"/admin/upload/{upload_id}").get_json()["offset"] == half
+    # finishing an incomplete upload returns the offset as well
+    assert finish(client, upload_id).status_code == 409
+
+    response = put(client, upload_id, data, half, len(data) - 1)
+    assert response.get_json()["offset"] == len(data)
+    response = finish(client, upload_id, data)
+    assert response.status_code == 200
+    assert response.get_json()["content_hash"] == content_hash(data)
+
+    image = Image.query.filter_by(filename="chunks.png").one()
+    assert (image.width, image.height) == (40, 30)
+    assert tmp_files() == []
+
+
+def test_blocks_are_hashed_while_they_arrive(app, client, uploads, small_blocks):
+    data = bytes(range(256)) * 2
+    upload_id = uploads("blocks.txt", data, "files")
+    meta_file = os.path.join(app.config["UPLOAD_TMP_DIR"], upload_id + ".json")
+
+    # chunks that don't end at block boundaries
+    put(client, upload_id, data, 0, 99)
+    put(client, upload_id, data, 100, 299)
+    with open(meta_file) as f:
+        assert len(json.load(f)["blocks"]) == 4
+    put(client, upload_id, data, 300, len(data) - 1)
+
+    response = finish(client, upload_id, data)
+    assert response.status_code == 200
+    assert response.get_json()["content_hash"] == content_hash(data)
+    with open(files.path("blocks.txt"), "rb") as f:
+        assert f.read() == data
+
+
+def test_content_addressed_upload_uses_content_hash(app, client, uploads, monkeypatch):
+    monkeypatch.setitem(app.config, "CONTENT_ADDRESSED_STORAGE", True)
+    data = b"notes " * 100
+    upload_id = uploads("notes.txt", data, "files")
+    put(client, upload_id, data, 0, len(data) - 1)
+
+    assert finish(client, upload_id, data).status_code == 200
+    item = File.query.filter_by(filename="notes.txt").one()
+    assert item.blob == storage.blob_name(content_hash(data), "notes.txt")
+    with open(files.path(item.blob), "rb") as f:
+        assert f.read() == data
+
+
+def test_second_finish_is_not_found(client, uploads):
+    data = png()
+    upload_id = uploads("twice.png", data)
+    put(client, upload_id, data, 0, len(data) - 1)
+
+    assert finish(client, upload_id, data).status_code == 200
+    assert finish(client, upload_id, data).status_code == 404
+    assert put(client, upload_id, data, 0, len(data) - 1).status_code == 404
+
+
+def test_uploads_are_not_below_the_static_directory(app):
+    assert not os.path.abspath(app.config["UPLOAD_TMP_DIR"]).startswith(
+        os.path.abspath(app.static_folder)
+    )
+
+
+def test_chunk_keeps_upload_from_expiring(app, client, uploads):
+    data = png()
+    upload_id = uploads("active.png", data)
+    meta_file = os.path.join(app.config["UPLOAD_TMP_DIR"], upload_id + ".json")
+    os.utime(meta_file, (0, 0))
+    put(client, upload_id, data, 0, 9)
+    assert os.path.getmtime(meta_file) > 0
+
+
+def test_wrong_checksum_discards_upload(client, uploads, tmp_files):
+    data = png()
+    upload_id = uploads("corrupted.png", data)
+    put(client, upload_id, data, 0, len(data) - 1)
+
+    assert finish(client, upload_id, data + b"x").status_code == 422
+    assert tmp_files() == []
+    assert Image.query.count() == 0
+
+
+def test_invalid_image_is_rejected(client, uploads, tmp_files):
+    data = b"not an image" * 10
+    upload_id = uploads("invalid.png", data)
+    put(client, upload_id, data, 0, len(data) - 1)
+
+    assert finish(client, upload_id, data).status_code == 400
+    assert tmp_files() == []
+    assert not os.path.exists(images.path("invalid.png"))
+    assert Image.query.count() == 0
@@ -0,0 +1,55 @@
+import os
+import pytest
+from app import db, user_stamps
+from app.models import Role, User
+
+
+@pytest.fixture
+def logged_in(client, database, login):
+    login()
+    # the first request after the login stores the snapshot
+    client.get("/admin/")
+    return User.query.filter_by(username="admin").first()
+
+
+def user_queries(queries):
+    return [q for q in queries if "FROM users" in q]
+
+
+def test_snapshot_replaces_the_user_query(client, logged_in, queries):
+    del queries[:]
+    assert client.get("/admin/").status_code == 200
+    assert user_queries(queries) == []
+
+
+def test_changes_of_other_users_keep_the_snapshot(client, logged_in, queries):
+    other = User(username="other", role=Role.query.filter_by(name="User").first())
+    db.session.add(other)
+    db.session.commit()
+    other.email = "other@example.com"
+    db.session.commit()
+
+    del queries[:]
+    client.get("/admin/")
+    assert user_queries(queries) == []
+
+
+def test_changes_of_the_user_invalidate_the_snapshot(client, logged_in, queries):
+    logged_in.email = "admin@example.com"
+    db.session.commit()
+
+    del queries[:]
+    client.get("/admin/")
+    assert len(user_queries(queries)) == 1
+
+
+def test_snapshot_without_stamp_is_invalid(client, logged_in, queries):
+    os.remove(user_stamps.stamp(logged_in.id).path)
+
+    del queries[:]
+    client.get("/admin/")
+    assert len(user_queries(queries)) == 1
+    # stored again with a new stamp
+    del queries[:]
+    client.get("/admin/")
+    assert user_queries(queries) == []